@@ -11,18 +11,25 @@ import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
 import prob2020.cython.cutils as cutils
 import prob2020.python.mutation_context as mc
+import prob2020.python.scores as scores
 import prob2020.python.permutation as pm
 import prob2020.python.indel as indel
 import prob2020.python.annotate as anot
 import prob2020.python.mymath as math
+import prob2020.python.scheduler as sched
+from prob2020.python.mutation_table import MutationTable
+import prob2020.python.mutation_reader as mr
+import prob2020.python.maf_writer as maf_writer
 
 # external imports
 import numpy as np
-import pandas as pd
+import scipy.sparse as sparse
 import pysam
 import csv
-from multiprocessing import Pool
 import argparse
+import glob
+import shutil
+import tempfile
 import logging
 import copy
 import itertools as it
@@ -31,37 +38,26 @@ logger = logging.getLogger(__name__)  # module logger
 
 def multiprocess_permutation(bed_dict, mut_df, opts, indel_df=None):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into bundles of genes with similar estimated cost.
     """
-    chroms = sorted(bed_dict.keys(), key=lambda x: len(bed_dict[x]), reverse=True)
-    multiprocess_flag = opts['processes']>0
-    if multiprocess_flag:
-        num_processes = opts['processes']
-    else:
-        num_processes = 1
-    #file_handle = open(opts['output'], 'w')
-    file_handle = opts['handle']
-    mywriter = csv.writer(file_handle, delimiter='\t', lineterminator='\n')
-    if opts['maf'] and opts['num_iterations']:
-        header = ['Gene', 'strand', 'Chromosome', 'Start_Position',
-                  'End_Position', 'Reference_Allele', 'Tumor_Allele',
-                  'Context', 'DNA_Change', 'Protein_Change', 'Variant_Classification']
-    elif opts['maf']:
-        header = ['Gene', 'strand', 'Chromosome', 'Start_Position',
-                  'End_Position', 'Reference_Allele', 'Tumor_Allele',
-                  'DNA_Change', 'Protein_Change', 'Variant_Classification',
-                  'Tumor_Sample', 'Tumor_Type']
-    else:
-        header = ['Gene', 'ID', 'gene length', 'non-silent snv', 'silent snv', 'nonsense', 'lost stop',
-                  'splice site', 'lost start', 'missense', 'recurrent missense',
-                  'normalized missense position entropy',]
-        # add column header for scores, is user provided one
-        if opts['score_dir']:
-            header += ['Total Missense MGAEntropy', 'Total Missense VEST Score']
-        # add indel columns
-        header += ['frameshift indel', 'inframe indel', 'normalized mutation entropy']
-    mywriter.writerow(header)
+    num_processes = opts['processes']
     num_iterations = opts['num_iterations']
+    header = output_header(opts)
+    if opts['maf']:
+        # each bundle of genes is written to a separate part of the output
+        # by the worker process
+        if opts['maf_format'] == 'npz':
+            part_dir = opts['output']
+        else:
+            maf_writer.MafWriter(opts['output'], header, opts['maf_format'],
+                                 header=True).close()
+            part_dir = tempfile.mkdtemp(prefix='.maf_parts',
+                                        dir=os.path.dirname(os.path.abspath(opts['output'])))
+    else:
+        #file_handle = open(opts['output'], 'w')
+        file_handle = opts['handle']
+        mywriter = csv.writer(file_handle, delimiter='\t', lineterminator='\n')
+        mywriter.writerow(header)
 
     # simulate indel counts
     if opts['summary'] and num_iterations:
@@ -91,85 +87,145 @@ def multiprocess_permutation(bed_dict, mut_df, opts, indel_df=None):
                 ix = name2ix[mygene]
                 fs_cts[0, ix] = 0 if mygene not in fs_cts_dict else fs_cts_dict[mygene]
                 inframe_cts[0, ix] = indel_cts_dict[mygene] - fs_cts[0, ix]
+        fs_cts = sparse.csc_matrix(fs_cts)
+        inframe_cts = sparse.csc_matrix(inframe_cts)
 
     # simulate snvs
-    obs_result = []
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                # iterate through each chromosome result
-                for chrom_result in process_results:
-                    # add columns for indels
-                    if opts['summary']:
-                        tmp_chrom_result = []
-                        for gname, grp in it.groupby(chrom_result, lambda x: x[0]):
-                            for l, row in enumerate(grp):
-                                gene_ix = name2ix[gname]
-                                fs_count = fs_cts[l, gene_ix]
-                                inframe_count = inframe_cts[l, gene_ix]
-                                missense_pos_ct = list(row.pop(-1).values())  # missense codon counts
-                                silent_pos_ct = [1 for l in range(row[4])]
-                                inactivating_ct = sum(row[5:9]) + fs_count
-                                tmp_count_list = missense_pos_ct + silent_pos_ct + [inactivating_ct, inframe_count]
-                                norm_ent = math.normalized_mutation_entropy(tmp_count_list)
-                                tmp_chrom_result.append(row+[fs_count, inframe_count, norm_ent])
-                        chrom_result = tmp_chrom_result
-
-                    # write output to file
-                    mywriter.writerows(chrom_result)
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
-        else:
-            # perform simulation
-            info = (bed_dict[chroms[i]], mut_df, opts)
-            chrom_results = singleprocess_permutation(info)
-
-            # add indel columns
+    bundles = sched.gene_bundles(bed_dict, mut_df, num_iterations,
+                                 num_processes)
+    # the output file handle can not be passed to other processes
+    worker_opts = {k: v for k, v in opts.items() if k != 'handle'}
+    # mutations are passed to the worker processes in shared memory, if specified
+    use_shared = num_processes > 0 and 'shared_memory' in opts and opts['shared_memory']
+    mut_table = MutationTable(mut_df, shared=True) if use_shared else None
+    if opts['maf']:
+        part_paths = [os.path.join(part_dir, 'part-{0:05d}'.format(i))
+                      for i in range(len(bundles))]
+        bundle_opts = (dict(worker_opts, maf_part=part_path) for part_path in part_paths)
+
+        # bundles finish out of order, so parts are appended once all
+        # previous parts are written
+        finished_parts = set()
+        num_appended = 0
+    else:
+        bundle_opts = it.repeat(worker_opts)
+    info_repeat = ((bundle, bundle_table, bundle_opt)
+                   for bundle, bundle_table, bundle_opt in zip(bundles,
+                                                               sched.bundle_mutations(mut_df, bundles, mut_table),
+                                                               bundle_opts))
+    bundle_results = sched.imap_bundles(singleprocess_permutation,
+                                        info_repeat, num_processes)
+    try:
+        for bundle_result in bundle_results:
+            # add columns for indels
             if opts['summary']:
-                tmp_chrom_result = []
-                for gname, grp in it.groupby(chrom_results, lambda x: x[0]):
-                    for l, row in enumerate(grp):
-                        gene_ix = name2ix[gname]
-                        fs_count = fs_cts[l, gene_ix]
-                        inframe_count = inframe_cts[l, gene_ix]
-                        missense_pos_ct = list(row.pop(-1).values())  # missense codon counts
-                        silent_pos_ct = [1 for l in range(row[4])]
-                        inactivating_ct = sum(row[5:9]) + fs_count
-                        tmp_count_list = missense_pos_ct + silent_pos_ct + [inactivating_ct, inframe_count]
-                        norm_ent = math.normalized_mutation_entropy(tmp_count_list)
-                        tmp_chrom_result.append(row+[fs_count, inframe_count, norm_ent])
-                chrom_results = tmp_chrom_result
-
-            # write to file
-            mywriter.writerows(chrom_results)
+                tmp_bundle_result = []
+                for gname, gene_len, summary_info in bundle_result:
+                    # indel counts of the gene in each simulation
+                    gene_ix = name2ix[gname]
+                    fs_count = fs_cts[:, gene_ix].toarray()[:, 0]
+                    inframe_count = inframe_cts[:, gene_ix].toarray()[:, 0]
+                    norm_ent = summary_mutation_entropy(summary_info, fs_count, inframe_count)
+
+                    # counts are written as integers
+                    num_sim = len(summary_info)
+                    sim_id = np.arange(1, num_sim+1).tolist() if num_iterations else ['NA']
+                    out_cols = [[gname]*num_sim, sim_id, [gene_len]*num_sim]
+                    out_cols += [summary_info[:, k].astype(int).tolist() for k in range(8)]
+                    out_cols += [summary_info[:, k].tolist() for k in range(8, summary_info.shape[1]-1)]
+                    out_cols += [fs_count.tolist(), inframe_count.tolist(), norm_ent.tolist()]
+                    tmp_bundle_result.extend(zip(*out_cols))
+                bundle_result = tmp_bundle_result
+
+            # write output to file
+            if not opts['maf']:
+                mywriter.writerows(bundle_result)
+            elif opts['maf_format'] != 'npz':
+                finished_parts.add(bundle_result)
+                while num_appended < len(part_paths) and part_paths[num_appended] in finished_parts:
+                    maf_writer.append_part(opts['output'], part_paths[num_appended])
+                    finished_parts.remove(part_paths[num_appended])
+                    num_appended += 1
+    finally:
+        if mut_table is not None:
+            mut_table.unlink()
+        if opts['maf'] and opts['maf_format'] != 'npz':
+            shutil.rmtree(part_dir, ignore_errors=True)
     #file_handle.close()
 
 
+def output_header(opts):
+    """Returns the column names of the output."""
+    if opts['maf'] and opts['num_iterations']:
+        header = list(pm.maf_columns)
+    elif opts['maf']:
+        header = ['Gene', 'strand', 'Chromosome', 'Start_Position',
+                  'End_Position', 'Reference_Allele', 'Tumor_Allele',
+                  'DNA_Change', 'Protein_Change', 'Variant_Classification',
+                  'Tumor_Sample', 'Tumor_Type']
+    else:
+        header = ['Gene', 'ID', 'gene length', 'non-silent snv', 'silent snv', 'nonsense', 'lost stop',
+                  'splice site', 'lost start', 'missense', 'recurrent missense',
+                  'normalized missense position entropy',]
+        # add column header for scores, is user provided one
+        if opts['score_dir']:
+            header += ['Total Missense MGAEntropy', 'Total Missense VEST Score']
+        # add indel columns
+        header += ['frameshift indel', 'inframe indel', 'normalized mutation entropy']
+    return header
+
+
+def summary_mutation_entropy(summary_info, fs_count, inframe_count):
+    """Computes the normalized mutation entropy of each row of summary
+    features.
+
+    Missense positions, silent mutations (each counted separately),
+    inactivating mutations (including frameshifts) and inframe indels are
+    the categories of mutations.
+
+    Parameters
+    ----------
+    summary_info : np.array
+        summary features from pm.summary_permutation
+    fs_count : np.array
+        number of frameshift indels for each row
+    inframe_count : np.array
+        number of inframe indels for each row
+
+    Returns
+    -------
+    norm_ent : np.array
+        normalized mutation entropy for each row
+    """
+    missense_ct = summary_info[:, 5] + summary_info[:, 6]
+    silent_ct = summary_info[:, 1]
+    inactivating_ct = summary_info[:, 2:6].sum(axis=1) + fs_count
+    total_ct = missense_ct + silent_ct + inactivating_ct + inframe_count
+    counts_ent = (summary_info[:, -1] + math.xlog2x(inactivating_ct) +
+                  math.xlog2x(inframe_count))
+    return math.normalized_mutation_entropy_batch(counts_ent, total_ct)
+
+
 @utils.log_error_decorator
 def singleprocess_permutation(info):
-    bed_list, mut_df, opts = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
+    bed_list, mut_table, opts = info
+    logger.info('Working on {0} genes ({1} . . .)'.format(len(bed_list),
+                                                         bed_list[0].gene_name))
     num_iterations = opts['num_iterations']
     gene_fa = pysam.Fastafile(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    score_provider = scores.get_score_provider(opts['score_dir']) if opts['score_dir'] else None
+    if opts['maf']:
+        # mutations are written directly to this bundle's part of the output
+        writer = maf_writer.MafWriter(opts['maf_part'], output_header(opts),
+                                      opts['maf_format'])
 
     # go through each gene to perform simulation
     result = []
     for bed in bed_list:
         # compute context counts and somatic bases for each context
-        gene_tuple = mc.compute_mutation_context(bed, gs, mut_df, opts)
+        gene_mut_df = mut_table.gene_mutations(bed.gene_name)
+        gene_tuple = mc.compute_mutation_context(bed, gs, gene_mut_df, opts)
         context_cts, context_to_mutations, mutations_df, gs, sc = gene_tuple
 
         if context_to_mutations:
@@ -183,10 +239,14 @@ def singleprocess_permutation(info):
                                                       tmp_mut_info['Somatic AA'],
                                                       tmp_mut_info['Codon Pos'],
                                                       bed.gene_name,
-                                                      opts['score_dir'],
+                                                      score_provider,
                                                       min_frac=opts['fraction'],
                                                       min_recur=opts['recurrent'])
-                tmp_result = [[bed.gene_name, 'NA', bed.cds_len] + tmp_result]
+                # replace missense position counts by their c*log2(c) sum
+                pos_ct = np.array(list(tmp_result.pop(-1).values()), dtype=float)
+                tmp_result.append(math.xlog2x(pos_ct).sum())
+                tmp_result = [(bed.gene_name, bed.cds_len,
+                               np.array([tmp_result], dtype=float))]
             ## Just record protein changes in MAF
             elif opts['maf'] and not num_iterations:
                 # input code for just annotating genes mutations
@@ -194,19 +254,22 @@ def singleprocess_permutation(info):
                                                mutations_df['Tumor_Allele'].tolist(),
                                                gs)
                 # add tumor sample / tumor type info to output
-                tmp_result = [line + [mutations_df['Tumor_Sample'].iloc[i],
+                writer.write([line + [mutations_df['Tumor_Sample'].iloc[i],
                                       mutations_df['Tumor_Type'].iloc[i]]
-                              for i, line in enumerate(tmp_result)]
+                              for i, line in enumerate(tmp_result)])
+                tmp_result = []
             ## Do permutations
             elif opts['maf']:
                 # if user specified MAF format then output all mutations in
                 # MAF format
-                tmp_result = pm.maf_permutation(context_cts,
-                                                context_to_mutations,
-                                                sc,
-                                                gs,
-                                                num_iterations,
-                                                drop_silent=opts['drop_silent'])
+                for maf_df in pm.maf_permutation(context_cts,
+                                                 context_to_mutations,
+                                                 sc,
+                                                 gs,
+                                                 num_iterations,
+                                                 drop_silent=opts['drop_silent']):
+                    writer.write(maf_df)
+                tmp_result = []
             else:
                 # Summarized results for feature for each simulation for each
                 # gene
@@ -214,15 +277,20 @@ def singleprocess_permutation(info):
                                                     context_to_mutations,
                                                     sc,  # sequence context obj
                                                     gs,  # gene sequence obj
-                                                    opts['score_dir'],
+                                                    score_provider,
                                                     num_iterations,
                                                     min_frac=opts['fraction'],
                                                     min_recur=opts['recurrent'],
                                                     drop_silent=opts['drop_silent'])
+                tmp_result = [(bed.gene_name, bed.cds_len, tmp_result)]
             result += tmp_result
 
     gene_fa.close()
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
+    logger.info('Finished working on {0} genes ({1} . . .).'.format(len(bed_list),
+                                                                   bed_list[0].gene_name))
+    if opts['maf']:
+        writer.close()
+        return opts['maf_part']
     return result
 
 
@@ -253,7 +321,7 @@ def parse_arguments():
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'DNA mutations file (MAF file)'
+    help_str = 'DNA mutations file (MAF file), or a prepared mutation file'
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
@@ -262,7 +330,8 @@ def parse_arguments():
                         type=str, required=True,
                         help=help_str)
     help_str = ('Directory containing pre-compute score information in '
-                'for VEST and evolutionary conservation in pickle format (Default: None).')
+                'for VEST and evolutionary conservation in pickle format, or a score '
+                'store file from convert_scores (Default: None).')
     parser.add_argument('-s', '--score-dir',
                         type=str, default=None,
                         help=help_str)
@@ -272,6 +341,27 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Pass mutations to the worker processes through shared memory '
+                'instead of copying them to each process (Default: False).')
+    parser.add_argument('--shared-memory',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
+    help_str = ('Directory to cache sequence context indexes of genes and parsed '
+                'mutation files, which are reused in later runs with the same '
+                'gene FASTA and mutation files '
+                '(Default: None).')
+    parser.add_argument('--cache-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = ('Random number generation used for simulations. "randomstate" '
+                'reproduces results of previous versions, while "generator" '
+                'uses an independent stream for each gene and sequence context '
+                '(Default: randomstate).')
+    parser.add_argument('--random-backend',
+                        type=str, default='randomstate',
+                        choices=['randomstate', 'generator'],
+                        help=help_str)
     help_str = ('Number of iterations for null model simulations. If zero is '
                 'specified then output represents a result from actually observed mutations (provided by -m parameter), '
                 'otherwise results will be from simulated mutations. (Default: 0).')
@@ -297,6 +387,14 @@ def parse_arguments():
                                 action='store_true',
                                 help='Flag for saving results in MAF format '
                                 '(Default: False).')
+    help_str = ('Format of MAF output: "text", "gzip" (compressed text) or "npz" '
+                '(a directory of prepared mutation files with columnar arrays). '
+                'By default, gzip is used if the output ends with ".gz", and '
+                'npz if it ends with ".npz", otherwise text.')
+    parser.add_argument('--maf-format',
+                        type=str, default=None,
+                        choices=maf_writer.maf_formats,
+                        help=help_str)
     help_str = ('Use mutations that are not mapped to the the single reference '
                 'transcript for a gene specified in the bed file indicated by '
                 'the -b option.')
@@ -345,7 +443,8 @@ def parse_arguments():
     parser.add_argument('-seed', '--seed',
                         type=int, default=101,
                         help=help_str)
-    help_str = 'Output text file of results'
+    help_str = ('Output text file of results (see --maf-format for the '
+                'formats of MAF output)')
     parser.add_argument('-o', '--output',
                         type=str, required=True,
                         help=help_str)
@@ -381,16 +480,8 @@ def main(opts):
     gene_fa.close()
 
     # Get Mutations
-    mut_df = pd.read_csv(opts['mutations'], sep='\t')
-    orig_num_mut = len(mut_df)
-
-    # rename columns to fit my internal column names
-    rename_dict = {
-        'Hugo_Symbol': 'Gene',
-        'Tumor_Sample_Barcode': 'Tumor_Sample',
-        'Tumor_Seq_Allele2' : 'Tumor_Allele'
-    }
-    mut_df.rename(columns=rename_dict, inplace=True)
+    cache_dir = opts['cache_dir'] if 'cache_dir' in opts else None
+    mut_df = mr.read_mutations(opts['mutations'], cache_dir=cache_dir)
 
     # restrict to only observed genes if flag present
     restricted_genes = None
@@ -402,29 +493,41 @@ def main(opts):
     indel_df.loc[:, 'Start_Position'] = indel_df['Start_Position'] - 1  # convert to 0-based
     indel_df.loc[:, 'indel len'] = indel_df['indel len'] + 1
     logger.info('There were {0} indels identified.'.format(len(indel_df)))
-    mut_df = mut_df.dropna(subset=['Tumor_Allele', 'Start_Position', 'Chromosome'])
-    logger.info('Kept {0} mutations after droping mutations with missing '
-                'information (Droped: {1})'.format(len(mut_df), orig_num_mut - len(mut_df)))
 
     # select valid single nucleotide variants only
-    mut_df = utils._fix_mutation_df(mut_df, opts['unique'])
+    mut_df = mc.select_snvs(mut_df, opts, opts['unique'])
 
     # read in bed info
     bed_dict = utils.read_bed(opts['bed'], restricted_genes)
 
     # perform permutation
-    opts['handle'] = open(opts['output'], 'w')
-    multiprocess_permutation(bed_dict, mut_df, opts, indel_df)
-
-    # save indels
     if opts['maf']:
-        #with open(opts['output'], 'a') as handle:
-        mywriter = csv.writer(opts['handle'], delimiter='\t', lineterminator='\n')
+        maf_format = opts['maf_format'] if 'maf_format' in opts else None
+        opts['maf_format'] = maf_writer.infer_maf_format(opts['output'], maf_format)
+        indel_path = opts['output']
+        if opts['maf_format'] == 'npz':
+            # prepared mutation files of each part are saved in a directory
+            if not os.path.exists(opts['output']):
+                os.makedirs(opts['output'])
+            # only remove prepared mutation files of a previous run
+            for prefix in ['part-', 'indels-']:
+                for old_path in glob.glob(os.path.join(opts['output'], prefix+'*.npz')):
+                    os.remove(old_path)
+            indel_path = os.path.join(opts['output'], 'indels')
+        multiprocess_permutation(bed_dict, mut_df, opts, indel_df)
+
+        # save indels
+        writer = maf_writer.MafWriter(indel_path, output_header(opts),
+                                      opts['maf_format'], mode='a')
         for maf_lines in indel.simulate_indel_maf(indel_df, bed_dict,
                                                   opts['num_iterations'],
                                                   opts['seed']):
-            mywriter.writerows(maf_lines)
-    opts['handle'].close()
+            writer.write(maf_lines)
+        writer.close()
+    else:
+        opts['handle'] = open(opts['output'], 'w')
+        multiprocess_permutation(bed_dict, mut_df, opts, indel_df)
+        opts['handle'].close()
 
 
 def cli_main():
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" This script converts the per gene VEST, MGA entropy and neighbor graph
+pickle files into a single memory-mapped score store file.
+"""
+# fix problems with pythons terrible import system
+import sys
+import os
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+sys.path.append(os.path.join(file_dir, '../../'))
+
+import prob2020.python.utils as utils
+import prob2020.python.score_store as score_store
+
+# actually important imports
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)  # module logger
+
+
+def parse_arguments():
+    info = 'Converts per gene score pickle files into a single score store file'
+    parser = argparse.ArgumentParser(description=info)
+
+    # logging arguments
+    parser.add_argument('-ll', '--log-level',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Write a log file (--log-level=DEBUG for debug mode, '
+                        '--log-level=INFO for info mode)')
+    parser.add_argument('-l', '--log',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Path to log file. (accepts stdout)')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Flag for more verbose log output')
+
+    # program arguments
+    help_str = 'Directory containing VEST and MGA entropy pickle files'
+    parser.add_argument('-s', '--score-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = 'Directory containing neighbor graph pickle files'
+    parser.add_argument('-ng', '--neighbor-graph-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = 'Output score store file'
+    parser.add_argument('-o', '--output',
+                        type=str, required=True,
+                        help=help_str)
+    args = parser.parse_args()
+
+    # handle logging
+    if args.log_level or args.log:
+        if args.log:
+            log_file = args.log
+        else:
+            log_file = ''  # auto-name the log file
+    else:
+        log_file = os.devnull
+    log_level = args.log_level
+    utils.start_logging(log_file=log_file,
+                        log_level=log_level,
+                        verbose=args.verbose)  # start logging
+
+    # log user entered command
+    logger.info('Command: {0}'.format(' '.join(sys.argv)))
+
+    return vars(args)
+
+
+def main(opts):
+    if not opts['score_dir'] and not opts['neighbor_graph_dir']:
+        raise ValueError('Either a score directory or a neighbor graph '
+                         'directory is required')
+    score_store.write_score_store(opts['output'],
+                                  score_dir=opts['score_dir'],
+                                  graph_dir=opts['neighbor_graph_dir'])
+
+
+def cli_main():
+    opts = parse_arguments()
+    main(opts)
+
+if __name__ == "__main__":
+    cli_main()
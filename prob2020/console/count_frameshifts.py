@@ -7,6 +7,8 @@ sys.path.append(os.path.join(file_dir, '../'))
 
 import prob2020.python.utils as utils
 import prob2020.python.indel as indel
+import prob2020.python.mutation_reader as mr
+import numpy as np
 import pandas as pd
 import argparse
 
@@ -24,14 +26,11 @@ def count_frameshifts(mut_df,
         gene_df = fs_df[fs_df['Gene']==bed.gene_name]
 
         # find it frameshift actually is on gene annotation
-        fs_pos = []
-        for ix, row in gene_df.iterrows():
-            indel_pos = [row['Start_Position'], row['End_Position']]
-            coding_pos = bed.query_position(bed.strand, row['Chromosome'], indel_pos)
-            fs_pos.append(coding_pos)
+        pos_left = bed.query_positions(bed.strand, gene_df['Start_Position'].values)
+        pos_right = bed.query_positions(bed.strand, gene_df['End_Position'].values)
 
         # mark frameshifts that could not be mapped to reference tx
-        gene_df['unmapped'] = [(1 if x is None else 0) for x in fs_pos]
+        gene_df['unmapped'] = (np.isnan(pos_left) & np.isnan(pos_right)).astype(int)
         total_fs = len(gene_df)
         unmapped_fs = len(gene_df[gene_df['unmapped']==1])
 
@@ -91,7 +90,7 @@ def parse_arguments():
 
 def main(opts):
     # read in data
-    df = pd.read_csv(opts['mutations'], sep='\t')
+    df = mr.read_mutations(opts['mutations'])
     df['Start_Position'] = df['Start_Position'] - 1  # convert to 0-based coord
 
     # count frameshifts
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+""" This script parses a mutation (MAF) file once and saves it as a prepared
+mutation file, which probabilistic2020, mut_annotate and
+simulate_non_silent_ratio accept in place of the mutation file.
+
+If a cache directory is given together with the BED and gene FASTA files,
+the SNVs annotated for those genes are also cached, so runs with the same
+cache directory, files and options skip annotating them.
+"""
+# fix problems with pythons terrible import system
+import sys
+import os
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+sys.path.append(os.path.join(file_dir, '../../'))
+
+import prob2020.python.utils as utils
+import prob2020.python.mutation_reader as mr
+import prob2020.python.mutation_context as mc
+
+# actually important imports
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)  # module logger
+
+
+def parse_arguments():
+    info = 'Parses a mutation file into a prepared mutation file'
+    parser = argparse.ArgumentParser(description=info)
+
+    # logging arguments
+    parser.add_argument('-ll', '--log-level',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Write a log file (--log-level=DEBUG for debug mode, '
+                        '--log-level=INFO for info mode)')
+    parser.add_argument('-l', '--log',
+                        type=str,
+                        action='store',
+                        default='',
+                        help='Path to log file. (accepts stdout)')
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Flag for more verbose log output')
+
+    # program arguments
+    help_str = 'DNA mutations file (MAF file)'
+    parser.add_argument('-m', '--mutations',
+                        type=str, required=True,
+                        help=help_str)
+    help_str = 'Output prepared mutation file'
+    parser.add_argument('-o', '--output',
+                        type=str, required=True,
+                        help=help_str)
+    help_str = ('Directory to cache the annotated SNVs in. Requires the '
+                '--bed and --input options.')
+    parser.add_argument('--cache-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = 'BED file annotation of genes'
+    parser.add_argument('-b', '--bed',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = 'gene FASTA file from extract_gene_seq script'
+    parser.add_argument('-i', '--input',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = ('Number of DNA bases to use as context for the cached SNVs. '
+                '0 indicates no context. 1 indicates only use the mutated '
+                'base. 1.5 indicates using the base context used in CHASM. '
+                '2 indicates using the mutated base and the upstream base. '
+                '3 indicates using the mutated base and both the upstream '
+                'and downstream bases. (Default: 1.5)')
+    parser.add_argument('-c', '--context',
+                        type=float, default=1.5,
+                        help=help_str)
+    help_str = ('Only keep unique mutations for each tumor sample in the '
+                'cached SNVs.')
+    parser.add_argument('--unique',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
+    args = parser.parse_args()
+    if args.cache_dir and not (args.bed and args.input):
+        parser.error('--cache-dir requires the --bed and --input options')
+
+    # handle logging
+    if args.log_level or args.log:
+        if args.log:
+            log_file = args.log
+        else:
+            log_file = ''  # auto-name the log file
+    else:
+        log_file = os.devnull
+    log_level = args.log_level
+    utils.start_logging(log_file=log_file,
+                        log_level=log_level,
+                        verbose=args.verbose)  # start logging
+
+    # log user entered command
+    logger.info('Command: {0}'.format(' '.join(sys.argv)))
+
+    return vars(args)
+
+
+def main(opts):
+    mut_df = mr.read_mutations(opts['mutations'])
+    mr.write_prepared_mutations(mut_df, opts['output'], opts['mutations'])
+
+    # cache the SNVs annotated for the genes
+    if 'cache_dir' in opts and opts['cache_dir']:
+        mc.select_snvs(mut_df, opts, opts['unique'])
+
+
+def cli_main():
+    opts = parse_arguments()
+    main(opts)
+
+if __name__ == "__main__":
+    cli_main()
@@ -74,7 +74,8 @@ def parse_arguments():
                                   type=str, required=True,
                                   help=help_str)
         help_str = ('DNA mutations file (MAF file). Columns can be in any order, '
-                    'but should contain the correct column header names.')
+                    'but should contain the correct column header names. A prepared '
+                    'mutation file from prepare_mutations can also be used.')
         major_parser.add_argument('-m', '--mutations',
                                   type=str, required=True,
                                   help=help_str)
@@ -94,12 +95,46 @@ def parse_arguments():
         major_parser.add_argument('-n', '--num-iterations',
                                   type=int, default=100000,
                                   help=help_str)
+        help_str = ('Pass mutations to the worker processes through shared memory '
+                    'instead of copying them to each process (Default: False).')
+        advance_parser.add_argument('--shared-memory',
+                                    action='store_true',
+                                    default=False,
+                                    help=help_str)
+        help_str = ('Directory to cache sequence context indexes of genes and parsed '
+                    'mutation files, which are reused in later runs with the same '
+                    'gene FASTA and mutation files '
+                    '(Default: None).')
+        advance_parser.add_argument('--cache-dir',
+                                    type=str, default=None,
+                                    help=help_str)
+        help_str = ('Random number generation used for simulations. "randomstate" '
+                    'reproduces results of previous versions, while "generator" '
+                    'uses an independent stream for each gene and sequence context '
+                    '(Default: randomstate).')
+        advance_parser.add_argument('--random-backend',
+                                    type=str, default='randomstate',
+                                    choices=['randomstate', 'generator'],
+                                    help=help_str)
         help_str = ('Number of iterations more significant then the observed statistic '
                     'to stop further computations. This decreases compute time spent in resolving '
                     'p-values for non-significant genes. (Default: 1000).')
         advance_parser.add_argument('-sc', '--stop-criteria',
                                     type=int, default=1000,
                                     help=help_str)
+        help_str = ('Significance level for sequential stopping of the simulations. '
+                    'Simulations are performed in batches of growing size and stop once '
+                    'the confidence interval of the p-value is entirely above or below '
+                    'this level. The interval is reported in the output. '
+                    '(Default: None, do not use sequential stopping).')
+        advance_parser.add_argument('--sequential-threshold',
+                                    type=float, default=None,
+                                    help=help_str)
+        help_str = ('Confidence level of the p-value interval used for sequential '
+                    'stopping (Default: .99).')
+        advance_parser.add_argument('--sequential-confidence',
+                                    type=float, default=.99,
+                                    help=help_str)
         help_str = ('Number of DNA bases to use as context. 0 indicates no context. '
                     '1 indicates only use the mutated base.  1.5 indicates using '
                     'the base context used in CHASM '
@@ -111,7 +146,8 @@ def parse_arguments():
                                   type=float, default=1.5,
                                   help=help_str)
         if i == 0:
-            help_str = 'Directory containing VEST score information in pickle files (Default: None).'
+            help_str = ('Directory containing VEST score information in pickle files, '
+                        'or a score store file from convert_scores (Default: None).')
             major_parser.add_argument('-s', '--score-dir',
                                       type=str, default=None,
                                       help=help_str)
@@ -132,6 +168,12 @@ def parse_arguments():
             advance_parser.add_argument('-d', '--deleterious',
                                         type=int, default=1,
                                         help=help_str)
+            help_str = ('Compute the exact p-value instead of performing '
+                        'simulations (Default: False).')
+            advance_parser.add_argument('--exact',
+                                        action='store_true',
+                                        default=False,
+                                        help=help_str)
         elif i == 2:
             help_str = ('Sequence window size for HotMAPS 1D algorithm '
                         'by number of codons (Default: 3)')
@@ -147,7 +189,8 @@ def parse_arguments():
                                         type=str,
                                         help=help_str)
         elif i == 3:
-            help_str = 'Directory containing codon neighbor graph information in pickle files (Default: None).'
+            help_str = ('Directory containing codon neighbor graph information in pickle '
+                        'files, or a score store file from convert_scores (Default: None).')
             major_parser.add_argument('-ng', '--neighbor-graph-dir',
                                       type=str, required=True,
                                       help=help_str)
@@ -264,7 +307,7 @@ def main(opts,
         result_df['tmp vest p-value'] = result_df['vest p-value']
         result_df.loc[result_df['entropy p-value']==0, 'tmp entropy p-value'] = 1. / opts['num_iterations']
         result_df.loc[result_df['vest p-value']==0, 'tmp vest p-value'] = 1. / opts['num_iterations']
-        result_df['combined p-value'] = result_df[['tmp entropy p-value', 'tmp vest p-value']].apply(mypval.fishers_method, axis=1)
+        result_df['combined p-value'] = mypval.combine_p_values(result_df[['tmp entropy p-value', 'tmp vest p-value']])
         result_df['combined BH q-value'] = mypval.bh_fdr(result_df['combined p-value'])
         del result_df['tmp vest p-value']
         del result_df['tmp entropy p-value']
@@ -9,18 +9,20 @@ sys.path.append(os.path.join(file_dir, '../../'))
 # package imports
 import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
-from prob2020.python.sequence_context import SequenceContext
+from prob2020.python.sequence_context import SequenceContext, get_context_cache_dir, get_random_backend
 import prob2020.python.mutation_context as mc
 import prob2020.python.count_frameshifts as cf
 import prob2020.python.process_result as pr
 import prob2020.python.p_value as mypval
+import prob2020.python.permutation as pm
+import prob2020.python.scheduler as sched
+from prob2020.python.mutation_table import MutationTable
+import prob2020.python.mutation_reader as mr
 
 # external imports
 import argparse
 import pysam
-import pandas as pd
 import numpy as np
-from multiprocessing import Pool
 import logging
 
 logger = logging.getLogger(__name__)  # module logger
@@ -29,49 +31,55 @@ logger = logging.getLogger(__name__)  # module logger
 @utils.log_error_decorator
 def singleprocess_permutation(info):
     # initialize input
-    bed_list, mut_df, opts, fs_cts_df, p_inactivating = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
+    bed_list, mut_table, opts, fs_cts_df, p_inactivating = info
+    logger.info('Working on {0} genes ({1} . . .)'.format(len(bed_list),
+                                                         bed_list[0].gene_name))
     gene_fa = pysam.Fastafile(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    cache_dir = get_context_cache_dir(opts)
+    random_backend = get_random_backend(opts)
+    signif_level, conf_level = pm.get_sequential_opts(opts)
 
     # list of columns that are needed
     cols = ['Chromosome', 'Start_Position', 'Reference_Allele',
             'Tumor_Allele', 'Variant_Classification',]
     # conditionally add protein_change column if exists
-    if 'Protein_Change' in mut_df.columns:
+    if 'Protein_Change' in mut_table.columns:
         cols += ['Protein_Change']
-
-    # figure out which genes actually have a mutation
-    genes_with_mut = set(mut_df['Gene'].unique())
+    # SNVs from the annotated cache are already on the coding strand
+    is_annotated = 'Context' in mut_table.columns
+    if is_annotated:
+        cols += ['Coding Position', 'Context']
 
     # iterate through each gene
     result = []
     for bed in bed_list:
-        if bed.gene_name not in genes_with_mut:
+        if bed.gene_name not in mut_table:
             # skip genes with no mutations
             continue
 
         # prepare info for running permutation test
-        mut_info = mut_df.loc[mut_df['Gene']==bed.gene_name, cols]
+        mut_info = mut_table.gene_mutations(bed.gene_name).loc[:, cols]
         gs.set_gene(bed)
-        sc = SequenceContext(gs, seed=opts['seed'])
+        sc = SequenceContext(gs, seed=opts['seed'], cache_dir=cache_dir,
+                             random_backend=random_backend)
 
         # count total mutations in gene
         total_mut = len(mut_info)
 
-        # fix nucleotide letter if gene is on - strand
-        if bed.strand == '-':
-            rc = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
-            mut_info.loc[:, 'Tumor_Allele'] = rc
+        if is_annotated:
+            # count only the contexts of the gene's mutations
+            mut_info['Context'] = mut_info['Context'].astype(object)
+        else:
+            # fix nucleotide letter if gene is on - strand
+            if bed.strand == '-':
+                rc = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
+                mut_info.loc[:, 'Tumor_Allele'] = rc
 
-        # get coding positions, mutations unmapped to the reference tx will have
-        # NA for a coding position
-        pos_list = []
-        for ix, row in mut_info.iterrows():
-            coding_pos = bed.query_position(bed.strand, row['Chromosome'], row['Start_Position'])
-            pos_list.append(coding_pos)
-        mut_info.loc[:, 'Coding Position'] = pos_list
+            # get coding positions, mutations unmapped to the reference tx will have
+            # NA for a coding position
+            mut_info.loc[:, 'Coding Position'] = bed.query_positions(bed.strand,
+                                                                     mut_info['Start_Position'].values)
 
         # recover mutations that could not be mapped to the reference transcript
         # for a gene before being dropped (next step)
@@ -96,7 +104,9 @@ def singleprocess_permutation(info):
                                                       opts['stop_criteria'],
                                                       0,  # no recurrent mutation pseudo count
                                                       opts['recurrent'],
-                                                      opts['fraction'])
+                                                      opts['fraction'],
+                                                      signif_level=signif_level,
+                                                      conf_level=conf_level)
             result.append(tmp_result + [total_mut, unmapped_muts])
         elif opts['kind'] == 'tsg':
             # calculate results for deleterious mutation permutation test
@@ -110,7 +120,10 @@ def singleprocess_permutation(info):
                                                          opts['stop_criteria'],
                                                          opts['deleterious'],
                                                          0,  # no deleterious mutation pseudo count
-                                                         opts['seed'])
+                                                         opts['seed'],
+                                                         signif_level=signif_level,
+                                                         conf_level=conf_level,
+                                                         exact='exact' in opts and opts['exact'])
             result.append(tmp_result + [num_mapped_muts, unmapped_muts])
                                         #fs_ct, fs_unmapped])
         elif opts['kind'] == 'hotmaps1d':
@@ -128,7 +141,9 @@ def singleprocess_permutation(info):
                                                      opts['num_iterations'],
                                                      opts['stop_criteria'],
                                                      opts['report_index'],
-                                                     null_save_path=save_path)
+                                                     null_save_path=save_path,
+                                                     signif_level=signif_level,
+                                                     conf_level=conf_level)
             result.extend(tmp_result)
         elif opts['kind'] == 'protein':
             tmp_result = mypval.calc_protein_p_value(mut_info, unmapped_mut_info,
@@ -150,44 +165,33 @@ def singleprocess_permutation(info):
             result.append(tmp_result + [total_mut, unmapped_muts])
 
     gene_fa.close()
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
+    logger.info('Finished working on {0} genes ({1} . . .).'.format(len(bed_list),
+                                                                   bed_list[0].gene_name))
     return result
 
 
 def multiprocess_permutation(bed_dict, mut_df, opts,
                              fs_cts_df=None, p_inactivating=None):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into bundles of genes with similar estimated cost.
     """
-    chroms = sorted(bed_dict.keys(), key=lambda x: len(bed_dict[x]), reverse=True)
-    multiprocess_flag = opts['processes']>0
-    if multiprocess_flag:
-        num_processes = opts['processes']
-    else:
-        num_processes = 1
+    num_processes = opts['processes']
+    bundles = sched.gene_bundles(bed_dict, mut_df, opts['num_iterations'],
+                                 num_processes)
+    # mutations are passed to the worker processes in shared memory, if specified
+    use_shared = num_processes > 0 and 'shared_memory' in opts and opts['shared_memory']
+    mut_table = MutationTable(mut_df, shared=True) if use_shared else None
+    info_repeat = ((bundle, bundle_table, opts, fs_cts_df, p_inactivating)
+                   for bundle, bundle_table in zip(bundles,
+                                                   sched.bundle_mutations(mut_df, bundles, mut_table)))
     result_list = []
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts, fs_cts_df, p_inactivating)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                for chrom_result in process_results:
-                    result_list += chrom_result
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
-        else:
-            info = (bed_dict[chroms[i]], mut_df, opts, fs_cts_df, p_inactivating)
-            result_list += singleprocess_permutation(info)
-
+    try:
+        for bundle_result in sched.imap_bundles(singleprocess_permutation,
+                                                info_repeat, num_processes):
+            result_list += bundle_result
+    finally:
+        if mut_table is not None:
+            mut_table.unlink()
     return result_list
 
 
@@ -218,7 +222,7 @@ def parse_arguments():
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'DNA mutations file'
+    help_str = 'DNA mutations file, or a prepared mutation file'
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
@@ -226,11 +230,13 @@ def parse_arguments():
     parser.add_argument('-b', '--bed',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'Directory containing score information in pickle files (Default: None).'
+    help_str = ('Directory containing score information in pickle files, or a '
+                'score store file from convert_scores (Default: None).')
     parser.add_argument('-s', '--score-dir',
                         type=str, default=None,
                         help=help_str)
-    help_str = 'Directory containing neighbor graph information in pickle files (Default: None).'
+    help_str = ('Directory containing neighbor graph information in pickle files, '
+                'or a score store file from convert_scores (Default: None).')
     parser.add_argument('-ng', '--neighbor-graph-dir',
                         type=str, default=None,
                         help=help_str)
@@ -240,6 +246,27 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Pass mutations to the worker processes through shared memory '
+                'instead of copying them to each process (Default: False).')
+    parser.add_argument('--shared-memory',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
+    help_str = ('Directory to cache sequence context indexes of genes and parsed '
+                'mutation files, which are reused in later runs with the same '
+                'gene FASTA and mutation files '
+                '(Default: None).')
+    parser.add_argument('--cache-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = ('Random number generation used for simulations. "randomstate" '
+                'reproduces results of previous versions, while "generator" '
+                'uses an independent stream for each gene and sequence context '
+                '(Default: randomstate).')
+    parser.add_argument('--random-backend',
+                        type=str, default='randomstate',
+                        choices=['randomstate', 'generator'],
+                        help=help_str)
     help_str = ('Number of iterations for null model. p-value precision '
                 'increases with more iterations, however this will also '
                 'increase the run time (Default: 10000).')
@@ -252,6 +279,19 @@ def parse_arguments():
     parser.add_argument('-sc', '--stop-criteria',
                         type=int, default=1000,
                         help=help_str)
+    help_str = ('Significance level for sequential stopping of the simulations. '
+                'Simulations are performed in batches of growing size and stop once '
+                'the confidence interval of the p-value is entirely above or below '
+                'this level. The interval is reported in the output. '
+                '(Default: None, do not use sequential stopping).')
+    parser.add_argument('--sequential-threshold',
+                        type=float, default=None,
+                        help=help_str)
+    help_str = ('Confidence level of the p-value interval used for sequential '
+                'stopping (Default: .99).')
+    parser.add_argument('--sequential-confidence',
+                        type=float, default=.99,
+                        help=help_str)
     help_str = ('Kind of permutation test to perform ("oncogene" or "tsg"). "position-based" permutation '
                 'test is intended to find oncogenes using position based statistics. '
                 'The "deleterious" permutation test is intended to find tumor '
@@ -304,6 +344,12 @@ def parse_arguments():
     parser.add_argument('-d', '--deleterious',
                         type=int, default=1,
                         help=help_str)
+    help_str = ('Compute the exact p-value of the tsg test instead of '
+                'performing simulations (Default: False).')
+    parser.add_argument('--exact',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
     help_str = ('Maximum TSG score to allow gene to be tested for oncogene '
                 'permutation test. Values greater than one indicate all '
                 'genes will be tested (Default: 1.01).')
@@ -362,45 +408,36 @@ def main(opts, mut_df=None, frameshift_df=None):
     gene_fa.close()
 
     # Get Mutations
-    if mut_df is None:
-        mut_df = pd.read_csv(opts['mutations'], sep='\t')
-    orig_num_mut = len(mut_df)
-
-    # rename columns to fit my internal column names
-    rename_dict = {
-        'Hugo_Symbol': 'Gene',
-        'Tumor_Sample_Barcode': 'Tumor_Sample',
-        'Tumor_Seq_Allele2' : 'Tumor_Allele'
-    }
-    mut_df.rename(columns=rename_dict, inplace=True)
-
-    # drop rows with missing info
-    na_cols = ['Gene', 'Tumor_Allele', 'Start_Position', 'Chromosome']
-    mut_df = mut_df.dropna(subset=na_cols)
-    logger.info('Kept {0} mutations after droping mutations with missing '
-                'information (Droped: {1})'.format(len(mut_df), orig_num_mut - len(mut_df)))
+    use_cache = mut_df is None
+    if mut_df is not None:
+        # rename columns to fit my internal column names
+        mut_df = mut_df.rename(columns=mr.rename_dict)
+    elif opts['kind'] == 'tsg':
+        # frameshifts are counted from all mutations
+        cache_dir = opts['cache_dir'] if 'cache_dir' in opts else None
+        mut_df = mr.read_mutations(opts['mutations'], cache_dir=cache_dir)
 
     # count frameshifts
     if opts['kind'] == 'tsg':
+        # drop rows with missing info
+        na_cols = ['Gene', 'Tumor_Allele', 'Start_Position', 'Chromosome']
+        all_mut_df = mut_df.dropna(subset=na_cols)
         if frameshift_df is None:
-            # read in mutations
-            if mut_df is None:
-                mut_df = pd.read_csv(opts['mutations'], sep='\t')
-
             # count number of frameshifts
-            frameshift_df = cf.count_frameshift_total(mut_df, opts['bed'],
+            frameshift_df = cf.count_frameshift_total(all_mut_df, opts['bed'],
                                                       opts['use_unmapped'])
 
         # calculate the proportion of inactivating
         #num_inact = len(mut_df[mut_df['Variant_Classification'].isin(utils.variant_inactivating)])
         #num_non_inact = len(mut_df[mut_df['Variant_Classification'].isin(utils.variant_non_inactivating)])
-        num_fs = len(mut_df[mut_df['Variant_Classification'].isin(utils.variant_frameshift)])
-        num_all = len(mut_df[mut_df['Variant_Classification'].isin(utils.all_variants)])
+        num_fs = len(all_mut_df[all_mut_df['Variant_Classification'].isin(utils.variant_frameshift)])
+        num_all = len(all_mut_df[all_mut_df['Variant_Classification'].isin(utils.all_variants)])
         #p_inactivating = float(num_inact) / (num_inact + num_non_inact)
         p_inactivating = float(num_fs) / num_all
 
-    # select valid single nucleotide variants only
-    mut_df = utils._fix_mutation_df(mut_df, opts['unique'])
+    # select valid single nucleotide variants only, which are only read from
+    # the mutation file if they are not cached
+    mut_df = mc.select_snvs(mut_df, opts, opts['unique'], use_cache=use_cache)
 
     # log random number seed choice if provided
     if opts['seed'] is not None:
@@ -410,18 +447,22 @@ def main(opts, mut_df=None, frameshift_df=None):
     bed_dict = utils.read_bed(opts['bed'])
 
     # Perform BH p-value adjustment and tidy up data for output
+    sequential = pm.get_sequential_opts(opts)[0] is not None
     if opts['kind'] == 'oncogene':
         permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
         permutation_df = pr.handle_oncogene_results(permutation_result,
-                                                    opts['num_iterations'])
+                                                    opts['num_iterations'],
+                                                    sequential=sequential)
     elif opts['kind'] == 'tsg':
         permutation_result = multiprocess_permutation(bed_dict, mut_df, opts,
                                                       frameshift_df, p_inactivating)
-        permutation_df = pr.handle_tsg_results(permutation_result)
+        permutation_df = pr.handle_tsg_results(permutation_result,
+                                               sequential=sequential)
     elif opts['kind'] == 'hotmaps1d':
         permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
                                                       #frameshift_df, p_inactivating)
-        permutation_df = pr.handle_hotmaps_results(permutation_result)
+        permutation_df = pr.handle_hotmaps_results(permutation_result,
+                                                   sequential=sequential)
     elif opts['kind'] == 'protein':
         permutation_result = multiprocess_permutation(bed_dict, mut_df, opts)
         permutation_df = pr.handle_protein_results(permutation_result)
@@ -12,12 +12,15 @@ import prob2020.python.utils as utils
 from prob2020.python.gene_sequence import GeneSequence
 import prob2020.cython.cutils as cutils
 import prob2020.python.mutation_context as mc
+import prob2020.python.scores as scores
+import prob2020.python.scheduler as sched
+from prob2020.python.mutation_table import MutationTable
+import prob2020.python.mymath as mymath
 
 # external imports
 import numpy as np
 import pandas as pd
 import pysam
-from multiprocessing import Pool
 import argparse
 import logging
 import copy
@@ -29,17 +32,70 @@ cols = ['non-silent count', 'silent count', 'nonsense count',
         'lost stop count', 'splice site count', 'lost start count',
         'missense count']
 
+def analytic_null(effect_frac, conf_level=.95):
+    """Calculates the null distribution of the mutation counts without
+    performing simulations.
+
+    Each count is a sum of independent Bernoulli outcomes, one for each
+    mutation (see permutation.effect_fractions), so its exact distribution
+    is a Poisson binomial distribution. The bounds of the non-silent to
+    silent ratio are those of the silent count, with the non-silent count
+    being the remaining mutations, less the expected number of mutations
+    whose effect can not be determined.
+
+    Parameters
+    ----------
+    effect_frac : np.array
+        num mutations X len(utils.variant_snv) array of the probability of
+        each variant classification
+    conf_level : float, default: .95
+        probability of the null distribution between the lower and upper
+        bounds
+
+    Returns
+    -------
+    null_df : pd.DataFrame
+        mean, standard deviation, and lower and upper bounds of each
+        mutation count and of the non-silent to silent ratio
+    """
+    count_cols = cols[:7]
+    var_class = ['Silent', 'Nonsense_Mutation', 'Nonstop_Mutation',
+                 'Splice_Site', 'Translation_Start_Site', 'Missense_Mutation']
+    probs = effect_frac[:, [utils.effect_code[v] for v in var_class]]
+    probs = np.column_stack([probs[:, 1:].sum(axis=1), probs])
+
+    alpha = 1 - conf_level
+    null_df = pd.DataFrame(index=count_cols + ['non-silent/silent ratio'],
+                           columns=['mean', 'std', 'lower', 'upper'], dtype=float)
+    for col, p in zip(count_cols, probs.T):
+        cdf = np.cumsum(mymath.poisson_binomial_pmf(p))
+        lower, upper = np.minimum(np.searchsorted(cdf, [alpha/2, 1-alpha/2]), len(cdf)-1)
+        null_df.loc[col] = [p.sum(), np.sqrt(np.sum(p*(1-p))), lower, upper]
+
+    # ratio of the expected counts, with delta method standard deviation
+    mean_ns, mean_s = null_df.loc[count_cols[0], 'mean'], null_df.loc[count_cols[1], 'mean']
+    var_ns, var_s = null_df.loc[count_cols[:2], 'std']**2
+    cov = -np.sum(probs[:, 0] * probs[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = mean_ns / mean_s
+        ratio_std = np.abs(ratio) * np.sqrt(var_ns/mean_ns**2 + var_s/mean_s**2
+                                            - 2*cov/(mean_ns*mean_s))
+        num_known = len(effect_frac) - np.sum(1 - probs[:, :2].sum(axis=1))
+        silent_lower, silent_upper = null_df.loc[count_cols[1], ['lower', 'upper']]
+        null_df.loc['non-silent/silent ratio'] = [ratio, ratio_std,
+                                                  (num_known - silent_upper) / silent_upper,
+                                                  (num_known - silent_lower) / silent_lower]
+    null_df.index.name = 'statistic'
+    return null_df.reset_index()
+
+
 def multiprocess_permutation(bed_dict, mut_df, opts):
     """Handles parallelization of permutations by splitting work
-    by chromosome.
+    into bundles of genes with similar estimated cost.
     """
-    chroms = sorted(bed_dict.keys())
-    multiprocess_flag = opts['processes']>0
-    if multiprocess_flag:
-        num_processes = opts['processes']
-    else:
-        num_processes = 1
+    num_processes = opts['processes']
     num_permutations = opts['num_permutations']
+    analytic = 'analytic' in opts and opts['analytic']
     if not opts['by_sample']:
         obs_result = []
     else:
@@ -47,76 +103,78 @@ def multiprocess_permutation(bed_dict, mut_df, opts):
         obs_result = pd.DataFrame(np.zeros((len(uniq_samp), len(cols))),
                                   index=uniq_samp, columns=cols)
 
-    # initialize list containing output
-    if not opts['score_dir']:
-        result_list = [[0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
-    else:
-        result_list = [[0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
-
-    # iterate over each chromosome
-    for i in range(0, len(chroms), num_processes):
-        if multiprocess_flag:
-            pool = Pool(processes=num_processes)
-            tmp_num_proc = len(chroms) - i if i + num_processes > len(chroms) else num_processes
-            info_repeat = ((bed_dict[chroms[tmp_ix]], mut_df, opts)
-                            for tmp_ix in range(i, i+tmp_num_proc))
-            process_results = pool.imap(singleprocess_permutation, info_repeat)
-            process_results.next = utils.keyboard_exit_wrapper(process_results.next)
-            try:
-                for chrom_result, obs_mutations in process_results:
-                    for j in range(num_permutations):
-                        result_list[j][0] += chrom_result[j][0]
-                        result_list[j][1] += chrom_result[j][1]
-                        result_list[j][2] += chrom_result[j][2]
-                        result_list[j][3] += chrom_result[j][3]
-                        result_list[j][4] += chrom_result[j][4]
-                        result_list[j][5] += chrom_result[j][5]
-                        result_list[j][6] += chrom_result[j][6]
-                        if opts['score_dir']:
-                            result_list[j][7] += chrom_result[j][7]
-                            result_list[j][8] += chrom_result[j][8]
-
-                    if not opts['by_sample']:
-                        obs_result.append(obs_mutations)
-                    else:
-                        obs_result = obs_result + obs_mutations
-            except KeyboardInterrupt:
-                pool.close()
-                pool.join()
-                logger.info('Exited by user. ctrl-c')
-                sys.exit(0)
-            pool.close()
-            pool.join()
-        else:
-            info = (bed_dict[chroms[i]], mut_df, opts)
-            chrom_result, obs_mutations = singleprocess_permutation(info)
-            for j in range(num_permutations):
-                result_list[j][0] += chrom_result[j][0]
-                result_list[j][1] += chrom_result[j][1]
-                result_list[j][2] += chrom_result[j][2]
-                result_list[j][3] += chrom_result[j][3]
-                result_list[j][4] += chrom_result[j][4]
-                result_list[j][5] += chrom_result[j][5]
-                result_list[j][6] += chrom_result[j][6]
-                if opts['score_dir']:
-                    result_list[j][7] += chrom_result[j][7]
-                    result_list[j][8] += chrom_result[j][8]
+    # initialize arrays containing output
+    result_cts = np.zeros((num_permutations, 7), dtype=int)
+    result_scores = np.zeros((num_permutations, 2))
+    effect_frac, samples = [], []
+
+    # iterate over each bundle of genes
+    bundles = sched.gene_bundles(bed_dict, mut_df, num_permutations,
+                                 num_processes)
+    # mutations are passed to the worker processes in shared memory, if specified
+    use_shared = num_processes > 0 and 'shared_memory' in opts and opts['shared_memory']
+    mut_table = MutationTable(mut_df, shared=True) if use_shared else None
+    info_repeat = ((bundle, bundle_table, opts)
+                   for bundle, bundle_table in zip(bundles,
+                                                   sched.bundle_mutations(mut_df, bundles, mut_table)))
+    bundle_results = sched.imap_bundles(singleprocess_permutation,
+                                        info_repeat, num_processes)
+    try:
+        for null_result, obs_mutations in bundle_results:
+            if analytic:
+                effect_frac.append(null_result[0])
+                samples.append(null_result[1])
+            else:
+                result_cts += null_result[0]
+                result_scores += null_result[1]
+
             if not opts['by_sample']:
                 obs_result.append(obs_mutations)
             else:
-                obs_result = obs_result + obs_mutations
-
+                # only the tumor samples of the bundle are counted
+                obs_result = obs_result.add(obs_mutations, fill_value=0).loc[obs_result.index]
+    finally:
+        if mut_table is not None:
+            mut_table.unlink()
+
+    # compute the null distribution of counts from the effect probabilities
+    if analytic:
+        effect_frac = np.vstack(effect_frac)
+        samples = np.concatenate(samples)
+        conf_level = opts['confidence_level'] if 'confidence_level' in opts else .95
+        if not opts['by_sample']:
+            null_df = analytic_null(effect_frac, conf_level)
+        else:
+            # group the mutations of each sample once
+            samp_ix = obs_result.index.get_indexer(samples)
+            order = np.argsort(samp_ix, kind='stable')
+            bounds = np.searchsorted(samp_ix[order], np.arange(len(obs_result.index)+1))
+            effect_frac = effect_frac[order]
+            null_df = pd.concat([analytic_null(effect_frac[bounds[i]:bounds[i+1]], conf_level)
+                                 for i in range(len(obs_result.index))],
+                                keys=obs_result.index, names=['Tumor_Sample', None])
+            null_df = null_df.reset_index(level=0).reset_index(drop=True)
+        return null_df, obs_result
+
+    # combine counts and scores, keeping counts as integers
+    if opts['score_dir']:
+        result_list = [cts + sc for cts, sc in zip(result_cts.tolist(),
+                                                   result_scores.tolist())]
+    else:
+        result_list = result_cts.tolist()
     return result_list, obs_result
 
 
 @utils.log_error_decorator
 def singleprocess_permutation(info):
-    bed_list, mut_df, opts = info
-    current_chrom = bed_list[0].chrom
-    logger.info('Working on chromosome: {0} . . .'.format(current_chrom))
+    bed_list, mut_table, opts = info
+    logger.info('Working on {0} genes ({1} . . .)'.format(len(bed_list),
+                                                         bed_list[0].gene_name))
     num_permutations = opts['num_permutations']
+    analytic = 'analytic' in opts and opts['analytic']
     gene_fa = pysam.Fastafile(opts['input'])
     gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    score_provider = scores.get_score_provider(opts['score_dir']) if opts['score_dir'] else None
 
     # variables for recording the actual observed number of non-silent
     # vs. silent mutations
@@ -131,18 +189,18 @@ def singleprocess_permutation(info):
         obs_vest = 0
         obs_mga_entropy = 0
     else:
-        uniq_samp = mut_df['Tumor_Sample'].unique()
+        uniq_samp = mut_table.unique('Tumor_Sample')
         obs_df = pd.DataFrame(np.zeros((len(uniq_samp), len(cols))),
                               index=uniq_samp, columns=cols)
 
     # go through each gene to permform simulation
-    if opts['score_dir']:
-        result = [[0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
-    else:
-        result = [[0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
+    sim_cts = np.zeros((num_permutations, 7), dtype=int)
+    sim_scores = np.zeros((num_permutations, 2))
+    effect_frac, samples = [], []
     for bed in bed_list:
         # compute context counts and somatic bases for each context
-        gene_tuple = mc.compute_mutation_context(bed, gs, mut_df, opts)
+        gene_mut_df = mut_table.gene_mutations(bed.gene_name)
+        gene_tuple = mc.compute_mutation_context(bed, gs, gene_mut_df, opts)
         context_cts, context_to_mutations, mutations_df, gs, sc = gene_tuple
 
         if context_to_mutations:
@@ -162,7 +220,7 @@ def singleprocess_permutation(info):
                                                       tmp_mut_info['Somatic AA'],
                                                       tmp_mut_info['Codon Pos'],
                                                       bed.gene_name,
-                                                      opts['score_dir'],
+                                                      score_provider,
                                                       #min_frac=opts['fraction'],
                                                       min_frac=0.0,
                                                       #min_recur=opts['recurrent']
@@ -192,18 +250,28 @@ def singleprocess_permutation(info):
                                                           somatic_aa,
                                                           codon_pos,
                                                           bed.gene_name,
-                                                          opts['score_dir'],
+                                                          score_provider,
                                                           min_frac=0.0,
                                                           min_recur=3)
                     if opts['score_dir']:
                         tmp_result.pop(-4)
                         tmp_result.pop(-4)
                         tmp_result.pop(-1)
+                    else:
+                        # only keep the mutation counts
+                        tmp_result = tmp_result[:7]
                     # update df
                     #obs_df.loc[tsamp,:] = obs_df.loc[tsamp,:] + np.array(tmp_non_silent)
                     obs_df.loc[tsamp,:] = obs_df.loc[tsamp,:] + np.array(tmp_result)
 
             ## Do permutations
+            if analytic:
+                # probabilities of each effect replace the simulations
+                effect_frac.append(pm.effect_fractions(mutations_df['Context'].tolist(),
+                                                       mutations_df['Tumor_Allele'].tolist(),
+                                                       sc, gs))
+                samples.append(mutations_df['Tumor_Sample'].values)
+                continue
             # calculate non silent count
             #tmp_result = pm.non_silent_ratio_permutation(context_cts,
                                                          #context_to_mutations,
@@ -214,27 +282,13 @@ def singleprocess_permutation(info):
                                                 context_to_mutations,
                                                 sc,  # sequence context obj
                                                 gs,  # gene sequence obj
-                                                opts['score_dir'],
+                                                score_provider,
                                                 num_permutations)
-        else:
-            if opts['score_dir']:
-                tmp_result = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
-            else:
-                tmp_result = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0] for k in range(num_permutations)]
-
-        # increment the non-silent/silent counts for each permutation
-        offset = 3
-        for j in range(num_permutations):
-            result[j][0] += tmp_result[j][0+offset]
-            result[j][1] += tmp_result[j][1+offset]
-            result[j][2] += tmp_result[j][2+offset]
-            result[j][3] += tmp_result[j][3+offset]
-            result[j][4] += tmp_result[j][4+offset]
-            result[j][5] += tmp_result[j][5+offset]
-            result[j][6] += tmp_result[j][6+offset]
+
+            # increment the non-silent/silent counts for each permutation
+            sim_cts += tmp_result[:, :7].astype(int)
             if opts['score_dir']:
-                result[j][7] += tmp_result[j][9+offset]
-                result[j][8] += tmp_result[j][10+offset]
+                sim_scores += tmp_result[:, 9:11]
 
     gene_fa.close()
     if not opts['by_sample']:
@@ -244,8 +298,14 @@ def singleprocess_permutation(info):
             obs_result.extend([obs_mga_entropy, obs_vest])
     else:
         obs_result = obs_df
-    logger.info('Finished working on chromosome: {0}.'.format(current_chrom))
-    return result, obs_result
+    logger.info('Finished working on {0} genes ({1} . . .).'.format(len(bed_list),
+                                                                   bed_list[0].gene_name))
+    if analytic:
+        num_effects = len(utils.variant_snv)
+        effect_frac = np.vstack(effect_frac) if effect_frac else np.zeros((0, num_effects))
+        samples = np.concatenate(samples) if samples else np.array([], dtype=object)
+        return (effect_frac, samples), obs_result
+    return (sim_cts, sim_scores), obs_result
 
 
 def parse_arguments():
@@ -271,7 +331,7 @@ def parse_arguments():
     parser.add_argument('-i', '--input',
                         type=str, required=True,
                         help=help_str)
-    help_str = 'DNA mutations file'
+    help_str = 'DNA mutations file, or a prepared mutation file'
     parser.add_argument('-m', '--mutations',
                         type=str, required=True,
                         help=help_str)
@@ -285,6 +345,27 @@ def parse_arguments():
     parser.add_argument('-p', '--processes',
                         type=int, default=0,
                         help=help_str)
+    help_str = ('Pass mutations to the worker processes through shared memory '
+                'instead of copying them to each process (Default: False).')
+    parser.add_argument('--shared-memory',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
+    help_str = ('Directory to cache sequence context indexes of genes and parsed '
+                'mutation files, which are reused in later runs with the same '
+                'gene FASTA and mutation files '
+                '(Default: None).')
+    parser.add_argument('--cache-dir',
+                        type=str, default=None,
+                        help=help_str)
+    help_str = ('Random number generation used for simulations. "randomstate" '
+                'reproduces results of previous versions, while "generator" '
+                'uses an independent stream for each gene and sequence context '
+                '(Default: randomstate).')
+    parser.add_argument('--random-backend',
+                        type=str, default='randomstate',
+                        choices=['randomstate', 'generator'],
+                        help=help_str)
     help_str = ('Number of permutations for null model. p-value precision '
                 'increases with more permutations (Default: 10000).')
     parser.add_argument('-n', '--num-permutations',
@@ -300,7 +381,8 @@ def parse_arguments():
     parser.add_argument('-c', '--context',
                         type=float, default=1.5,
                         help=help_str)
-    help_str = 'Directory containing score information in pickle files (Default: None).'
+    help_str = ('Directory containing score information in pickle files, or a '
+                'score store file from convert_scores (Default: None).')
     parser.add_argument('-s', '--score-dir',
                         type=str, default=None,
                         help=help_str)
@@ -308,6 +390,20 @@ def parse_arguments():
     parser.add_argument('-bs', '--by-sample',
                         action='store_true',
                         help=help_str)
+    help_str = ('Compute the null distribution of the mutation counts exactly '
+                'instead of performing simulations. The output then contains '
+                'the mean, standard deviation and bounds of each count and '
+                'of the non-silent to silent ratio, for each tumor sample if '
+                '--by-sample is set. Scores are not reported (Default: False).')
+    parser.add_argument('--analytic',
+                        action='store_true',
+                        default=False,
+                        help=help_str)
+    help_str = ('Probability of the null distribution between the lower and '
+                'upper bounds reported by --analytic (Default: .95).')
+    parser.add_argument('--confidence-level',
+                        type=float, default=.95,
+                        help=help_str)
     help_str = ('Use mutations that are not mapped to the the single reference '
                 'transcript for a gene specified in the bed file indicated by '
                 'the -b option.')
@@ -362,15 +458,9 @@ def main(opts):
     gene_fa = pysam.Fastafile(opts['input'])
     gene_fa.close()
 
-    # Get Mutations
-    mut_df = pd.read_csv(opts['mutations'], sep='\t')
-    orig_num_mut = len(mut_df)
-    mut_df = mut_df.dropna(subset=['Tumor_Allele', 'Start_Position', 'Chromosome'])
-    logger.info('Kept {0} mutations after droping mutations with missing '
-                'information (Droped: {1})'.format(len(mut_df), orig_num_mut - len(mut_df)))
-
-    # select valid single nucleotide variants only
-    mut_df = utils._fix_mutation_df(mut_df)
+    # Get valid single nucleotide variants, which are only read from the
+    # mutation file if they are not cached
+    mut_df = mc.select_snvs(None, opts)
 
     # read in bed info
     bed_dict = utils.read_bed(opts['bed'])
@@ -409,8 +499,11 @@ def main(opts):
     #sim_result = permutation_result[0]
 
     # convert to dataframe to save to file
-    non_silent_ratio_df = pd.DataFrame(sim_result,
-                                       columns=cols)
+    if 'analytic' in opts and opts['analytic']:
+        non_silent_ratio_df = sim_result
+    else:
+        non_silent_ratio_df = pd.DataFrame(sim_result,
+                                           columns=cols)
     # save simulation output
     non_silent_ratio_df.to_csv(opts['output'], sep='\t', index=False)
 
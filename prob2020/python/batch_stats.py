@@ -0,0 +1,344 @@
+"""Array-based versions of the mutation statistics found in cutils.
+
+Each function takes num simulations X num mutations arrays of integer
+codes (see mutation_context.get_aa_mut_info_batch) and computes the
+statistic for every simulation in the batch at once.
+"""
+import prob2020.python.utils as utils
+import prob2020.python.scores as scores
+import numpy as np
+
+
+def is_deleterious(effect):
+    """Finds which mutations are deleterious.
+
+    Follows the same definition as cutils.calc_deleterious_info.
+
+    Parameters
+    ----------
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+
+    Returns
+    -------
+    deleterious : np.array
+        boolean array of the same shape as effect
+    """
+    deleterious_codes = [utils.effect_code[v]
+                         for v in ['Nonsense_Mutation', 'Nonstop_Mutation',
+                                   'Splice_Site', 'Translation_Start_Site']]
+    return np.isin(effect, deleterious_codes)
+
+
+def calc_deleterious_info(effect):
+    """Counts the number of deleterious mutations in each simulation.
+
+    Follows the same definition as cutils.calc_deleterious_info.
+
+    Parameters
+    ----------
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+
+    Returns
+    -------
+    num_deleterious : np.array
+        number of deleterious mutations for each simulation (row)
+    """
+    num_deleterious = is_deleterious(effect).sum(axis=1)
+    return num_deleterious
+
+
+def calc_non_silent_info(effect):
+    """Counts the number of mutations for each variant classification.
+
+    Follows the same definition as cutils.calc_non_silent_info.
+
+    Parameters
+    ----------
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+
+    Returns
+    -------
+    non_silent_info : np.array
+        num simulations X 7 array with the number of non-silent, silent,
+        nonsense, lost stop, splice site, lost start, and missense mutations
+    """
+    var_class = ['Silent', 'Nonsense_Mutation', 'Nonstop_Mutation',
+                 'Splice_Site', 'Translation_Start_Site', 'Missense_Mutation']
+    counts = np.column_stack([(effect == utils.effect_code[v]).sum(axis=1)
+                              for v in var_class])
+    num_non_silent = counts[:, 1:].sum(axis=1)
+    non_silent_info = np.column_stack([num_non_silent, counts])
+    return non_silent_info
+
+
+def _count_missense_runs(codon_pos, effect):
+    """Counts the missense mutations at each mutated codon of each simulation.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        codon positions (-1 for splice sites)
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+
+    Returns
+    -------
+    run_sim : np.array
+        simulation (row) of each mutated codon, in order of codon position
+        within a simulation
+    run_ct : np.array
+        number of missense mutations at each mutated codon (as floats)
+    num_missense : np.array
+        number of missense mutations in each simulation
+    """
+    num_mut = codon_pos.shape[1]
+
+    # lost start mutations are counted as missense like in cutils
+    is_missense = np.isin(effect, [utils.effect_code['Missense_Mutation'],
+                                   utils.effect_code['Translation_Start_Site']])
+    not_missense = np.iinfo(np.int64).max
+    sorted_pos = np.where(is_missense, codon_pos, not_missense).astype(np.int64)
+    sorted_pos.sort(axis=1)
+
+    # find runs of mutations at the same codon
+    is_new = np.ones(sorted_pos.shape, dtype=bool)
+    is_new[:, 1:] = sorted_pos[:, 1:] != sorted_pos[:, :-1]
+    is_last = np.ones(sorted_pos.shape, dtype=bool)
+    is_last[:, :-1] = is_new[:, 1:]
+    is_valid = sorted_pos != not_missense
+    run_start = np.flatnonzero(is_new & is_valid)
+    run_end = np.flatnonzero(is_last & is_valid)
+    run_sim = run_start // max(num_mut, 1)
+    run_ct = (run_end - run_start + 1).astype(float)
+    return run_sim, run_ct, is_missense.sum(axis=1)
+
+
+def calc_pos_info(codon_pos, effect,
+                  pseudo_count=0,
+                  min_frac=0.0,
+                  min_recur=2,
+                  is_obs=1):
+    """Calculates the missense position statistics for each simulation.
+
+    Follows the same definitions as cutils.calc_pos_info, but the
+    mutations per codon are counted by sorting the positions of every
+    simulation rather than filling a map for each simulation.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        codon positions (-1 for splice sites)
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+    pseudo_count : int, default: 0
+        number of mutations at an extra dummy position
+    min_frac : float, default: 0.0
+        fraction of total mutations to be recurrent position
+    min_recur : int, default: 2
+        minimum number of missense at same position to be defined as recurrent
+    is_obs : int, default: 1
+        flag indicating whether the statistics are for observed data, which
+        uses min_frac/min_recur to define recurrent positions
+
+    Returns
+    -------
+    num_recur : np.array
+        number of recurrent missense mutations for each simulation
+    frac_pos_ent : np.array
+        missense position entropy as a fraction of the maximum entropy
+    delta_pos_ent : np.array
+        difference between the uniform and the observed position entropy
+    """
+    num_sim = codon_pos.shape[0]
+    run_sim, run_ct, num_missense = _count_missense_runs(codon_pos, effect)
+
+    # add pseudo-counts as a separate position
+    if pseudo_count:
+        run_sim = np.concatenate([run_sim, np.arange(num_sim)])
+        run_ct = np.concatenate([run_ct, np.full(num_sim, float(pseudo_count))])
+
+    # total number of mutations, including pseudo-counts
+    mysum = num_missense + pseudo_count
+    run_sum = mysum[run_sim].astype(float)
+
+    # recurrent positions are defined either by the minimum or by a fraction
+    # of the total missense mutations
+    if is_obs == 1:
+        min_frac_thresh = (mysum*min_frac + .99).astype(int)
+        min_recurrent = np.maximum(min_recur, min_frac_thresh)[run_sim]
+        is_recur = run_ct >= min_recurrent
+    else:
+        is_recur = run_ct >= 2
+    num_recur = np.bincount(run_sim, weights=run_ct*is_recur,
+                            minlength=num_sim).astype(int)
+
+    # non-recurrent positions in observed data are treated as distinct positions
+    # each with a single mutation
+    is_spread = ~is_recur if is_obs == 1 else np.zeros(len(run_ct), dtype=bool)
+    p = np.where(is_spread, 1, run_ct) / run_sum
+    run_weight = np.where(is_spread, run_ct, 1)
+    ent_2 = np.bincount(run_sim, weights=-run_weight*p*np.log2(p), minlength=num_sim)
+    ent_e = np.bincount(run_sim, weights=-run_weight*p*np.log(p), minlength=num_sim)
+    num_pos = np.bincount(run_sim, weights=run_weight, minlength=num_sim)
+
+    # normalize the entropy metrics
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac_pos_ent = np.where(mysum > 1, ent_2 / np.log2(mysum), 1.0)
+        delta_pos_ent = np.where(num_pos > 1, np.log(num_pos) - ent_e, 0.0)
+    return num_recur, frac_pos_ent, delta_pos_ent
+
+
+def calc_pos_count_entropy(codon_pos, effect):
+    """Sums c*log2(c) over the number of missense mutations, c, at each
+    mutated codon of each simulation.
+
+    The sum is what the missense position counts contribute to the
+    normalized mutation entropy (see mymath.normalized_mutation_entropy),
+    so the mutation entropy can be computed without keeping the counts.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        codon positions (-1 for splice sites)
+    effect : np.array
+        variant classification codes (see utils.effect_code)
+
+    Returns
+    -------
+    pos_ct_ent : np.array
+        sum of c*log2(c) over the mutated codons of each simulation
+    """
+    num_sim = codon_pos.shape[0]
+    run_sim, run_ct, num_missense = _count_missense_runs(codon_pos, effect)
+    pos_ct_ent = np.bincount(run_sim, weights=run_ct*np.log2(run_ct),
+                             minlength=num_sim)
+    return pos_ct_ent
+
+
+def calc_summary_info(aa_info, gene_name, score_dir,
+                      min_frac=0.0,
+                      min_recur=2):
+    """Calculates the summary features of each simulation.
+
+    Follows the same definitions as cutils.calc_summary_info, except that
+    the map of missense position counts at the end is replaced by the sum
+    of c*log2(c) over those counts (see calc_pos_count_entropy).
+
+    Parameters
+    ----------
+    aa_info : dict
+        num simulations X num mutations arrays from
+        mutation_context.get_aa_mut_info_batch
+    gene_name : str
+        name of gene, used to fetch score information
+    score_dir : str, ScoreProvider or None
+        directory containing score information
+    min_frac : float, default: 0.0
+        fraction of total mutations to be recurrent position
+    min_recur : int, default: 2
+        minimum number of missense at same position to be defined as recurrent
+
+    Returns
+    -------
+    summary_info : np.array
+        num simulations X features array. The columns are the number of
+        non-silent, silent, nonsense, lost stop, splice site, lost start,
+        missense and recurrent missense mutations, the missense position
+        entropy, the total MGA entropy and VEST scores (only if score_dir
+        is given), and the sum of c*log2(c) over missense position counts.
+    """
+    codon_pos, effect = aa_info['Codon Pos'], aa_info['Effect']
+    non_silent_info = calc_non_silent_info(effect)
+    num_recur, pos_ent, delta_pos_ent = calc_pos_info(codon_pos, effect,
+                                                      min_frac=min_frac,
+                                                      min_recur=min_recur)
+    summary_info = [non_silent_info, num_recur, pos_ent]
+
+    # add score information if user specified a directory
+    if score_dir:
+        total_mga_ent, total_vest = scores.retrieve_scores_batch(gene_name, score_dir,
+                                                                 codon_pos,
+                                                                 aa_info['Reference AA'],
+                                                                 aa_info['Somatic AA'])
+        summary_info += [total_mga_ent, total_vest]
+    summary_info.append(calc_pos_count_entropy(codon_pos, effect))
+    return np.column_stack(summary_info).astype(float)
+
+
+def calc_missense_mask(ref_aa, somatic_aa):
+    """Flags missense mutations by their amino acid codes.
+
+    Follows the definition of a missense mutation used by
+    cutils.calc_pos_info and utils.calc_windowed_sum, i.e. both residues are
+    known, neither is a stop codon and they differ.
+
+    Parameters
+    ----------
+    ref_aa : np.array
+        reference amino acid codes (see utils.aa_code)
+    somatic_aa : np.array
+        somatic amino acid codes (see utils.aa_code)
+
+    Returns
+    -------
+    is_missense : np.array
+        flag for each mutation indicating whether it is missense
+    """
+    is_missense = ((ref_aa != utils.missing_aa_code) &
+                   (somatic_aa != utils.missing_aa_code) &
+                   (ref_aa != utils.stop_code) &
+                   (somatic_aa != utils.stop_code) &
+                   (ref_aa != utils.splice_code) &
+                   (ref_aa != somatic_aa))
+    return is_missense
+
+
+def calc_windowed_sum(codon_pos, ref_aa, somatic_aa, window=[3]):
+    """Calculates the number of missense mutations within a window around
+    each mutated codon for each simulation.
+
+    Follows the same definition as utils.calc_windowed_sum. The codon
+    positions of each simulation are offset so that windows never span two
+    simulations, which allows the window counts of the whole batch to be
+    found with a binary search in a single sorted array.
+
+    Parameters
+    ----------
+    codon_pos : np.array
+        codon positions (-1 for splice sites)
+    ref_aa : np.array
+        reference amino acid codes (see utils.aa_code)
+    somatic_aa : np.array
+        somatic amino acid codes (see utils.aa_code)
+    window : list, default: [3]
+        window sizes to calculate the sum for
+
+    Returns
+    -------
+    pos_sim : np.array
+        simulation (row) of each mutated codon
+    pos_ct : np.array
+        number of missense mutations at each mutated codon
+    pos_sum : dict
+        maps window size to an array with the number of missense mutations
+        within the window around each mutated codon
+    """
+    num_sim, num_mut = codon_pos.shape
+    is_missense = calc_missense_mask(ref_aa, somatic_aa)
+
+    # place each simulation in a separate range of positions
+    max_window = max(window)
+    offset = int(codon_pos.max(initial=0)) + 2*max_window + 1
+    sim_ix = np.repeat(np.arange(num_sim, dtype=np.int64), num_mut).reshape(num_sim, num_mut)
+    flat_pos = np.sort(codon_pos[is_missense] + sim_ix[is_missense]*offset)
+
+    # count mutations at each codon and within each window
+    uniq_pos, pos_ct = np.unique(flat_pos, return_counts=True)
+    pos_sim = uniq_pos // offset
+    pos_sum = {w: (np.searchsorted(flat_pos, uniq_pos+w, side='right') -
+                   np.searchsorted(flat_pos, uniq_pos-w, side='left'))
+               for w in window}
+    return pos_sim, pos_ct, pos_sum
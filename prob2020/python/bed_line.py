@@ -1,5 +1,6 @@
 """Parses an individual line in a BED file."""
 from collections import namedtuple
+import numpy as np
 import logging
 
 # Initialize a global named tuple to make handling BED lines less awkward
@@ -29,6 +30,8 @@ class BedLine(object):
         '+'
         >>> bed.query_position('+', 'chr3', 41265559)
         0
+        >>> bed.query_positions('+', [41265559, 41265560, 0])
+        array([ 0.,  1., nan])
 
     """
 
@@ -128,6 +131,14 @@ class BedLine(object):
         self.three_ss_len = 2*(self.num_exons-1)
         self._init_splice_site_pos()
 
+        # genome coordinate of each sequence position, created when needed
+        self._seqpos2genome = None
+
+        # arrays used to map genome coordinates to coding positions
+        self._exon_starts = np.array([e[0] for e in self.exons], dtype=np.int64)
+        self._exon_ends = np.array([e[1] for e in self.exons], dtype=np.int64)
+        self._exon_offsets = np.concatenate([[0], np.cumsum(self.exon_lens, dtype=np.int64)])
+
     def _init_splice_site_pos(self):
         # dictionary mapping internal position format to position
         # in list of 5'/3' splice sites
@@ -155,46 +166,54 @@ class BedLine(object):
         return self.num_exons
 
     def init_genome_coordinates(self) :
-        """Creates the self.seqpos2genome dictionary that converts positions
-        relative to the sequence to genome coordinates."""
-        self.seqpos2genome = {}
+        """Creates the self.seqpos2genome array that converts positions
+        relative to the sequence to genome coordinates.
+
+        Positions follow the order of coding positions, then 5' and 3'
+        splice site positions. The array is computed only once, and is
+        otherwise created the first time it is used.
+        """
+        if self._seqpos2genome is not None:
+            return
+        pos_in_ss = np.tile([0, 1], self.num_exons-1)
+        ss_ix = np.repeat(np.arange(self.num_exons-1), 2)
 
         # record genome positions for each sequence position
-        seq_pos = 0
-        for estart, eend in self.exons:
-            for genome_pos in range(estart, eend):
-                if self.strand == '+':
-                    self.seqpos2genome[seq_pos] = genome_pos
-                elif self.strand == '-':
-                    tmp = self.cds_len - seq_pos - 1
-                    self.seqpos2genome[tmp] = genome_pos
-                seq_pos += 1
-
-        # recode 5' splice site locations
-        for i in range(0, self.five_ss_len):
-            seq_pos = self.cds_len + i
-            ss_ix = i // 2  # the ss_ix'th 5'ss starting from upstream tx
-            pos_in_ss = i % 2  # whether first/second nuc in splice site
-
-            # determine genome coordinates for 5' splice site
-            if self.strand == '+':
-                self.seqpos2genome[seq_pos] = self.exons[ss_ix][1] + pos_in_ss
-            else:
-                exon_pos = -1 - ss_ix
-                self.seqpos2genome[seq_pos] = self.exons[exon_pos][0] - pos_in_ss - 1
-
-        # recode 3' splice site locations
-        for i in range(0, self.three_ss_len):
-            seq_pos = self.cds_len + self.five_ss_len + i
-            ss_ix = i // 2  # the ss_ix'th 3'ss starting from upstream tx
-            pos_in_ss = i % 2  # whether first/second nuc in splice site
-
-            # determine genome coordinates for 3' splice site
-            if self.strand == '+':
-                self.seqpos2genome[seq_pos] = self.exons[ss_ix+1][0] - 2 + pos_in_ss
-            else:
-                exon_pos = -1 - ss_ix
-                self.seqpos2genome[seq_pos] = self.exons[exon_pos-1][1] + 1 - pos_in_ss
+        coding_pos = np.concatenate([np.arange(estart, eend, dtype=np.int64)
+                                     for estart, eend in self.exons] +
+                                    [np.zeros(0, dtype=np.int64)])
+        if self.strand == '+':
+            five_ss_pos = self._exon_ends[ss_ix] + pos_in_ss
+            three_ss_pos = self._exon_starts[ss_ix+1] - 2 + pos_in_ss
+        else:
+            coding_pos = coding_pos[::-1]
+            five_ss_pos = self._exon_starts[::-1][ss_ix] - pos_in_ss - 1
+            three_ss_pos = self._exon_ends[::-1][ss_ix+1] + 1 - pos_in_ss
+        self._seqpos2genome = np.concatenate([coding_pos, five_ss_pos,
+                                              three_ss_pos]).astype(np.int64)
+
+    @property
+    def seqpos2genome(self):
+        """Array of the (0-based) genome coordinate of each sequence
+        position (see init_genome_coordinates)."""
+        self.init_genome_coordinates()
+        return self._seqpos2genome
+
+    def seq_to_genome(self, positions):
+        """Converts positions relative to the sequence to genome coordinates.
+
+        Parameters
+        ----------
+        positions : int or np.array
+            0-based positions on the coding sequence, followed by 5' and 3'
+            splice site positions
+
+        Returns
+        -------
+        genome_coord : int or np.array
+            0-based genome coordinates
+        """
+        return self.seqpos2genome[np.asarray(positions, dtype=np.int64)]
 
     def query_position(self, strand, chr, genome_coord):
         """Provides the relative position on the coding sequence for a given
@@ -234,11 +253,10 @@ class BedLine(object):
         for i, (estart, eend) in enumerate(self.exons):
             # in coding region
             if estart <= genome_coord < eend:
+                prev_lens = int(self._exon_offsets[i])  # previous exon lengths
                 if strand == '+':
-                    prev_lens = sum(self.exon_lens[:i])  # previous exon lengths
                     pos = prev_lens + (genome_coord - estart)
                 elif strand == '-':
-                    prev_lens = sum(self.exon_lens[:i])  # previous exon lengths
                     pos = prev_lens + (genome_coord - estart)
                     pos = self.cds_len - pos - 1  # flip coords because neg strand
                 return pos
@@ -258,3 +276,77 @@ class BedLine(object):
                 return pos
 
         return pos
+
+    def query_positions(self, strand, genome_coords):
+        """Provides the relative positions on the coding sequence for an
+        array of genomic positions.
+
+        Gives the same positions as query_position, but exons are found with
+        a binary search over all positions at once.
+
+        Parameters
+        ----------
+        strand : str
+            strand of the gene, either '+' or '-'
+        genome_coords : np.array
+            0-based positions for mutations
+
+        Returns
+        -------
+        pos : np.array
+            position of mutations in coding sequence, NaN for mutations that
+            do not match a region found in self.exons
+        """
+        coords = np.asarray(genome_coords, dtype=np.int64)
+        pos = np.full(len(coords), np.nan)
+        if not self.num_exons:
+            return pos
+        starts, ends = self._exon_starts, self._exon_ends
+        last_exon = self.num_exons - 1
+
+        # candidate exon for each kind of region. When several regions match,
+        # query_position uses the first exon, checking the coding region first,
+        # then the splice site after the exon, and then the one before it.
+        num_regions = 3
+        no_match = num_regions * self.num_exons
+        coding_ix = np.searchsorted(starts, coords, side='right') - 1
+        is_coding = (coding_ix >= 0) & (coords < ends[np.maximum(coding_ix, 0)])
+        after_ix = np.searchsorted(ends, coords, side='right') - 1
+        is_after = ((after_ix >= 0) & (after_ix != last_exon) &
+                    (coords < ends[np.maximum(after_ix, 0)] + 2))
+        before_ix = np.searchsorted(starts, coords, side='right')
+        is_before = ((before_ix <= last_exon) & (before_ix != 0) &
+                     (coords >= starts[np.minimum(before_ix, last_exon)] - 2))
+        rank = np.stack([np.where(is_coding, num_regions*coding_ix, no_match),
+                         np.where(is_after, num_regions*after_ix + 1, no_match),
+                         np.where(is_before, num_regions*before_ix + 2, no_match)])
+        region = rank.argmin(axis=0)
+        region[rank.min(axis=0) == no_match] = -1
+
+        # in coding region
+        mask = region == 0
+        i = coding_ix[mask]
+        tmp_pos = self._exon_offsets[i] + (coords[mask] - starts[i])
+        if strand == '-':
+            tmp_pos = self.cds_len - tmp_pos - 1  # flip coords because neg strand
+        pos[mask] = tmp_pos
+
+        # in splice site after the exon
+        mask = region == 1
+        i = after_ix[mask]
+        if strand == '+':
+            pos[mask] = self.cds_len + 2*i + (coords[mask] - ends[i])
+        elif strand == '-':
+            pos[mask] = (self.cds_len + self.five_ss_len + 2*(self.num_exons-(i+2)) +
+                         (coords[mask] - ends[i]))
+
+        # in splice site before the exon
+        mask = region == 2
+        i = before_ix[mask]
+        if strand == '-':
+            pos[mask] = self.cds_len + 2*(self.num_exons-(i+2)) + (coords[mask] - (starts[i] - 2))
+        elif strand == '+':
+            pos[mask] = (self.cds_len + self.five_ss_len + 2*(i-1) +
+                         (coords[mask] - (starts[i] - 2)))
+
+        return pos
@@ -0,0 +1,128 @@
+"""This module stores the empirical null distribution of the HotMAPS 1D
+windowed sums as dense histograms.
+
+Each window size has an integer histogram indexed by the windowed sum,
+bounded by the number of mutations in the gene. P-values for any set of
+observed values are found from the reverse cumulative sum of the
+histogram, and histograms from several workers or runs of the same gene
+can be merged.
+"""
+import numpy as np
+import csv
+
+
+class EmpiricalNull(object):
+    """Histogram of simulated windowed sums for each window size."""
+
+    def __init__(self, window, max_count):
+        """Constructor.
+
+        Parameters
+        ----------
+        window : list
+            window sizes
+        max_count : int
+            maximum possible windowed sum, i.e. the number of mutations
+        """
+        self.window = list(window)
+        self.max_count = int(max_count)
+        self.counts = {w: np.zeros(self.max_count+1, dtype=np.int64)
+                       for w in self.window}
+
+    def add(self, w, vals):
+        """Adds simulated windowed sums to the histogram of a window.
+
+        Parameters
+        ----------
+        w : int
+            window size
+        vals : np.array
+            simulated windowed sums
+        """
+        vals = np.asarray(vals, dtype=np.int64)
+        if len(vals) and vals.max() > self.max_count:
+            self._grow(vals.max())
+        self.counts[w] += np.bincount(vals, minlength=self.max_count+1)
+
+    def _grow(self, max_count):
+        """Extends the histograms to a larger maximum windowed sum."""
+        extra = int(max_count) - self.max_count
+        for w in self.window:
+            self.counts[w] = np.concatenate([self.counts[w],
+                                             np.zeros(extra, dtype=np.int64)])
+        self.max_count = int(max_count)
+
+    def merge(self, other):
+        """Adds the histograms of another empirical null of the same gene.
+
+        Parameters
+        ----------
+        other : EmpiricalNull
+            empirical null with the same window sizes
+        """
+        if set(other.window) != set(self.window):
+            raise ValueError('Can not merge empirical nulls with different windows')
+        if other.max_count > self.max_count:
+            self._grow(other.max_count)
+        for w in self.window:
+            self.counts[w][:other.max_count+1] += other.counts[w]
+        return self
+
+    def num_sim(self, w):
+        """Returns the number of simulated windowed sums of a window."""
+        return int(self.counts[w].sum())
+
+    def tail_counts(self, w, vals):
+        """Counts the simulated windowed sums as or more extreme than each
+        value.
+
+        Parameters
+        ----------
+        w : int
+            window size
+        vals : list or np.array
+            observed windowed sums
+
+        Returns
+        -------
+        tail_cts : np.array
+            number of simulated windowed sums greater or equal to each value
+        """
+        tail = np.concatenate([np.cumsum(self.counts[w][::-1])[::-1], [0]])
+        vals = np.clip(np.asarray(vals, dtype=np.int64), 0, self.max_count+1)
+        return tail[vals]
+
+    def p_values(self, w, vals):
+        """Calculates the p-value of each observed windowed sum.
+
+        Parameters
+        ----------
+        w : int
+            window size
+        vals : list or np.array
+            observed windowed sums
+
+        Returns
+        -------
+        pvals : np.array
+            fraction of simulated windowed sums greater or equal to each value
+        """
+        return self.tail_counts(w, vals) / float(self.num_sim(w))
+
+    def save(self, path):
+        """Saves the tail distribution of each window.
+
+        Parameters
+        ----------
+        path : str
+            file path with a "{0}" placeholder for the window size
+        """
+        for w in self.window:
+            # windowed sums that occured, from the highest to the lowest
+            vals = np.flatnonzero(self.counts[w])[::-1]
+            pvals = self.p_values(w, vals)
+            output = [['mutation_count', 'p-value']]
+            output.extend(zip(vals.tolist(), pvals.tolist()))
+            with open(path.format(w), 'w') as handle:
+                mywriter = csv.writer(handle, delimiter='\t', lineterminator='\n')
+                mywriter.writerows(output)
@@ -1,5 +1,15 @@
 """Fetches gene sequence from gene fasta created by extract_genes.py"""
 import prob2020.python.utils as utils
+import numpy as np
+
+# amino acid code for every codon, indexed by the base-5 number formed by
+# the nucleotide codes of the codon (codons containing an "N" are missing)
+_codon_weights = np.array([25, 5, 1])
+_codon_aa = np.full(len(utils.nuc_letters)**3, utils.missing_aa_code, dtype=np.int8)
+for _codon, _aa in utils.codon_table.items():
+    if len(_codon) == 3:
+        _codon_ix = sum(utils.nuc_code[n]*w for n, w in zip(_codon, _codon_weights))
+        _codon_aa[_codon_ix] = utils.aa_code[_aa]
 
 
 class GeneSequence(object):
@@ -30,6 +40,7 @@ class GeneSequence(object):
         self.three_prime_seq = three_ss_seq_list
         self.five_prime_seq =  five_ss_seq_list
         self._to_upper()  # make sure all sequences are in upper case
+        self._effect_table = None  # lookup table depends on the sequence
 
     def add_germline_variants(self, germline_nucs, coding_pos):
         """Add potential germline variants into the nucleotide sequence.
@@ -53,11 +64,102 @@ class GeneSequence(object):
         es = list(self.exon_seq)
         for i in range(len(germline_nucs)):
             gl_nuc, cpos = germline_nucs[i].upper(), coding_pos[i]
-            if not utils.is_valid_nuc(gl_nuc):
+            if gl_nuc not in utils.nuc_code:
                 raise ValueError('{0} is not a valid nucleotide'.format(gl_nuc))
             if cpos >= 0:
                 es[cpos] = gl_nuc
         self.exon_seq = ''.join(es)
+        self._effect_table = None  # lookup table depends on the sequence
+
+    def get_effect_table(self):
+        """Returns integer lookup tables describing the effect of every
+        possible SNV in the gene.
+
+        Positions follow the same convention as SequenceContext, i.e. coding
+        positions are followed by 5' and then 3' splice site positions.
+        Amino acids are encoded with utils.aa_code, somatic bases with
+        utils.nuc_code and the variant classification with utils.effect_code.
+        The table is only computed once per gene.
+
+        Returns
+        -------
+        effect_table : dict
+            'Codon Pos' is the codon position of each sequence position (-1
+            for splice sites) and 'Reference AA' is the reference residue code.
+            'Somatic AA' and 'Effect' are (num positions x num bases) arrays of
+            the residue code and the variant classification code after
+            mutating a position to each base.
+        """
+        if self._effect_table is None:
+            self._effect_table = self._init_effect_table()
+        return self._effect_table
+
+    def _init_effect_table(self):
+        """Computes the effect lookup table with array operations.
+
+        Matches the output of mutation_context.get_aa_mut_info and
+        cutils.get_variant_classification, e.g. incomplete codons or codons
+        with an "N" have a missing residue and effect.
+        """
+        cds_len = self.bed.cds_len
+        num_ss = self.bed.five_ss_len + self.bed.three_ss_len
+        num_nucs = len(utils.nuc_letters)
+
+        # convert sequence to nucleotide codes
+        byte2code = np.full(256, utils.nuc_code['N'], dtype=np.int8)
+        for nuc in 'ACGT':
+            byte2code[ord(nuc)] = utils.nuc_code[nuc]
+        seq_code = byte2code[np.frombuffer(self.exon_seq[:cds_len].encode('ascii'),
+                                           dtype=np.uint8)].astype(np.int64)
+
+        # only complete codons have an amino acid
+        num_codons = cds_len // 3
+        num_full = 3*num_codons
+        codon_ix = seq_code[:num_full].reshape(num_codons, 3).dot(_codon_weights)
+        pos = np.arange(num_full)
+        pos_weight = _codon_weights[pos % 3]
+        base_ix = codon_ix[pos // 3] - seq_code[:num_full]*pos_weight
+
+        # fill in coding positions
+        ref_aa = np.full(cds_len + num_ss, utils.missing_aa_code, dtype=np.int8)
+        somatic_aa = np.full((cds_len + num_ss, num_nucs),
+                             utils.missing_aa_code, dtype=np.int8)
+        codon_pos = np.full(cds_len + num_ss, -1, dtype=np.int32)
+        ref_aa[:num_full] = _codon_aa[codon_ix[pos // 3]]
+        somatic_aa[:num_full] = _codon_aa[base_ix[:, None] + np.outer(pos_weight, np.arange(num_nucs))]
+        codon_pos[:cds_len] = np.arange(cds_len) // 3
+
+        # splice sites are never in a codon
+        ref_aa[cds_len:] = utils.splice_code
+        somatic_aa[cds_len:] = utils.splice_code
+
+        # classify the variant, the order of the checks follows
+        # cutils.get_variant_classification
+        germ_aa = ref_aa[:, np.newaxis]
+        is_changed = somatic_aa != germ_aa
+        is_splice = (somatic_aa == utils.splice_code) | (germ_aa == utils.splice_code)
+        is_valid = ((somatic_aa != utils.missing_aa_code) &
+                    (germ_aa != utils.missing_aa_code)) | is_splice
+        conditions = [~is_valid,
+                      is_changed & (somatic_aa == utils.stop_code),
+                      is_changed & (germ_aa == utils.stop_code),
+                      is_splice,
+                      is_changed & (codon_pos[:, np.newaxis] == 0),
+                      is_changed]
+        choices = [utils.missing_effect_code,
+                   utils.effect_code['Nonsense_Mutation'],
+                   utils.effect_code['Nonstop_Mutation'],
+                   utils.effect_code['Splice_Site'],
+                   utils.effect_code['Translation_Start_Site'],
+                   utils.effect_code['Missense_Mutation']]
+        effect = np.select(conditions, choices,
+                           default=utils.effect_code['Silent']).astype(np.int8)
+
+        effect_table = {'Codon Pos': codon_pos,
+                        'Reference AA': ref_aa,
+                        'Somatic AA': somatic_aa,
+                        'Effect': effect}
+        return effect_table
 
     def _to_upper(self):
         """Convert sequences to upper case."""
@@ -6,48 +6,69 @@ input.
 import prob2020.python.utils as utils
 import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 
 def simulate_indel_counts(indel_df, bed_dict,
                           num_permutations=1,
-                          seed=None):
+                          seed=None,
+                          max_draws=10000000):
+    """Simulates the number of frameshift and inframe indels in each gene.
+
+    Each indel is independently assigned to a gene with probability
+    proportional to the gene's CDS length, so the frameshift and inframe
+    indel counts of the genes each follow a multinomial distribution.
+
+    Parameters
+    ----------
+    indel_df : pd.DataFrame
+        indels, containing an "indel len" column
+    bed_dict : dict
+        dictionary mapping chromosomes to BedLine objects
+    num_permutations : int, default: 1
+        number of simulations
+    seed : int or None, default: None
+        seed for the random number generator
+    max_draws : int, default: 10000000
+        maximum number of gene counts drawn at a time (num simulations X
+        num genes). Only the nonzero counts are kept, so memory usage is
+        bounded by max_draws and the size of the returned matrices.
+
+    Returns
+    -------
+    fs_cts : sparse.csc_matrix
+        num permutations X num genes matrix of frameshift counts
+    inframe_cts : sparse.csc_matrix
+        num permutations X num genes matrix of inframe indel counts
+    gene_names : pd.Index
+        gene name of each column
+    """
     # count indels
     bed_genes = [mybed
                  for chrom in bed_dict
                  for mybed in bed_dict[chrom]]
-    tmp = []
-    for b in bed_genes:
-        b.init_genome_coordinates()
-        tmp.append(b)
-    bed_genes = tmp
     gene_lengths = pd.Series([b.cds_len for b in bed_genes],
                               index=[b.gene_name for b in bed_genes])
 
-    # generate random indel assignments
+    # generate random indel counts
     gene_prob = gene_lengths.astype(float) / gene_lengths.sum()
-    indel_lens = indel_df['indel len'].copy().values
-    is_fs = (indel_lens % 3) > 0
-    indel_ixs = np.arange(len(indel_lens))
+    indel_lens = indel_df['indel len'].values
+    num_fs = int(np.sum((indel_lens % 3) > 0))
+    num_inframe = len(indel_lens) - num_fs
+    num_genes = len(gene_lengths)
     prng = np.random.RandomState(seed=seed)
 
-    # randomly reassign indels
-    mygene_cts = prng.multinomial(len(indel_lens), gene_prob, size=num_permutations)
-    inframe_cts = mygene_cts.copy()
-    for row in range(mygene_cts.shape[0]):
-        nonzero_ix = np.nonzero(mygene_cts[row,:])[0]
-
-        # randomly shuffle indel lengths
-        prng.shuffle(indel_ixs)
-        is_fs = is_fs[indel_ixs]
-
-        # iterate over each gene
-        indel_ix = 0
-        for j in range(len(nonzero_ix)):
-            prev_indel_ix = indel_ix
-            num_gene_indels = mygene_cts[row, nonzero_ix[j]]
-            indel_ix += num_gene_indels
-            inframe_cts[row, nonzero_ix[j]] = num_gene_indels - np.sum(is_fs[prev_indel_ix:indel_ix])
-    mygene_cts -= inframe_cts
-    return mygene_cts, inframe_cts, gene_lengths.index
+    # draw gene counts for a chunk of simulations at a time, and only keep
+    # the counts of the genes hit in each simulation
+    rows_per_chunk = max(1, max_draws // max(num_genes, 1))
+    indel_cts = []
+    for num_type in [num_fs, num_inframe]:
+        chunks = [sparse.csr_matrix((0, num_genes), dtype=np.int64)]
+        for start in range(0, num_permutations, rows_per_chunk):
+            num_rows = min(rows_per_chunk, num_permutations - start)
+            chunks.append(sparse.csr_matrix(prng.multinomial(num_type, gene_prob, size=num_rows)))
+        indel_cts.append(sparse.vstack(chunks, format='csc'))
+    fs_cts, inframe_cts = indel_cts
+    return fs_cts, inframe_cts, gene_lengths.index
 
 
 def simulate_indel_maf(indel_df, bed_dict,
@@ -57,11 +78,6 @@ def simulate_indel_maf(indel_df, bed_dict,
     bed_genes = [mybed
                 for chrom in bed_dict
                 for mybed in bed_dict[chrom]]
-    tmp = []
-    for b in bed_genes:
-        b.init_genome_coordinates()
-        tmp.append(b)
-    bed_genes = tmp
     gene_lengths = pd.Series([b.cds_len for b in bed_genes],
                                 index=[b.gene_name for b in bed_genes])
 
@@ -99,7 +115,7 @@ def counts2maf(num_indels, myindel_lens, myindel_types, gene_bed, seed=None):
     maf_list = []
     prng = np.random.RandomState(seed=seed)
     pos = prng.randint(low=0, high=gene_bed.cds_len, size=num_indels)
-    genome_pos = [gene_bed.seqpos2genome[p] for p in pos]
+    genome_pos = gene_bed.seq_to_genome(pos)
     is_frame_shift = myindel_lens%3
     for i, gpos in enumerate(genome_pos):
         if myindel_types[i] == 'INS':
@@ -0,0 +1,179 @@
+"""This module writes mutations in a MAF-like format.
+
+Mutations can be written as tab-delimited text, gzip compressed text or as
+prepared mutation files (see mutation_reader), which store each column as
+a numpy array. Writers are meant to be used by each worker process on its
+own part of the output, which the parent process then combines with
+append_part. Concatenated gzip files are a valid gzip file, so parts of
+text and gzip output are combined by copying their bytes. Prepared
+mutation output is a directory containing the prepared mutation file of
+each part.
+"""
+import prob2020.python.mutation_reader as mr
+import pandas as pd
+import csv
+import glob
+import gzip
+import os
+import shutil
+
+maf_formats = ['text', 'gzip', 'npz']
+
+
+def infer_maf_format(path, maf_format=None):
+    """Determines the output format.
+
+    Parameters
+    ----------
+    path : str
+        output path
+    maf_format : str or None, default: None
+        format specified by the user ('text', 'gzip' or 'npz'). If None,
+        the format is inferred from the file extension of path.
+
+    Returns
+    -------
+    maf_format : str
+        output format
+    """
+    if maf_format:
+        if maf_format not in maf_formats:
+            raise ValueError('Unknown MAF output format: {0}'.format(maf_format))
+        return maf_format
+    if path.endswith('.gz'):
+        return 'gzip'
+    elif path.endswith('.npz'):
+        return 'npz'
+    return 'text'
+
+
+class MafWriter(object):
+    """Writes mutations in a MAF-like format.
+
+    Mutations are given either as a pd.DataFrame or as a list of rows. For
+    prepared mutation output, mutations are kept in memory until flush_rows
+    mutations are collected, and then saved as a separate prepared mutation
+    file named after path (e.g. "<path>-0000.npz").
+    """
+
+    def __init__(self, path, columns,
+                 maf_format='text',
+                 header=False,
+                 mode='w',
+                 flush_rows=1000000):
+        """Constructor.
+
+        Parameters
+        ----------
+        path : str
+            output path (prefix of the output files for 'npz' format)
+        columns : list of str
+            column names
+        maf_format : str, default: 'text'
+            'text', 'gzip' or 'npz'
+        header : bool, default: False
+            write the column names as the first line of text output
+        mode : str, default: 'w'
+            'w' to create a new file or 'a' to append to it
+        flush_rows : int, default: 1000000
+            number of mutations in each prepared mutation file
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.maf_format = maf_format
+        self.flush_rows = flush_rows
+        self.num_parts = 0
+        self._pending = []
+        self._num_pending = 0
+        if maf_format == 'text':
+            self._handle = open(path, mode)
+        elif maf_format == 'gzip':
+            self._handle = gzip.open(path, mode+'t')
+        else:
+            self._handle = None
+        if self._handle is not None:
+            self._writer = csv.writer(self._handle, delimiter='\t', lineterminator='\n')
+            if header:
+                self._writer.writerow(self.columns)
+
+    def write(self, maf_lines):
+        """Writes mutations.
+
+        Parameters
+        ----------
+        maf_lines : pd.DataFrame or list of lists
+            mutations with the columns of the writer
+        """
+        if self._handle is not None:
+            if isinstance(maf_lines, pd.DataFrame):
+                maf_lines = zip(*[maf_lines[col].tolist() for col in maf_lines.columns])
+            self._writer.writerows(maf_lines)
+        else:
+            if not isinstance(maf_lines, pd.DataFrame):
+                maf_lines = pd.DataFrame(maf_lines, columns=self.columns)
+            if len(maf_lines):
+                self._pending.append(maf_lines)
+                self._num_pending += len(maf_lines)
+            if self._num_pending >= self.flush_rows:
+                self.flush()
+
+    def flush(self):
+        """Saves the collected mutations as a prepared mutation file."""
+        if not self._pending:
+            return
+        maf_df = pd.concat(self._pending, ignore_index=True)
+        part_path = '{0}-{1:04d}.npz'.format(self.path, self.num_parts)
+        mr.write_prepared_mutations(maf_df, part_path)
+        self.num_parts += 1
+        self._pending = []
+        self._num_pending = 0
+
+    def close(self):
+        """Finishes writing the output."""
+        if self._handle is not None:
+            self._handle.close()
+        else:
+            self.flush()
+
+
+def append_part(path, part_path):
+    """Appends a text or gzip output part to the output file, and deletes
+    the part.
+
+    Parameters
+    ----------
+    path : str
+        output file
+    part_path : str
+        output of a MafWriter with the same format as the output file
+    """
+    with open(path, 'ab') as out_handle, open(part_path, 'rb') as part_handle:
+        shutil.copyfileobj(part_handle, out_handle)
+    os.remove(part_path)
+
+
+def read_maf(path, maf_format=None):
+    """Reads mutations written by MafWriter.
+
+    Parameters
+    ----------
+    path : str
+        text or gzip file with a header line, or a directory of prepared
+        mutation files (other files in the directory are ignored)
+    maf_format : str or None, default: None
+        format of the output, inferred from path if None
+
+    Returns
+    -------
+    maf_df : pd.DataFrame
+        mutations
+    """
+    maf_format = infer_maf_format(path, maf_format)
+    if maf_format == 'npz':
+        parts = [mr.read_prepared_mutations(part_path)
+                 for part_path in sorted(glob.glob(os.path.join(path, '*.npz')))
+                 if mr.is_prepared_mutations(part_path)]
+        if not parts:
+            return pd.DataFrame()
+        return pd.concat(parts, ignore_index=True)
+    return pd.read_csv(path, sep='\t')
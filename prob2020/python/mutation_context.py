@@ -1,6 +1,7 @@
 from prob2020.python import utils
 import prob2020.python.sequence_context
 import prob2020.python.indel as indel
+import prob2020.python.mutation_reader as mr
 from prob2020.python.gene_sequence import GeneSequence
 from prob2020.python.amino_acid import AminoAcid
 import prob2020.cython.cutils as cutils
@@ -8,6 +9,10 @@ import numpy as np
 import pandas as pd
 import pysam
 import itertools as it
+import os
+
+import logging
+logger = logging.getLogger(__name__)  # module logger
 
 # hack to rename izip function
 import sys
@@ -58,29 +63,39 @@ def compute_mutation_context(bed, gs, df, opts):
     cols = ['Chromosome', 'Start_Position', 'Reference_Allele',
             'Tumor_Allele', 'Variant_Classification', 'Protein_Change',
             'Tumor_Sample', 'Tumor_Type']
+    # SNVs from the annotated cache are already on the coding strand
+    is_annotated = 'Context' in df.columns
+    if is_annotated:
+        cols += ['Coding Position', 'Context']
     mut_info = gene_mut[cols]
     gs.set_gene(bed)
 
     # get sequence context
+    cache_dir = prob2020.python.sequence_context.get_context_cache_dir(opts)
+    random_backend = prob2020.python.sequence_context.get_random_backend(opts)
     if 'seed' in opts:
-        sc = prob2020.python.sequence_context.SequenceContext(gs, seed=opts['seed'])
+        sc = prob2020.python.sequence_context.SequenceContext(gs, seed=opts['seed'],
+                                                              cache_dir=cache_dir,
+                                                              random_backend=random_backend)
     else:
-        sc = prob2020.python.sequence_context.SequenceContext(gs)
+        sc = prob2020.python.sequence_context.SequenceContext(gs, cache_dir=cache_dir,
+                                                              random_backend=random_backend)
 
     # count total mutations in gene
     total_mut = len(mut_info)
 
-    # fix nucleotide letter if gene is on - strand
-    if bed.strand == '-':
-        mut_info.loc[:,'Tumor_Allele'] = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
+    if is_annotated:
+        # count only the contexts of the gene's mutations
+        mut_info = mut_info.assign(Context=mut_info['Context'].astype(object))
+    else:
+        # fix nucleotide letter if gene is on - strand
+        if bed.strand == '-':
+            mut_info.loc[:,'Tumor_Allele'] = mut_info['Tumor_Allele'].map(lambda x: utils.rev_comp(x))
 
-    # get coding positions, mutations unmapped to the reference tx will have
-    # NA for a coding position
-    pos_list = []
-    for ix, row in mut_info.iterrows():
-        coding_pos = bed.query_position(bed.strand, row['Chromosome'], row['Start_Position'])
-        pos_list.append(coding_pos)
-    mut_info['Coding Position'] = pos_list
+        # get coding positions, mutations unmapped to the reference tx will have
+        # NA for a coding position
+        mut_info['Coding Position'] = bed.query_positions(bed.strand,
+                                                          mut_info['Start_Position'].values)
 
     # recover mutations that could not be mapped to the reference transcript
     # for a gene before being dropped (next step)
@@ -95,7 +110,8 @@ def compute_mutation_context(bed, gs, df, opts):
             'Tumor_Sample', 'Tumor_Type']
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if not is_annotated:
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         unmapped_mut_df = pd.DataFrame(unmapped_mut_info)
@@ -114,6 +130,127 @@ def compute_mutation_context(bed, gs, df, opts):
     return context_cts, context_to_mutations, tmp_df, gs, sc
 
 
+def _rev_comp_alleles(alleles, is_rev):
+    """Reverse complements the flagged alleles, keeping them as categories."""
+    alleles = alleles.astype('category')
+    categories = list(alleles.cat.categories)
+    rc_categories = [utils.rev_comp(a) for a in categories]
+    new_categories = pd.Index(categories + rc_categories).unique()
+    codes = alleles.cat.codes.values
+    new_codes = np.where(is_rev,
+                         new_categories.get_indexer(rc_categories)[codes],
+                         new_categories.get_indexer(categories)[codes])
+    new_codes[codes < 0] = -1
+    return pd.Categorical.from_codes(new_codes, new_categories)
+
+
+def annotate_snvs(snv_df, bed_dict, opts):
+    """Annotates SNVs with their position on the coding sequence of their gene.
+
+    Performs the same steps as compute_mutation_context for every gene at
+    once, so they can be cached.
+
+    Parameters
+    ----------
+    snv_df : pd.DataFrame
+        valid SNVs with 0-based positions
+    bed_dict : dict
+        BedLine objects of the genes, grouped by chromosome
+    opts : dict
+        options containing "input" (gene FASTA), "context", and optionally
+        "cache_dir"
+
+    Returns
+    -------
+    snv_df : pd.DataFrame
+        SNVs with the reference and tumor alleles on the coding strand, and
+        additional "Coding Position" (NaN if not on the reference
+        transcript) and "Context" columns. SNVs of genes without a BED line
+        are kept unchanged.
+    """
+    snv_df = snv_df.copy()
+    gene_fa = pysam.Fastafile(opts['input'])
+    gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    cache_dir = prob2020.python.sequence_context.get_context_cache_dir(opts)
+    gene_ixs = snv_df.groupby('Gene', observed=True).indices
+    coding_pos = np.full(len(snv_df), np.nan)
+    context_codes = np.full(len(snv_df), -1, dtype=np.int32)
+    is_rev = np.zeros(len(snv_df), dtype=bool)
+    contexts = {}
+    for chrom in bed_dict:
+        for bed in bed_dict[chrom]:
+            if bed.gene_name not in gene_ixs:
+                continue
+            ixs = gene_ixs[bed.gene_name]
+            gs.set_gene(bed)
+            sc = prob2020.python.sequence_context.SequenceContext(gs, cache_dir=cache_dir)
+            is_rev[ixs] = bed.strand == '-'
+
+            # contexts of the SNVs on the reference transcript
+            gene_pos = bed.query_positions(bed.strand, snv_df['Start_Position'].values[ixs])
+            coding_pos[ixs] = gene_pos
+            is_mapped = ~np.isnan(gene_pos)
+            gene_contexts = sc.get_contexts(gene_pos[is_mapped].astype(int))
+            context_codes[ixs[is_mapped]] = [contexts.setdefault(c, len(contexts))
+                                             for c in gene_contexts]
+    gene_fa.close()
+
+    snv_df['Coding Position'] = coding_pos
+    snv_df['Context'] = pd.Categorical.from_codes(context_codes, list(contexts))
+    for col in ['Reference_Allele', 'Tumor_Allele']:
+        snv_df[col] = _rev_comp_alleles(snv_df[col], is_rev)
+    return snv_df
+
+
+def select_snvs(mut_df, opts, only_unique=False, use_cache=True):
+    """Selects the valid SNVs among the mutations.
+
+    If a cache directory is specified, the selected SNVs are annotated
+    by annotate_snvs and cached (see mutation_reader.annotated_cache_path).
+    Later runs load the annotated SNVs from the cache, and skip selecting
+    and annotating them again.
+
+    Parameters
+    ----------
+    mut_df : pd.DataFrame or None
+        mutations of opts["mutations"]. If None, the mutations are read
+        unless the annotated SNVs are cached.
+    opts : dict
+        options containing "mutations", "bed", "input" (gene FASTA),
+        "context", and optionally "cache_dir"
+    only_unique : bool, default: False
+        only keep unique mutations for each tumor sample
+    use_cache : bool, default: True
+        whether annotated SNVs are cached. Should be False if mut_df is
+        not read from opts["mutations"].
+
+    Returns
+    -------
+    snv_df : pd.DataFrame
+        valid SNVs with 0-based positions
+    """
+    cache_path = mr.annotated_cache_path(opts, only_unique) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        return mr.read_prepared_mutations(cache_path)
+
+    if mut_df is None:
+        cache_dir = opts['cache_dir'] if 'cache_dir' in opts else None
+        mut_df = mr.read_mutations(opts['mutations'], cache_dir=cache_dir)
+    orig_num_mut = len(mut_df)
+    mut_df = mut_df.dropna(subset=['Gene', 'Tumor_Allele', 'Start_Position', 'Chromosome'])
+    logger.info('Kept {0} mutations after droping mutations with missing '
+                'information (Droped: {1})'.format(len(mut_df), orig_num_mut - len(mut_df)))
+
+    # select valid single nucleotide variants only
+    snv_df = utils._fix_mutation_df(mut_df, only_unique)
+    if cache_path:
+        # the index is not saved, so it is reset like for cached SNVs
+        snv_df = annotate_snvs(snv_df, utils.read_bed(opts['bed']), opts)
+        snv_df = snv_df.reset_index(drop=True)
+        mr.write_prepared_mutations(snv_df, cache_path, opts['mutations'])
+    return snv_df
+
+
 def get_chasm_context(tri_nuc):
     """Returns the mutation context acording to CHASM.
 
@@ -252,6 +389,39 @@ def get_aa_mut_info(coding_pos, somatic_base, gene_seq):
     return aa_info
 
 
+def get_aa_mut_info_batch(coding_pos, somatic_base, gene_seq):
+    """Array-based version of get_aa_mut_info for a whole batch of
+    simulations.
+
+    Instead of strings, amino acids and the variant classification are
+    returned as integer codes (see utils.aa_code and utils.effect_code)
+    gathered from the gene's effect lookup table.
+
+    Parameters
+    ----------
+    coding_pos : np.array
+        num simulations X num mutations array of base positions (0-based)
+    somatic_base : list of str
+        Contains the somatic nucleotide for each column of coding_pos
+    gene_seq : GeneSequence
+        gene sequence
+
+    Returns
+    -------
+    aa_info : dict
+        num simulations X num mutations arrays for the codon position,
+        reference AA code, somatic AA code and effect code
+    """
+    effect_table = gene_seq.get_effect_table()
+    base_code = np.array([utils.nuc_code.get(b, utils.nuc_code['N'])
+                          for b in somatic_base], dtype=int)
+    aa_info = {'Codon Pos': effect_table['Codon Pos'][coding_pos],
+               'Reference AA': effect_table['Reference AA'][coding_pos],
+               'Somatic AA': effect_table['Somatic AA'][coding_pos, base_code],
+               'Effect': effect_table['Effect'][coding_pos, base_code]}
+    return aa_info
+
+
 def get_unmapped_aa_mut_info(mut_info, genome_fa, strand, chr, context_type):
 
     # get information on the nucleotide context
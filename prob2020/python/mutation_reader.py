@@ -0,0 +1,280 @@
+"""This module reads mutation (MAF) files in chunks.
+
+Only the columns used by the statistical tests are read. Columns with
+few distinct values, such as genes, samples and alleles, are read as
+categories, so each chunk is stored as integer codes rather than as
+strings. Column names from the MAF specification are renamed to the
+internal column names.
+
+The parsed mutations can be saved as a prepared mutation file, which
+stores each column as a numpy array (string columns as integer codes into
+their unique values) together with the checksum of the source file. A
+prepared file can be given in place of the mutation file, and is created
+automatically in the cache directory if one is specified. SNVs annotated
+for the genes of a BED file are cached the same way (see
+mutation_context.select_snvs).
+"""
+import prob2020.python.utils as utils
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import logging
+logger = logging.getLogger(__name__)  # module logger
+
+# MAF column names -> internal column names
+rename_dict = {
+    'Hugo_Symbol': 'Gene',
+    'Tumor_Sample_Barcode': 'Tumor_Sample',
+    'Tumor_Seq_Allele2' : 'Tumor_Allele'
+}
+
+# columns used from the mutation file
+position_cols = ['Start_Position', 'End_Position']
+mutation_cols = ['Gene', 'Tumor_Sample', 'Tumor_Type', 'Chromosome',
+                 'Start_Position', 'End_Position', 'Variant_Classification',
+                 'Reference_Allele', 'Tumor_Allele', 'Protein_Change']
+category_cols = ['Gene', 'Tumor_Sample', 'Tumor_Type', 'Chromosome',
+                 'Variant_Classification', 'Reference_Allele', 'Tumor_Allele']
+
+
+def mutation_file_columns(path):
+    """Finds the columns of a mutation file that are used.
+
+    Parameters
+    ----------
+    path : str
+        path to tab-delimited mutation file
+
+    Returns
+    -------
+    use_cols : dict
+        column name in the file -> internal column name
+    """
+    header = pd.read_csv(path, sep='\t', nrows=0).columns
+    use_cols = {}
+    for col in header:
+        internal_col = rename_dict.get(col, col)
+        if internal_col in mutation_cols and internal_col not in use_cols.values():
+            use_cols[col] = internal_col
+    return use_cols
+
+
+def iter_mutation_chunks(path, chunksize=500000):
+    """Iterates over chunks of a mutation file.
+
+    Parameters
+    ----------
+    path : str
+        path to tab-delimited mutation file
+    chunksize : int, default: 500000
+        number of rows in each chunk
+
+    Yields
+    ------
+    mut_df : pd.DataFrame
+        mutations of the chunk, only containing the used columns with
+        internal column names. Positions are floats, since they may be
+        missing, and the columns in category_cols are categories.
+    """
+    use_cols = mutation_file_columns(path)
+    dtypes = {}
+    for col, internal_col in use_cols.items():
+        if internal_col in position_cols:
+            dtypes[col] = float
+        elif internal_col in category_cols:
+            dtypes[col] = 'category'
+        else:
+            dtypes[col] = str
+    reader = pd.read_csv(path, sep='\t', usecols=list(use_cols),
+                         dtype=dtypes, chunksize=chunksize)
+    for mut_df in reader:
+        mut_df.rename(columns=use_cols, inplace=True)
+        yield mut_df
+
+
+def read_mutations(path, chunksize=500000, cache_dir=None):
+    """Reads the used columns of a mutation file.
+
+    Parameters
+    ----------
+    path : str
+        path to tab-delimited mutation file, or to a prepared mutation file
+    chunksize : int, default: 500000
+        number of rows read at a time
+    cache_dir : str or None, default: None
+        directory where prepared mutation files are cached, keyed by the
+        checksum of the mutation file
+
+    Returns
+    -------
+    mut_df : pd.DataFrame
+        mutations with internal column names. Position columns are
+        integers unless they contain missing values, and the columns in
+        category_cols are categories.
+    """
+    if is_prepared_mutations(path):
+        return read_prepared_mutations(path)
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, 'mutations',
+                                  utils.file_checksum(path) + '.npz')
+        if os.path.exists(cache_path):
+            return read_prepared_mutations(cache_path)
+
+    # chunks only hold integer codes for the categorical columns, which are
+    # merged into codes for the categories of the whole file
+    chunks = list(iter_mutation_chunks(path, chunksize))
+    columns = list(chunks[0].columns)
+    data = {}
+    for col in columns:
+        if col in category_cols:
+            data[col] = union_categoricals([chunk[col] for chunk in chunks])
+        else:
+            data[col] = np.concatenate([chunk[col].values for chunk in chunks])
+    del chunks
+    mut_df = pd.DataFrame(data, columns=columns)
+    for col in position_cols:
+        if col in mut_df.columns and not mut_df[col].isnull().any():
+            mut_df[col] = mut_df[col].astype(np.int64)
+    logger.info('Read {0} mutations from {1}'.format(len(mut_df), path))
+
+    if cache_dir:
+        write_prepared_mutations(mut_df, cache_path, path)
+    return mut_df
+
+
+def mutations_checksum(path):
+    """Gets the checksum of a mutation file. Prepared mutation files have
+    the checksum of the mutation file they were read from."""
+    if is_prepared_mutations(path):
+        with np.load(path) as prepared:
+            meta = json.loads(str(prepared['prepared_meta']))
+        if meta['checksum']:
+            return meta['checksum']
+    return utils.file_checksum(path)
+
+
+def annotated_cache_path(opts, only_unique=False):
+    """Gets the path where annotated SNVs are cached.
+
+    The path is specific to the checksums of the mutation, BED and gene
+    FASTA files, to the type of sequence context, and to whether only
+    unique mutations are kept.
+
+    Parameters
+    ----------
+    opts : dict
+        options containing "mutations", "bed", "input" (gene FASTA),
+        "context", and optionally "cache_dir"
+    only_unique : bool, default: False
+        whether only unique mutations of each tumor sample are kept
+
+    Returns
+    -------
+    cache_path : str or None
+        path of the cached SNVs, None if no cache directory was specified
+    """
+    if 'cache_dir' not in opts or not opts['cache_dir']:
+        return None
+    checksums = [mutations_checksum(opts['mutations']),
+                 utils.file_checksum(opts['bed']),
+                 utils.file_checksum(opts['input'])]
+    key = hashlib.md5('_'.join(checksums).encode()).hexdigest()
+    return os.path.join(opts['cache_dir'], 'annotated',
+                        '{0}_{1}_{2}.npz'.format(key, opts['context'], int(only_unique)))
+
+
+def is_prepared_mutations(path):
+    """Checks whether a path is a prepared mutation file."""
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as handle:
+        return 'prepared_meta.npy' in handle.namelist()
+
+
+def write_prepared_mutations(mut_df, path, source_path=None):
+    """Saves parsed mutations as a prepared mutation file.
+
+    Parameters
+    ----------
+    mut_df : pd.DataFrame
+        mutations from read_mutations
+    path : str
+        output path of the prepared mutation file
+    source_path : str or None, default: None
+        path of the mutation file the mutations were read from. None if the
+        mutations were not read from a file, e.g. simulated mutations.
+    """
+    meta = {'columns': list(mut_df.columns),
+            'source': os.path.abspath(source_path) if source_path else None,
+            'checksum': utils.file_checksum(source_path) if source_path else None,
+            'categorical': []}
+    arrays = {}
+    for col in mut_df.columns:
+        vals = mut_df[col].values
+        if vals.dtype.kind in 'biuf':
+            arrays[col] = vals
+        elif isinstance(mut_df[col].dtype, pd.CategoricalDtype):
+            # categories are already encoded
+            arrays[col] = mut_df[col].cat.codes.values.astype(np.int32)
+            arrays[col+' values'] = np.array(mut_df[col].cat.categories, dtype=str)
+            meta['categorical'].append(col)
+        else:
+            codes, uniques = pd.factorize(mut_df[col])
+            arrays[col] = codes.astype(np.int32)
+            arrays[col+' values'] = np.array(uniques, dtype=str)
+    arrays['prepared_meta'] = np.array(json.dumps(meta))
+
+    # write to a temporary file first, so other processes never read a
+    # partially written file
+    out_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as handle:
+        np.savez(handle, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_prepared_mutations(path):
+    """Reads mutations from a prepared mutation file.
+
+    Parameters
+    ----------
+    path : str
+        path to prepared mutation file
+
+    Returns
+    -------
+    mut_df : pd.DataFrame
+        mutations, identical to those returned by read_mutations for the
+        source mutation file
+    """
+    with np.load(path) as prepared:
+        meta = json.loads(str(prepared['prepared_meta']))
+        categorical = meta['categorical'] if 'categorical' in meta else []
+        data = {}
+        for col in meta['columns']:
+            vals = prepared[col]
+            if col in categorical:
+                categories = prepared[col+' values'].astype(object)
+                vals = pd.Categorical.from_codes(vals, categories)
+            elif col+' values' in prepared.files:
+                uniques = prepared[col+' values'].astype(object)
+                if len(uniques):
+                    decoded = uniques[np.maximum(vals, 0)]
+                else:
+                    decoded = np.empty(len(vals), dtype=object)
+                decoded[vals < 0] = np.nan
+                vals = decoded
+            data[col] = vals
+    mut_df = pd.DataFrame(data, columns=meta['columns'])
+    logger.info('Read {0} mutations prepared from {1} ({2})'.format(len(mut_df),
+                                                                   meta['source'],
+                                                                   path))
+    return mut_df
@@ -0,0 +1,238 @@
+"""This module stores mutations grouped by gene in columnar numpy arrays.
+
+A MutationTable can optionally place its arrays in shared memory, so that
+worker processes attach to the same arrays by name instead of receiving a
+pickled copy of the mutations.
+"""
+import numpy as np
+import pandas as pd
+import pickle
+from multiprocessing import util
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python versions prior to 3.8
+    shared_memory = None
+
+# shared mutation tables already attached in this process
+_attached_tables = {}
+
+
+def _close_attached_tables():
+    """Detaches this process from every shared mutation table."""
+    for mut_table in _attached_tables.values():
+        mut_table.close()
+    _attached_tables.clear()
+
+
+def _tracker_pid():
+    """Gets the pid of the resource tracker started by this process, if any."""
+    return resource_tracker._resource_tracker._pid
+
+
+def _attach_shared_memory(name, tracker_pid):
+    """Attaches to a shared memory block created by another process.
+
+    The block is only unlinked by the process that created it, so it must
+    not be tracked by a resource tracker of this process, which would
+    unlink it once this process exits. Worker processes of a Pool use the
+    resource tracker of their parent, where the block is already
+    registered.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python versions prior to 3.13 always track the block
+        pass
+    shm = shared_memory.SharedMemory(name=name)
+    own_pid = _tracker_pid()
+    if own_pid is not None and own_pid != tracker_pid:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _rebuild_table(state):
+    """Re-creates a MutationTable that was passed to another process.
+
+    Shared tables attach to the shared memory blocks by name, and are only
+    attached once per process. They are detached when the process exits.
+    """
+    if not state['shared']:
+        mut_table = MutationTable.__new__(MutationTable)
+        mut_table.__dict__.update(state)
+        mut_table._init_lookup()
+        return mut_table
+
+    key = state['specs']['Gene'][0]
+    if key not in _attached_tables:
+        if not _attached_tables:
+            # runs on exit of worker processes, unlike atexit with fork
+            util.Finalize(None, _close_attached_tables, exitpriority=0)
+        mut_table = MutationTable.__new__(MutationTable)
+        mut_table.__dict__.update(state)
+        mut_table._shm = []
+        mut_table._arrays = {}
+        for name, (shm_name, dtype, shape) in state['specs'].items():
+            shm = _attach_shared_memory(shm_name, state['tracker_pid'])
+            mut_table._shm.append(shm)
+            mut_table._arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        mut_table._init_lookup()
+        _attached_tables[key] = mut_table
+    return _attached_tables[key]
+
+
+class MutationTable(object):
+    """Mutations sorted by gene and stored as one numpy array per column.
+
+    Numeric columns are stored as is, while other columns are stored as
+    integer codes into a (pickled) array of unique values. Mutations for a
+    gene are retrieved by slicing with precomputed gene offsets.
+    """
+
+    def __init__(self, mut_df, shared=False):
+        """Constructor.
+
+        Parameters
+        ----------
+        mut_df : pd.DataFrame
+            mutations, which must contain a "Gene" column
+        shared : bool, default: False
+            place the arrays in shared memory. The creating process should
+            call unlink once the table is no longer used.
+        """
+        if shared and shared_memory is None:
+            raise ValueError('Shared memory requires python 3.8 or later')
+        self.columns = list(mut_df.columns)
+        self.shared = shared
+        self.categorical = []
+
+        # order mutations by gene, keeping the original order within a gene
+        gene_codes, genes = pd.factorize(mut_df['Gene'])
+        order = np.argsort(gene_codes, kind='mergesort')
+        num_missing = np.sum(gene_codes < 0)
+        gene_cts = np.bincount(gene_codes[gene_codes >= 0], minlength=len(genes))
+        arrays = {'Gene offsets': np.concatenate([[0], np.cumsum(gene_cts)]) + num_missing,
+                  'Row': order}
+
+        # store each column as an array
+        for col in self.columns:
+            vals = mut_df[col].values
+            if vals.dtype.kind in 'biuf':
+                arrays[col] = vals[order]
+            else:
+                codes, uniques = pd.factorize(mut_df[col])
+                arrays[col] = codes[order].astype(np.int32)
+                uniques_pkl = pickle.dumps(np.asarray(uniques, dtype=object),
+                                           protocol=pickle.HIGHEST_PROTOCOL)
+                arrays[col+' values'] = np.frombuffer(uniques_pkl, dtype=np.uint8)
+                self.categorical.append(col)
+
+        if shared:
+            self._shm = []
+            self._arrays = {}
+            self.specs = {}
+            for name, arr in arrays.items():
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                shm_arr = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+                shm_arr[:] = arr
+                self._shm.append(shm)
+                self._arrays[name] = shm_arr
+                self.specs[name] = (shm.name, arr.dtype.str, arr.shape)
+            self.tracker_pid = _tracker_pid()
+        else:
+            self._arrays = arrays
+        self._init_lookup()
+
+    def __reduce__(self):
+        state = {'columns': self.columns,
+                 'shared': self.shared,
+                 'categorical': self.categorical}
+        if self.shared:
+            # only pass the names of the shared memory blocks
+            state['specs'] = self.specs
+            state['tracker_pid'] = self.tracker_pid
+        else:
+            state['_arrays'] = self._arrays
+        return (_rebuild_table, (state,))
+
+    def __contains__(self, gene):
+        return gene in self._gene_ix
+
+    def __len__(self):
+        return len(self._arrays['Row'])
+
+    def _init_lookup(self):
+        """Decodes the unique values of each column and indexes genes."""
+        self._values = {col: pickle.loads(self._arrays[col+' values'].tobytes())
+                        for col in self.categorical}
+        self._gene_ix = {g: i for i, g in enumerate(self._values['Gene'])}
+
+    def _decode(self, col, rows):
+        """Gets the values of a column for a range of rows."""
+        vals = self._arrays[col][rows]
+        if col not in self._values:
+            return vals.copy()
+        uniques = self._values[col]
+        if not len(uniques):
+            return np.full(len(vals), np.nan, dtype=object)
+        decoded = uniques[np.maximum(vals, 0)]
+        decoded[vals < 0] = np.nan
+        return decoded
+
+    def unique(self, col):
+        """Returns the unique values of a column in order of appearance.
+
+        Parameters
+        ----------
+        col : str
+            column name
+
+        Returns
+        -------
+        uniques : np.array
+            unique (non-missing) values
+        """
+        if col in self._values:
+            return self._values[col].copy()
+        return pd.unique(self._arrays[col])
+
+    def gene_mutations(self, gene):
+        """Returns the mutations for a gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+
+        Returns
+        -------
+        gene_df : pd.DataFrame
+            mutations in the gene, indexed by their row number in the
+            original data frame
+        """
+        offsets = self._arrays['Gene offsets']
+        if gene in self._gene_ix:
+            ix = self._gene_ix[gene]
+            rows = slice(offsets[ix], offsets[ix+1])
+        else:
+            rows = slice(0, 0)
+        gene_df = pd.DataFrame({col: self._decode(col, rows)
+                                for col in self.columns},
+                               index=self._arrays['Row'][rows].copy(),
+                               columns=self.columns)
+        return gene_df
+
+    def close(self):
+        """Detaches from the shared memory."""
+        if self.shared:
+            self._arrays = {}
+            for shm in self._shm:
+                shm.close()
+
+    def unlink(self):
+        """Detaches and frees the shared memory. Should only be called
+        by the process that created the table."""
+        if self.shared:
+            self.close()
+            for shm in self._shm:
+                shm.unlink()
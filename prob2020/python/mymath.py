@@ -85,6 +85,98 @@ def normalized_mutation_entropy(counts, total_cts=None):
     return norm_ent
 
 
+def xlog2x(x):
+    """Calculates x*log2(x), which is zero for x equal to zero.
+
+    Parameters
+    ----------
+    x : np.array
+        array of non-negative values
+
+    Returns
+    -------
+    x*log2(x) for each element
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x > 0, x * np.log2(x), 0.)
+
+
+def normalized_mutation_entropy_batch(counts_ent, total_cts):
+    """Array-based version of normalized_mutation_entropy.
+
+    Uses that the entropy of the counts, c, is log2(n) - sum(c*log2(c))/n,
+    where n is the total number of mutations, so only the sum of
+    c*log2(c) is needed for each distribution of mutation counts.
+
+    Parameters
+    ----------
+    counts_ent : np.array
+        sum of c*log2(c) over the mutation counts of each distribution
+    total_cts : np.array
+        total mutation counts of each distribution
+
+    Returns
+    -------
+    norm_ent : np.array
+        normalized entropy of each mutation count distribution.
+    """
+    total_cts = np.asarray(total_cts, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        max_ent = np.log2(total_cts)
+        norm_ent = (max_ent - counts_ent / total_cts) / max_ent
+    return np.where(total_cts > 1, norm_ent, 1.0)
+
+
+def poisson_binomial_pmf(probs, counts=None, max_direct=2e8):
+    """Calculates the distribution of the number of successes among
+    independent trials with different success probabilities.
+
+    The distributions of pairs of trials are convolved, level by level,
+    until a single distribution remains. Convolutions are computed as
+    direct sums, which keep the precision of very small probabilities,
+    unless the work becomes too large, in which case an FFT is used.
+
+    Parameters
+    ----------
+    probs : np.array
+        success probability of each group of trials
+    counts : np.array or None, default: None
+        number of trials in each group, one trial per group if None
+    max_direct : float, default: 2e8
+        maximum number of operations of a level computed as direct sums
+
+    Returns
+    -------
+    pmf : np.array
+        probability of each number of successes, from zero to the total
+        number of trials
+    """
+    probs = np.asarray(probs, dtype=float)
+    if counts is not None:
+        probs = np.repeat(probs, counts)
+    num_trials = len(probs)
+
+    # pad to a power of two with trials that never succeed
+    num_rows = 1 << int(np.ceil(np.log2(max(num_trials, 1))))
+    pmf = np.zeros((num_rows, 2))
+    pmf[:, 0] = 1
+    pmf[:num_trials, 0] = 1 - probs
+    pmf[:num_trials, 1] = probs
+
+    while len(pmf) > 1:
+        left, right = pmf[0::2], pmf[1::2]
+        num_rows, n = left.shape
+        if num_rows * n * n <= max_direct:
+            pmf = np.zeros((num_rows, 2*n))
+            for j in range(n):
+                pmf[:, j:j+n] += left[:, j:j+1] * right
+        else:
+            pmf = np.fft.irfft(np.fft.rfft(left, 2*n) * np.fft.rfft(right, 2*n), 2*n)
+            pmf = np.maximum(pmf, 0)
+    return pmf[0, :num_trials+1]
+
+
 def kl_divergence(p, q):
     """Compute the Kullback-Leibler (KL) divergence for discrete distributions.
 
@@ -17,11 +17,52 @@ logger = logging.getLogger(__name__)  # module logger
 
 def fishers_method(pvals):
     """Fisher's method for combining independent p-values."""
-    pvals = np.asarray(pvals)
-    degrees_of_freedom = 2 * pvals.size
-    chisq_stat = np.sum(-2*np.log(pvals))
-    fishers_pval = stats.chi2.sf(chisq_stat, degrees_of_freedom)
-    return fishers_pval
+    pvals = np.asarray(pvals, dtype=float)
+    return combine_p_values(pvals.reshape(1, -1), method='fisher')[0]
+
+
+def combine_p_values(pvals, method='fisher', weights=None):
+    """Combines the p-values of several tests for each gene.
+
+    Rows containing a NaN p-value have a NaN combined p-value.
+
+    Parameters
+    ----------
+    pvals : np.array or pd.DataFrame
+        num genes X num tests array of p-values
+    method : str, default='fisher'
+        'fisher' for Fisher's method, 'stouffer' for Stouffer's Z-score
+        method, or 'cauchy' for the Cauchy combination test, which is
+        robust to dependence between tests
+    weights : list or None, default=None
+        weight of each test for the stouffer and cauchy methods, equal
+        weights if None
+
+    Returns
+    -------
+    combined_pval : np.array
+        combined p-value for each gene
+    """
+    pvals = np.asarray(pvals, dtype=float)
+    num_tests = pvals.shape[1]
+    if weights is None:
+        weights = np.ones(num_tests)
+    weights = np.asarray(weights, dtype=float)
+
+    if method == 'fisher':
+        chisq_stat = np.sum(-2*np.log(pvals), axis=1)
+        combined_pval = stats.chi2.sf(chisq_stat, 2*num_tests)
+    elif method == 'stouffer':
+        z = stats.norm.isf(pvals).dot(weights) / np.sqrt(np.sum(weights**2))
+        combined_pval = stats.norm.sf(z)
+    elif method == 'cauchy':
+        # tan((.5-p)*pi) written to stay accurate for small p-values
+        weights = weights / weights.sum()
+        cauchy_stat = (1. / np.tan(np.pi*pvals)).dot(weights)
+        combined_pval = np.arctan2(1., cauchy_stat) / np.pi
+    else:
+        raise ValueError('Unknown method for combining p-values: {0}'.format(method))
+    return combined_pval
 
 
 def cummin(x):
@@ -32,6 +73,57 @@ def cummin(x):
     return x
 
 
+def p_adjust(pvals, method='BH'):
+    """Adjusts p-values for multiple testing, like p.adjust in R.
+
+    Each column is adjusted separately. NaN p-values are not counted as
+    tests and remain NaN.
+
+    Parameters
+    ----------
+    pvals : list, np.array or pd.DataFrame
+        p-values, either a vector or a num genes X num tests array
+    method : str, default='BH'
+        'BH' for the Benjamini-Hochberg FDR or 'BY' for the
+        Benjamini-Yekutieli FDR
+
+    Returns
+    -------
+    pval_adj : np.array
+        adjusted p-values with the same shape as the input
+    """
+    pval_array = np.array(pvals, dtype=float)
+    is_vector = pval_array.ndim == 1
+    if is_vector:
+        pval_array = pval_array.reshape(-1, 1)
+    is_nan = np.isnan(pval_array)
+
+    # sort each column, NaN p-values are placed last
+    sorted_order = np.argsort(pval_array, axis=0, kind='mergesort')
+    sorted_pval = np.take_along_axis(pval_array, sorted_order, axis=0)
+    n = (~is_nan).sum(axis=0).astype(float)
+    rank = np.arange(1, len(pval_array)+1, dtype=float).reshape(-1, 1)
+    if method == 'BH':
+        scale = n
+    elif method == 'BY':
+        inv_rank_cumsum = np.concatenate([[0], np.cumsum(1. / rank[:, 0])])
+        scale = n * inv_rank_cumsum[n.astype(int)]
+    else:
+        raise ValueError('Unknown p-value adjustment method: {0}'.format(method))
+
+    # cumulative minimum from the largest p-value, skipping NaN
+    scaled_pval = scale/rank * sorted_pval
+    sorted_adj = np.minimum(1, np.fmin.accumulate(scaled_pval[::-1], axis=0))[::-1]
+
+    # put back into the original order
+    pval_adj = np.empty_like(pval_array)
+    np.put_along_axis(pval_adj, sorted_order, sorted_adj, axis=0)
+    pval_adj[is_nan] = np.nan
+    if is_vector:
+        pval_adj = pval_adj[:, 0]
+    return pval_adj
+
+
 def bh_fdr(pval):
     """A python implementation of the Benjamani-Hochberg FDR method.
 
@@ -48,17 +140,7 @@ def bh_fdr(pval):
     pval_adj : np.array
         adjusted p-values according the benjamani-hochberg method
     """
-    pval_array = np.array(pval)
-    sorted_order = np.argsort(pval_array)
-    original_order = np.argsort(sorted_order)
-    pval_array = pval_array[sorted_order]
-
-    # calculate the needed alpha
-    n = float(len(pval))
-    pval_adj = np.zeros(int(n))
-    i = np.arange(1, int(n)+1, dtype=float)[::-1]  # largest to smallest
-    pval_adj = np.minimum(1, cummin(n/i * pval_array[::-1]))[::-1]
-    return pval_adj[original_order]
+    return p_adjust(pval, method='BH')
 
 
 def calc_deleterious_p_value(mut_info,
@@ -70,10 +152,15 @@ def calc_deleterious_p_value(mut_info,
                              stop_thresh,
                              del_threshold,
                              pseudo_count,
-                             seed=None):
+                             seed=None,
+                             signif_level=None,
+                             conf_level=.99,
+                             exact=False):
     """Calculates the p-value for the number of inactivating SNV mutations.
 
-    Calculates p-value based on how many simulations exceed the observed value.
+    Calculates p-value based on how many simulations exceed the observed value,
+    or, in exact mode, from the exact null distribution of the number of
+    inactivating mutations (see permutation.deleterious_exact).
 
     Parameters
     ----------
@@ -99,11 +186,22 @@ def calc_deleterious_p_value(mut_info,
         means more precision on the p-value.
     seed : int (Default: None)
         seed number to random number generator (None to be randomly set)
+    signif_level : float (Default: None)
+        significance level to stop simulations once the p-value is clearly
+        above or below it. If provided, the confidence interval of the
+        p-value is added to the result.
+    conf_level : float (Default: .99)
+        confidence level of the p-value interval
+    exact : bool (Default: False)
+        compute the exact p-value instead of performing simulations. The
+        p-value interval is then the p-value itself.
     """
     #prng = np.random.RandomState(seed)
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if 'Context' not in mut_info.columns:
+            # SNVs from the annotated cache already have contexts
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -125,7 +223,14 @@ def calc_deleterious_p_value(mut_info,
 
         # skip permutation test if number of deleterious mutations is not at
         # least meet some user-specified threshold
-        if num_del >= del_threshold:
+        if num_del >= del_threshold and exact:
+            del_p_value = pm.deleterious_exact(num_del,
+                                               context_cts,
+                                               context_to_mutations,
+                                               sc,  # sequence context obj
+                                               gs)  # gene sequence obj
+            del_interval = (del_p_value, del_p_value)
+        elif num_del >= del_threshold:
             # perform permutations
             del_p_value = pm.deleterious_permutation(num_del,
                                                      context_cts,
@@ -134,14 +239,22 @@ def calc_deleterious_p_value(mut_info,
                                                      gs,  # gene sequence obj
                                                      num_permutations,
                                                      stop_thresh,
-                                                     pseudo_count)
+                                                     pseudo_count,
+                                                     signif_level=signif_level,
+                                                     conf_level=conf_level)
+            if signif_level is not None:
+                del_p_value, del_interval = del_p_value
         else:
             del_p_value = None
+            del_interval = (None, None)
     else:
         num_del = 0
         del_p_value = None
+        del_interval = (None, None)
 
     result = [bed.gene_name, num_del, del_p_value]
+    if signif_level is not None:
+        result += list(del_interval)
     return result
 
 
@@ -155,10 +268,14 @@ def calc_position_p_value(mut_info,
                           stop_thresh,
                           pseudo_count,
                           min_recurrent,
-                          min_fraction):
+                          min_fraction,
+                          signif_level=None,
+                          conf_level=.99):
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if 'Context' not in mut_info.columns:
+            # SNVs from the annotated cache already have contexts
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -204,16 +321,24 @@ def calc_position_p_value(mut_info,
                                                      gene_vest,
                                                      num_permutations,
                                                      stop_thresh,
-                                                     pseudo_count)
-        ent_p_value, vest_p_value = permutation_result
+                                                     pseudo_count,
+                                                     signif_level=signif_level,
+                                                     conf_level=conf_level)
+        if signif_level is not None:
+            ent_p_value, vest_p_value, ent_interval, vest_interval = permutation_result
+        else:
+            ent_p_value, vest_p_value = permutation_result
     else:
         num_recurrent = 0
         pos_ent = 0
         vest_score = 0.0
         ent_p_value = 1.0
         vest_p_value = 1.0
+        ent_interval = vest_interval = (np.nan, np.nan)
     result = [bed.gene_name, num_recurrent, pos_ent, vest_score,
               ent_p_value, vest_p_value]
+    if signif_level is not None:
+        result += list(ent_interval) + list(vest_interval)
     return result
 
 
@@ -226,10 +351,14 @@ def calc_hotmaps_p_value(mut_info,
                          num_permutations,
                          stop_thresh,
                          report_index=False,
-                         null_save_path=None):
+                         null_save_path=None,
+                         signif_level=None,
+                         conf_level=.99):
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if 'Context' not in mut_info.columns:
+            # SNVs from the annotated cache already have contexts
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -269,7 +398,11 @@ def calc_hotmaps_p_value(mut_info,
                                            window_size,
                                            num_permutations,
                                            stop_thresh,
-                                           null_save_path=null_save_path)
+                                           null_save_path=null_save_path,
+                                           signif_level=signif_level,
+                                           conf_level=conf_level)
+        if signif_level is not None:
+            pval_dict, interval_dict = pval_dict
 
         # prepare output
         # NOTE: internally codon positions start at 0, so add 1 for the output
@@ -283,6 +416,11 @@ def calc_hotmaps_p_value(mut_info,
                       for mywin in window_sum_dict
                       for k in window_sum_dict[mywin]]
 
+        # add the confidence interval of the p-values
+        if signif_level is not None:
+            result = [row + list(interval_dict[row[1]][row[2]-1])
+                      for row in result]
+
     else:
         result = []
     return result
@@ -312,7 +450,9 @@ def calc_protein_p_value(mut_info,
     """
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if 'Context' not in mut_info.columns:
+            # SNVs from the annotated cache already have contexts
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
@@ -380,7 +520,9 @@ def calc_effect_p_value(mut_info,
                         min_fraction):
     if len(mut_info) > 0:
         mut_info['Coding Position'] = mut_info['Coding Position'].astype(int)
-        mut_info['Context'] = mut_info['Coding Position'].apply(lambda x: sc.pos2context[x])
+        if 'Context' not in mut_info.columns:
+            # SNVs from the annotated cache already have contexts
+            mut_info['Context'] = sc.get_contexts(mut_info['Coding Position'])
 
         # group mutations by context
         cols = ['Context', 'Tumor_Allele']
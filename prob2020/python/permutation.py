@@ -1,9 +1,141 @@
 import numpy as np
-import csv
+import pandas as pd
+import scipy.stats as stats
 import prob2020.python.utils as utils
 from ..cython import cutils
 import prob2020.python.mutation_context as mc
 import prob2020.python.scores as scores
+import prob2020.python.batch_stats as batch_stats
+import prob2020.python.mymath as mymath
+from prob2020.python.empirical_null import EmpiricalNull
+
+
+def _count_null_hits(null_cts, is_null_hit, stop_criteria):
+    """Adds a batch of simulations to the empirical null distribution counts.
+
+    Simulations are counted up to the same simulation as when the stop
+    criteria is checked after every single simulation, i.e. the first one
+    where all of the counts reach stop_criteria.
+
+    Parameters
+    ----------
+    null_cts : list of int
+        number of simulations so far as or more extreme than the observed
+        value, one for each statistic
+    is_null_hit : list of np.array
+        flag for each simulation in the batch indicating whether it is as or
+        more extreme than the observed value, one for each statistic
+    stop_criteria : int
+        stop after stop_criteria simulations are more significant
+        then the observed statistic.
+
+    Returns
+    -------
+    null_cts : list of int
+        updated null distribution counts
+    num_sim : int
+        number of simulations in the batch that were used
+    """
+    cum_cts = [ct + np.cumsum(hit) for ct, hit in zip(null_cts, is_null_hit)]
+    batch_size = len(cum_cts[0])
+    i = min(np.searchsorted(np.minimum.reduce(cum_cts), stop_criteria), batch_size-1)
+    null_cts = [int(ct[i]) for ct in cum_cts]
+    return null_cts, i+1
+
+
+def clopper_pearson(num_hits, num_sim, conf_level=.99):
+    """Calculates the Clopper-Pearson confidence interval of a monte carlo
+    p-value.
+
+    Parameters
+    ----------
+    num_hits : int or np.array
+        number of simulations as or more extreme than the observed value
+    num_sim : int
+        number of simulations
+    conf_level : float, default: .99
+        confidence level of the interval
+
+    Returns
+    -------
+    lower : float or np.array
+        lower bound of the p-value
+    upper : float or np.array
+        upper bound of the p-value
+    """
+    num_hits = np.asarray(num_hits, dtype=float)
+    alpha = 1 - conf_level
+    lower = stats.beta.ppf(alpha / 2, np.maximum(num_hits, 1), num_sim - num_hits + 1)
+    upper = stats.beta.ppf(1 - alpha / 2, num_hits + 1, np.maximum(num_sim - num_hits, 1))
+    lower = np.where(num_hits == 0, 0., lower)
+    upper = np.where(num_hits == num_sim, 1., upper)
+    if lower.ndim == 0:
+        return float(lower), float(upper)
+    return lower, upper
+
+
+def get_sequential_opts(opts):
+    """Gets the significance and confidence level of the sequential mode
+    specified in the options.
+
+    Parameters
+    ----------
+    opts : dict
+        options, optionally containing "sequential_threshold" and
+        "sequential_confidence"
+
+    Returns
+    -------
+    signif_level : float or None
+        significance level to stop simulations, None if sequential mode
+        is not used
+    conf_level : float
+        confidence level of the p-value intervals (default: .99)
+    """
+    signif_level = None
+    if 'sequential_threshold' in opts and opts['sequential_threshold'] is not None:
+        signif_level = opts['sequential_threshold']
+    conf_level = .99
+    if 'sequential_confidence' in opts and opts['sequential_confidence']:
+        conf_level = opts['sequential_confidence']
+    return signif_level, conf_level
+
+
+def _is_decided(null_cts, num_sim, signif_level, conf_level):
+    """Checks whether the confidence interval of every p-value lies entirely
+    above or below the significance level."""
+    if not num_sim:
+        return False
+    lower, upper = clopper_pearson(null_cts, num_sim, conf_level)
+    return bool(np.all((lower > signif_level) | (upper < signif_level)))
+
+
+def _batch_sizes(num_permutations, max_batch, signif_level=None,
+                 initial_batch=100):
+    """Splits the simulations into batches of at most max_batch simulations.
+
+    In sequential mode (signif_level is not None), the batches start at
+    initial_batch simulations and double in size, so that the p-value can be
+    checked against the significance level after a small number of
+    simulations.
+    """
+    max_batch = min(num_permutations, max_batch)
+    if signif_level is None:
+        num_batches = num_permutations // max_batch
+        remainder = num_permutations % max_batch
+        batch_sizes = [max_batch] * num_batches
+        if remainder:
+            batch_sizes += [remainder]
+        return batch_sizes
+
+    batch_sizes = []
+    batch_size = min(initial_batch, max_batch)
+    num_left = num_permutations
+    while num_left > 0:
+        batch_sizes.append(min(batch_size, num_left))
+        num_left -= batch_sizes[-1]
+        batch_size = min(2*batch_size, max_batch)
+    return batch_sizes
 
 
 def deleterious_permutation(obs_del,
@@ -14,10 +146,16 @@ def deleterious_permutation(obs_del,
                             num_permutations=10000,
                             stop_criteria=100,
                             pseudo_count=0,
-                            max_batch=25000):
+                            max_batch=25000,
+                            signif_level=None,
+                            conf_level=.99):
     """Performs null-permutations for deleterious mutation statistics
     in a single gene.
 
+    In sequential mode (signif_level is provided), simulations are performed
+    in geometrically growing batches and stop once the Clopper-Pearson
+    interval of the p-value lies entirely above or below signif_level.
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -37,11 +175,18 @@ def deleterious_permutation(obs_del,
         Pseudo-count for number of deleterious mutations for each
         permutation of the null distribution. Increasing pseudo_count
         makes the statistical test more stringent.
+    signif_level : float or None, default: None
+        significance level used to stop the simulations in sequential mode.
+        If None, simulations only stop by the stop_criteria.
+    conf_level : float, default: .99
+        confidence level of the p-value interval in sequential mode
 
     Returns
     -------
-    del_count_list : list
-        list of deleterious mutation counts under the null
+    del_pval : float
+        p-value for the number of deleterious mutations
+    del_interval : tuple, (lower, upper)
+        confidence interval of the p-value, only returned in sequential mode
     """
     mycontexts = context_counts.index.tolist()
     somatic_base = [base
@@ -49,12 +194,7 @@ def deleterious_permutation(obs_del,
                     for base in context_to_mut[one_context]]
 
     # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    batch_sizes = _batch_sizes(num_permutations, max_batch, signif_level)
 
     num_sim = 0
     null_del_ct = 0
@@ -63,36 +203,131 @@ def deleterious_permutation(obs_del,
         if null_del_ct >= stop_criteria:
             #j = j - 1
             break
+        if signif_level is not None and _is_decided([null_del_ct], num_sim,
+                                                    signif_level, conf_level):
+            break
 
         # get random positions determined by sequence context
         tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
                                                 batch_size)
         tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
-        # determine result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calc deleterious mutation info
-            tmp_del_count = cutils.calc_deleterious_info(tmp_mut_info['Reference AA'],
-                                                         tmp_mut_info['Somatic AA'],
-                                                         tmp_mut_info['Codon Pos'])
+        # determine result of random positions for the whole batch
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                                somatic_base,
+                                                gene_seq)
+        tmp_del_count = batch_stats.calc_deleterious_info(tmp_mut_info['Effect'])
 
-            # update empricial null distribution
-            if tmp_del_count >= obs_del: null_del_ct += 1
+        # update empricial null distribution
+        null_cts, tmp_num_sim = _count_null_hits([null_del_ct],
+                                                 [tmp_del_count >= obs_del],
+                                                 stop_criteria)
+        null_del_ct = null_cts[0]
 
-            # stop if reach sufficient precision on p-value
-            if null_del_ct >= stop_criteria:
-                break
         # update number of simulations
-        num_sim += i + 1
+        num_sim += tmp_num_sim
 
     #num_sim = j*max_batch + i+1
     del_pval = float(null_del_ct) / (num_sim)
 
+    if signif_level is not None:
+        return del_pval, clopper_pearson(null_del_ct, num_sim, conf_level)
+    return del_pval
+
+
+def effect_fractions(contexts, somatic_base, seq_context, gene_seq):
+    """Calculates the probability of each variant classification for
+    mutations placed at a random position with the same sequence context.
+
+    Parameters
+    ----------
+    contexts : list of str
+        sequence context of each mutation
+    somatic_base : list of str
+        somatic base of each mutation
+    seq_context : SequenceContext
+        Sequence context for the entire gene sequence
+    gene_seq : GeneSequence
+        Sequence of gene of interest
+
+    Returns
+    -------
+    effect_frac : np.array
+        num mutations X len(utils.variant_snv) array with the fraction of
+        positions with the mutation's context where its somatic base results
+        in each variant classification (see utils.effect_code). Rows sum to
+        less than one if the effect of some positions can not be determined.
+    """
+    effect = gene_seq.get_effect_table()['Effect']
+    num_effects = len(utils.variant_snv)
+    contexts = np.asarray(contexts, dtype=object)
+    base_code = np.array([utils.nuc_code.get(b, utils.nuc_code['N'])
+                          for b in somatic_base], dtype=int)
+
+    effect_frac = np.zeros((len(contexts), num_effects))
+    for one_context in pd.unique(contexts):
+        # count each effect for every base, with missing effects in the last column
+        context_effect = effect[seq_context.context_positions(one_context)]
+        context_effect = np.where(context_effect < 0, num_effects, context_effect)
+        context_frac = np.stack([np.bincount(e, minlength=num_effects+1)
+                                 for e in context_effect.T]) / float(len(context_effect))
+
+        is_context = contexts == one_context
+        effect_frac[is_context] = context_frac[base_code[is_context], :num_effects]
+    return effect_frac
+
+
+def deleterious_exact(obs_del,
+                      context_counts,
+                      context_to_mut,
+                      seq_context,
+                      gene_seq):
+    """Calculates the exact p-value for the number of deleterious mutations
+    in a single gene.
+
+    Under the null model of deleterious_permutation, each mutation is
+    independently placed at a random position with the same sequence
+    context, so it is deleterious with probability equal to the fraction
+    of those positions where its somatic base is deleterious. The number
+    of deleterious mutations therefore follows a Poisson binomial
+    distribution, which is computed directly instead of being simulated.
+
+    Parameters
+    ----------
+    obs_del : int
+        observed number of deleterious mutations
+    context_counts : pd.Series
+        number of mutations for each context
+    context_to_mut : dict
+        dictionary mapping nucleotide context to a list of observed
+        somatic base changes.
+    seq_context : SequenceContext
+        Sequence context for the entire gene sequence (regardless
+        of where mutations occur).
+    gene_seq : GeneSequence
+        Sequence of gene of interest
+
+    Returns
+    -------
+    del_pval : float
+        p-value for the number of deleterious mutations
+    """
+    mycontexts = context_counts.index.tolist()
+    contexts = [one_context
+                for one_context in mycontexts
+                for base in context_to_mut[one_context]]
+    somatic_base = [base
+                    for one_context in mycontexts
+                    for base in context_to_mut[one_context]]
+
+    # probability of each mutation to be deleterious
+    effect_frac = effect_fractions(contexts, somatic_base, seq_context, gene_seq)
+    is_del = batch_stats.is_deleterious(np.arange(effect_frac.shape[1]))
+    del_prob = effect_frac[:, is_del].sum(axis=1)
+
+    # probability of at least the observed number of deleterious mutations
+    null_pmf = mymath.poisson_binomial_pmf(del_prob)
+    del_pval = min(null_pmf[obs_del:][::-1].sum(), 1.0)
     return del_pval
 
 
@@ -105,10 +340,17 @@ def position_permutation(obs_stat,
                          num_permutations=10000,
                          stop_criteria=100,
                          pseudo_count=0,
-                         max_batch=25000):
+                         max_batch=25000,
+                         signif_level=None,
+                         conf_level=.99):
     """Performs null-permutations for position-based mutation statistics
     in a single gene.
 
+    In sequential mode (signif_level is provided), simulations are performed
+    in geometrically growing batches and stop once the Clopper-Pearson
+    intervals of both the entropy and VEST p-values lie entirely above or
+    below signif_level.
+
     Parameters
     ----------
     obs_stat : tuple, (recur ct, entropy, delta entropy, mean vest)
@@ -133,13 +375,24 @@ def position_permutation(obs_stat,
         Pseudo-count for number of recurrent missense mutations for each
         permutation for the null distribution. Increasing pseudo_count
         makes the statistical test more stringent.
+    signif_level : float or None, default: None
+        significance level used to stop the simulations in sequential mode.
+        If None, simulations only stop by the stop_criteria.
+    conf_level : float, default: .99
+        confidence level of the p-value intervals in sequential mode
 
     Returns
     -------
-    num_recur_list : list
-        list of recurrent mutation counts under the null
-    entropy_list : list
-        list of position entropy values under the null
+    ent_pval : float
+        p-value for the missense position entropy
+    vest_pval : float
+        p-value for the mean VEST score
+    ent_interval : tuple, (lower, upper)
+        confidence interval of the entropy p-value, only returned in
+        sequential mode
+    vest_interval : tuple, (lower, upper)
+        confidence interval of the VEST p-value, only returned in
+        sequential mode
     """
     # get contexts and somatic base
     mycontexts = context_counts.index.tolist()
@@ -148,12 +401,7 @@ def position_permutation(obs_stat,
                     for base in context_to_mut[one_context]]
 
     # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    batch_sizes = _batch_sizes(num_permutations, max_batch, signif_level)
 
     obs_recur, obs_ent, obs_delta_ent, obs_vest = obs_stat
     num_sim = 0 # number of simulations
@@ -162,48 +410,50 @@ def position_permutation(obs_stat,
         # stop iterations if reached sufficient precision
         if null_vest_ct >= stop_criteria and null_entropy_ct >= stop_criteria:
             break
+        if signif_level is not None and _is_decided([null_entropy_ct, null_vest_ct],
+                                                    num_sim, signif_level, conf_level):
+            break
 
         # get random positions determined by sequence context
         tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
                                                 batch_size)
         tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
-        # calculate position-based statistics as a result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calculate position info
-            tmp_recur_ct, tmp_entropy, tmp_delta_entropy, _ = cutils.calc_pos_info(tmp_mut_info['Codon Pos'],
-                                                                                tmp_mut_info['Reference AA'],
-                                                                                tmp_mut_info['Somatic AA'],
-                                                                                pseudo_count=pseudo_count,
-                                                                                is_obs=0)
-            # get vest scores
-            if gene_vest:
-                tmp_vest = scores.compute_vest_stat(gene_vest,
-                                                    tmp_mut_info['Reference AA'],
-                                                    tmp_mut_info['Somatic AA'],
-                                                    tmp_mut_info['Codon Pos'])
-            else:
-                tmp_vest = 0.0
+        # calculate position-based statistics for the whole batch
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                                somatic_base,
+                                                gene_seq)
+        tmp_recur_ct, tmp_entropy, tmp_delta_entropy = batch_stats.calc_pos_info(tmp_mut_info['Codon Pos'],
+                                                                                 tmp_mut_info['Effect'],
+                                                                                 pseudo_count=pseudo_count,
+                                                                                 is_obs=0)
+        # get vest scores
+        if gene_vest:
+            tmp_vest = scores.compute_vest_stat_batch(gene_vest,
+                                                      tmp_mut_info['Reference AA'],
+                                                      tmp_mut_info['Somatic AA'],
+                                                      tmp_mut_info['Codon Pos'])
+        else:
+            tmp_vest = np.zeros(batch_size)
 
-            # update empirical null distribution counts
-            if tmp_entropy-utils.epsilon <= obs_ent: null_entropy_ct += 1
-            if tmp_vest+utils.epsilon >= obs_vest: null_vest_ct += 1
+        # update empirical null distribution counts
+        null_cts, tmp_num_sim = _count_null_hits([null_entropy_ct, null_vest_ct],
+                                                 [tmp_entropy-utils.epsilon <= obs_ent,
+                                                  tmp_vest+utils.epsilon >= obs_vest],
+                                                 stop_criteria)
+        null_entropy_ct, null_vest_ct = null_cts
 
-            # stop iterations if reached sufficient precision
-            if null_vest_ct >= stop_criteria and null_entropy_ct >= stop_criteria:
-                break
         # update the number of simulations
-        num_sim += i+1
+        num_sim += tmp_num_sim
 
     # calculate p-value from empirical null-distribution
     ent_pval = float(null_entropy_ct) / (num_sim)
     vest_pval = float(null_vest_ct) / (num_sim)
 
+    if signif_level is not None:
+        ent_interval = clopper_pearson(null_entropy_ct, num_sim, conf_level)
+        vest_interval = clopper_pearson(null_vest_ct, num_sim, conf_level)
+        return ent_pval, vest_pval, ent_interval, vest_interval
     return ent_pval, vest_pval
 
 
@@ -216,10 +466,18 @@ def hotmaps_permutation(obs_stat,
                         num_permutations=10000,
                         stop_criteria=100,
                         max_batch=25000,
-                        null_save_path=None):
+                        null_save_path=None,
+                        signif_level=None,
+                        conf_level=.99,
+                        empirical_null=None):
     """Performs null-permutations for position-based mutation statistics
     in a single gene.
 
+    In sequential mode (signif_level is provided), simulations are performed
+    in geometrically growing batches and stop once the Clopper-Pearson
+    intervals of the p-values for every codon lie entirely above or below
+    signif_level.
+
     Parameters
     ----------
     obs_stat : dict
@@ -250,11 +508,23 @@ def hotmaps_permutation(obs_stat,
         can get quite large.
     null_save_path : str or None
         File path to save null distribution. If None, don't save it.
+    signif_level : float or None, default: None
+        significance level used to stop the simulations in sequential mode.
+        If None, simulations only stop by the stop_criteria.
+    conf_level : float, default: .99
+        confidence level of the p-value intervals in sequential mode
+    empirical_null : EmpiricalNull or None, default: None
+        histograms of windowed sums from previous simulations of the same
+        gene, which are updated in place with the new simulations. If None,
+        the null distribution starts empty.
 
     Returns
     -------
     pvals : dict
         Maps mutated codon position to the calculated p-value
+    intervals : dict
+        Maps mutated codon position to the confidence interval (lower, upper)
+        of the p-value, only returned in sequential mode
     """
     # get contexts and somatic base
     mycontexts = context_counts.index.tolist()
@@ -263,97 +533,76 @@ def hotmaps_permutation(obs_stat,
                     for base in context_to_mut[one_context]]
 
     # calculate the # of batches for simulations
-    max_batch = min(num_permutations, max_batch)
-    num_batches = num_permutations // max_batch
-    remainder = num_permutations % max_batch
-    batch_sizes = [max_batch] * num_batches
-    if remainder:
-        batch_sizes += [remainder]
+    batch_sizes = _batch_sizes(num_permutations, max_batch, signif_level)
 
     # figure out which position has highest value
     max_key = {w: max(obs_stat[w], key=(lambda key: obs_stat[w][key]))
                for w in window}
 
-    # setup null dist counts
-    null_cts = {w: {k: 0 for k in obs_stat[w]}
-                for w in window }
+    # observed windowed sums
+    obs_keys = {w: list(obs_stat[w]) for w in window}
+    obs_vals = {w: np.array([obs_stat[w][k] for k in obs_keys[w]])
+                for w in window}
 
-    # empirical null distribution (saved if file path provided)
-    empirical_null = {w: {} for w in window}
+    # empirical null distribution, bounded by the number of mutations
+    if empirical_null is None:
+        empirical_null = EmpiricalNull(window, len(somatic_base))
 
-    num_sim = 0 # number of simulations
     for j, batch_size in enumerate(batch_sizes):
         # stop iterations if reached sufficient precision
-        # stop iterations if reached sufficient precision
-        stop_flag = [(null_cts[w][max_key[w]]>=stop_criteria)
-                      for w in window]
-        if all(stop_flag):
+        null_cts = {w: empirical_null.tail_counts(w, obs_vals[w]) for w in window}
+        max_cts = [empirical_null.tail_counts(w, [obs_stat[w][max_key[w]]])[0]
+                   for w in window]
+        if all(ct >= stop_criteria for ct in max_cts):
+            break
+        if signif_level is not None and _is_decided(np.concatenate([null_cts[w] for w in window]),
+                                                    empirical_null.num_sim(window[0]),
+                                                    signif_level, conf_level):
             break
-        #if null_cts[max_key] >= stop_criteria:
-            #break
 
         # get random positions determined by sequence context
         tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
                                                 batch_size)
         tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
-        # calculate position-based statistics as a result of random positions
-        for i, row in enumerate(tmp_mut_pos):
-            # get info about mutations
-            tmp_mut_info = mc.get_aa_mut_info(row,
-                                              somatic_base,
-                                              gene_seq)
-
-            # calculate position info
-            tmp_pos, tmp_sim = utils.calc_windowed_sum(tmp_mut_info['Codon Pos'],
-                                                 tmp_mut_info['Reference AA'],
-                                                 tmp_mut_info['Somatic AA'],
-                                                 window)
-
-            # update the counts when the empirical null passes the observed
-            for tmp_w in tmp_sim:
-                for tmp_key in tmp_sim[tmp_w]:
-                    # get mutation count for simulation
-                    val = tmp_sim[tmp_w][tmp_key]
-
-                    # add to empirical null distribution
-                    empirical_null[tmp_w].setdefault(val, 0)
-                    empirical_null[tmp_w][val] += 1
-
-                    # update counts used for p-value
-                    for key in null_cts[tmp_w]:
-                        if val >= obs_stat[tmp_w][key]:
-                            null_cts[tmp_w][key] += 1
-
-            # update the number of simulations
-            num_sim += len(tmp_pos)
-
-            # stop iterations if reached sufficient precision
-            stop_flag = [(null_cts[w][max_key[w]]>=stop_criteria)
-                         for w in window]
-            if all(stop_flag):
-                break
+        # calculate windowed sums for the whole batch
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                                somatic_base,
+                                                gene_seq)
+        tmp_sim, tmp_ct, tmp_sum = batch_stats.calc_windowed_sum(tmp_mut_info['Codon Pos'],
+                                                                 tmp_mut_info['Reference AA'],
+                                                                 tmp_mut_info['Somatic AA'],
+                                                                 window)
+
+        # only use simulations up to where the stop criteria is reached
+        max_hits = [np.bincount(tmp_sim, weights=tmp_sum[w]>=obs_stat[w][max_key[w]],
+                                minlength=batch_size)
+                    for w in window]
+        _, tmp_num_rows = _count_null_hits(max_cts, max_hits, stop_criteria)
+        is_used = tmp_sim < tmp_num_rows
+
+        # add to empirical null distribution
+        for w in window:
+            empirical_null.add(w, tmp_sum[w][is_used])
 
     # calculate p-value from empirical null-distribution
-    pvals = {w: {k: float(null_cts[w][k]) / (num_sim) for k in obs_stat[w]}
-             for w in window}
+    pvals = {}
+    for w in window:
+        tmp_pvals = empirical_null.p_values(w, obs_vals[w])
+        pvals[w] = dict(zip(obs_keys[w], tmp_pvals.tolist()))
 
     # save empirical distribution
     if null_save_path:
-        for w in window:
-            # create null distribution
-            output = [['mutation_count', 'p-value']]
-            sorted_cts = sorted(empirical_null[w].keys())
-            tmp_sum = 0
-            for i in range(len(sorted_cts)):
-                tmp_sum += empirical_null[w][sorted_cts[-(i+1)]]
-                tmp_pval = tmp_sum / float(num_sim)
-                output.append([sorted_cts[-(i+1)], tmp_pval])
-            # save output
-            with open(null_save_path.format(w), 'w') as handle:
-                mywriter = csv.writer(handle, delimiter='\t', lineterminator='\n')
-                mywriter.writerows(output)
+        empirical_null.save(null_save_path)
 
+    if signif_level is not None:
+        intervals = {}
+        for w in window:
+            lower, upper = clopper_pearson(empirical_null.tail_counts(w, obs_vals[w]),
+                                           empirical_null.num_sim(w), conf_level)
+            intervals[w] = {k: (lo, up)
+                            for k, lo, up in zip(obs_keys[w], lower.tolist(), upper.tolist())}
+        return pvals, intervals
     return pvals
 
 
@@ -366,10 +615,14 @@ def protein_permutation(graph_score,
                         gene_graph,
                         num_permutations=10000,
                         stop_criteria=100,
-                        pseudo_count=0):
+                        max_batch=25000):
     """Performs null-simulations for position-based mutation statistics
     in a single gene.
 
+    The first stop_criteria-1 simulations are used to estimate the expected
+    relative increase in coverage from smoothing over the neighbor graph,
+    which normalizes both the observed and the simulated statistics.
+
     Parameters
     ----------
     graph_score : float
@@ -387,17 +640,23 @@ def protein_permutation(graph_score,
         identified at positions along the gene.
     gene_seq : GeneSequence
         Sequence of gene of interest
+    gene_graph : dict
+        Graph of spatially near codons. keys = nodes, edges = key -> value.
     num_permutations : int, default: 10000
         number of permutations to create for null
     stop_criteria : int
         stop after stop_criteria iterations are more significant
         then the observed statistic.
+    max_batch : int
+        maximum number of whole gene simulations to do at once.
 
     Returns
     -------
     protein_pval : float
         p-value for clustering in neighbor graph constructure from protein
         structures
+    obs_stat : float
+        normalized clustering score for observed data
     """
     # get contexts and somatic base
     mycontexts = context_counts.index.tolist()
@@ -405,80 +664,74 @@ def protein_permutation(graph_score,
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+    # convert neighbor graph to a sparse matrix once for the gene
+    graph_matrix, is_node = scores.neighbor_graph_matrix(gene_graph)
 
-    # calculate position-based statistics as a result of random positions
+    # calculate the # of batches for simulations
+    batch_sizes = _batch_sizes(num_permutations, max_batch)
+
+    num_calib = stop_criteria - 1  # simulations to estimate the coverage
+    exp_rel_inc = None
+    pending = []  # simulations not yet compared to the observed statistic
+    num_sim = 0
     null_graph_entropy_ct = 0
-    coverage_list = []
-    num_mut_list = []
-    graph_entropy_list = []
-    for i, row in enumerate(tmp_mut_pos):
+    for j, batch_size in enumerate(batch_sizes):
+        # stop iterations if reached sufficient precision
+        if null_graph_entropy_ct >= stop_criteria:
+            break
+
+        # get random positions determined by sequence context
+        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
+                                                batch_size)
+        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+
+        # get entropy on graph-smoothed probability distribution
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                                somatic_base,
+                                                gene_seq)
+        is_missense = batch_stats.calc_missense_mask(tmp_mut_info['Reference AA'],
+                                                     tmp_mut_info['Somatic AA'])
+        sim_ix = np.nonzero(is_missense)[0]
+        pending.append(scores.compute_ng_stat_batch(graph_matrix, is_node, sim_ix,
+                                                    tmp_mut_info['Codon Pos'][is_missense],
+                                                    batch_size))
+        tmp_graph_entropy, tmp_coverage, tmp_num_mut_codons = \
+            [np.concatenate(x) for x in zip(*pending)]
+
         # calculate the expected value of the relative increase in coverage
-        if i == stop_criteria-1:
-            rel_inc = [coverage_list[k] / float(num_mut_list[k])
-                       for k in range(stop_criteria-1)
-                       if coverage_list[k]]
-            exp_rel_inc = np.mean(rel_inc)
+        if exp_rel_inc is None:
+            if len(tmp_coverage) < num_calib:
+                continue
+            calib_cov = tmp_coverage[:num_calib]
+            calib_num_mut = tmp_num_mut_codons[:num_calib]
+            exp_rel_inc = np.mean(calib_cov[calib_cov>0] / calib_num_mut[calib_cov>0].astype(float))
 
             # calculate observed statistic
             if num_codons_obs:
                 obs_stat = graph_score / np.log2(exp_rel_inc*num_codons_obs)
             else:
                 obs_stat = 1.0
+        pending = []
 
-            # calculate statistics for simulated data
-            sim_stat_list = [ent / np.log2(exp_rel_inc*num_mut_list[l])
-                             for l, ent in enumerate(graph_entropy_list)]
-            null_graph_entropy_ct = len([s for s in sim_stat_list
-                                         if s-utils.epsilon <= obs_stat])
-
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # calculate position info
-        tmp_tuple = cutils.calc_pos_info(tmp_mut_info['Codon Pos'],
-                                         tmp_mut_info['Reference AA'],
-                                         tmp_mut_info['Somatic AA'],
-                                         pseudo_count=pseudo_count,
-                                         is_obs=0)
-        _, _, _, tmp_pos_ct = tmp_tuple
-
-        # record num of mut codons
-        if i < stop_criteria-1:
-            tmp_num_mut_codons = len(tmp_pos_ct)
-            num_mut_list.append(tmp_num_mut_codons)
-
-        # get entropy on graph-smoothed probability distribution
-        tmp_graph_entropy, tmp_coverage = scores.compute_ng_stat(gene_graph, tmp_pos_ct)
-
-        # record the "coverage" in the graph
-        if i < stop_criteria-1:
-            coverage_list.append(tmp_coverage)
-            graph_entropy_list.append(tmp_graph_entropy)
+        # calculate statistics for simulated data
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim_stat = np.where(tmp_num_mut_codons > 0,
+                                tmp_graph_entropy / np.log2(exp_rel_inc*tmp_num_mut_codons),
+                                1.0)
 
         # update empirical null distribution counts
-        if i >= stop_criteria:
-            #if tmp_graph_entropy-utils.epsilon <= graph_score:
-            if tmp_num_mut_codons:
-                sim_stat = tmp_graph_entropy / np.log2(exp_rel_inc*tmp_num_mut_codons)
-            else:
-                sim_stat = 1.0
-
-            # add count
-            if sim_stat-utils.epsilon <= obs_stat:
-                null_graph_entropy_ct += 1
+        null_cts, tmp_num_sim = _count_null_hits([null_graph_entropy_ct],
+                                                 [sim_stat-utils.epsilon <= obs_stat],
+                                                 stop_criteria)
+        null_graph_entropy_ct = null_cts[0]
+        num_sim += tmp_num_sim
 
-        # stop iterations if reached sufficient precision
-        if null_graph_entropy_ct >= stop_criteria:
-            break
+    if exp_rel_inc is None:
+        raise ValueError('At least {0} simulations are needed to normalize the '
+                         'graph statistic'.format(num_calib))
 
     # calculate p-value from empirical null-distribution
-    protein_pval = float(null_graph_entropy_ct) / (i+1)
+    protein_pval = float(null_graph_entropy_ct) / num_sim
 
     return protein_pval, obs_stat
 
@@ -591,18 +844,10 @@ def non_silent_ratio_permutation(context_counts,
     tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
     # determine result of random positions
-    non_silent_count_list = []
-    for row in tmp_mut_pos:
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # calc deleterious mutation info
-        tmp_non_silent = cutils.calc_non_silent_info(tmp_mut_info['Reference AA'],
-                                                     tmp_mut_info['Somatic AA'],
-                                                     tmp_mut_info['Codon Pos'])
-        non_silent_count_list.append(tmp_non_silent)
+    tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                            somatic_base,
+                                            gene_seq)
+    non_silent_count_list = batch_stats.calc_non_silent_info(tmp_mut_info['Effect']).tolist()
     return non_silent_count_list
 
 
@@ -614,10 +859,14 @@ def summary_permutation(context_counts,
                         num_permutations=10000,
                         min_frac=0.0,
                         min_recur=2,
-                        drop_silent=False):
+                        drop_silent=False,
+                        max_batch=25000):
     """Performs null-permutations and summarizes the results as features over
     the gene.
 
+    The features of a whole batch of simulations are computed at once (see
+    batch_stats.calc_summary_info).
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -631,59 +880,62 @@ def summary_permutation(context_counts,
         identified at positions along the gene.
     gene_seq : GeneSequence
         Sequence of gene of interest
+    score_dir : str, ScoreProvider or None
+        directory containing score information, or a ScoreProvider which
+        keeps scores of recently used genes in memory
     num_permutations : int, default: 10000
         number of permutations to create for null
     drop_silent : bool, default=False
         Flage on whether to drop all silent mutations. Some data sources
         do not report silent mutations, and the simulations should match this.
+    max_batch : int, default: 25000
+        maximum number of simulations computed at once
 
     Returns
     -------
-    summary_info_list : list of lists
-        list of non-silent and silent mutation counts under the null along
-        with information on recurrent missense counts and missense positional
-        entropy.
+    summary_info : np.array
+        num permutations X features array of non-silent and silent mutation
+        counts under the null along with information on recurrent missense
+        counts, missense positional entropy and scores. The last column is
+        the sum of c*log2(c) over the missense position counts, used for the
+        normalized mutation entropy.
     """
     mycontexts = context_counts.index.tolist()
     somatic_base = [base
                     for one_context in mycontexts
                     for base in context_to_mut[one_context]]
 
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
-
     # determine result of random positions
     gene_name = gene_seq.bed.gene_name
-    gene_len = gene_seq.bed.cds_len
-    summary_info_list = []
-    for i, row in enumerate(tmp_mut_pos):
-        # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
+    summary_info = []
+    for batch_size in _batch_sizes(num_permutations, max_batch):
+        # get random positions determined by sequence context
+        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
+                                                batch_size)
+        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
         # Get all metrics summarizing each gene
-        tmp_summary = cutils.calc_summary_info(tmp_mut_info['Reference AA'],
-                                               tmp_mut_info['Somatic AA'],
-                                               tmp_mut_info['Codon Pos'],
-                                               gene_name,
-                                               score_dir,
-                                               min_frac=min_frac,
-                                               min_recur=min_recur)
-
-        # drop silent if needed
-        if drop_silent:
-            # silent mutation count is index 1
-            tmp_summary[1] = 0
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos,
+                                                somatic_base,
+                                                gene_seq)
+        summary_info.append(batch_stats.calc_summary_info(tmp_mut_info,
+                                                          gene_name,
+                                                          score_dir,
+                                                          min_frac=min_frac,
+                                                          min_recur=min_recur))
+    summary_info = np.vstack(summary_info)
 
-        # limit the precision of floats
-        #pos_ent = tmp_summary[-1]
-        #tmp_summary[-1] = '{0:.5f}'.format(pos_ent)
+    # drop silent if needed
+    if drop_silent:
+        # silent mutation count is index 1
+        summary_info[:, 1] = 0
+    return summary_info
 
-        summary_info_list.append([gene_name, i+1, gene_len]+tmp_summary)
-    return summary_info_list
+
+# columns of simulated mutations from maf_permutation
+maf_columns = ['Gene', 'strand', 'Chromosome', 'Start_Position',
+               'End_Position', 'Reference_Allele', 'Tumor_Allele',
+               'Context', 'DNA_Change', 'Protein_Change', 'Variant_Classification']
 
 
 def maf_permutation(context_counts,
@@ -691,13 +943,18 @@ def maf_permutation(context_counts,
                     seq_context,
                     gene_seq,
                     num_permutations=10000,
-                    drop_silent=False):
+                    drop_silent=False,
+                    max_rows=250000):
     """Performs null-permutations across all genes and records the results in
     a format like a MAF file. This could be useful for examining the null
     permutations because the alternative approaches always summarize the results.
     With the simulated null-permutations, novel metrics can be applied to create
     an empirical null-distribution.
 
+    Simulations are done in batches, and the mutations of each batch are
+    formatted with array operations and yielded, so that they can be
+    written out before the next batch is simulated.
+
     Parameters
     ----------
     context_counts : pd.Series
@@ -716,68 +973,82 @@ def maf_permutation(context_counts,
     drop_silent : bool, default=False
         Flage on whether to drop all silent mutations. Some data sources
         do not report silent mutations, and the simulations should match this.
-
-    Returns
-    -------
-    maf_list : list of tuples
-        list of null mutations with mutation info in a MAF like format
+    max_rows : int, default: 250000
+        maximum number of mutations simulated in a batch
+
+    Yields
+    ------
+    maf_df : pd.DataFrame
+        null mutations of a batch of simulations with mutation info in a MAF
+        like format (see maf_columns)
     """
     mycontexts = context_counts.index.tolist()
     somatic_base, base_context = zip(*[(base, one_context)
                                        for one_context in mycontexts
                                        for base in context_to_mut[one_context]])
-
-    # get random positions determined by sequence context
-    tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
-                                            num_permutations)
-    tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
+    num_mut = len(somatic_base)
 
     # info about gene
-    gene_name = gene_seq.bed.gene_name
-    strand = gene_seq.bed.strand
-    chrom = gene_seq.bed.chrom
-    gene_seq.bed.init_genome_coordinates()  # map seq pos to genome
-
-    # determine result of random positions
-    maf_list = []
-    for row in tmp_mut_pos:
-        # get genome coordinate
-        pos2genome = np.vectorize(lambda x: gene_seq.bed.seqpos2genome[x]+1)
-        genome_coord = pos2genome(row)
+    bed = gene_seq.bed
+    num_pos = bed.cds_len + bed.five_ss_len + bed.three_ss_len
+    genome_coord = bed.seqpos2genome + 1  # map seq pos to genome
+
+    # reference base of each sequence position
+    ref_nuc = list(gene_seq.exon_seq[:bed.cds_len])
+    for p in range(bed.cds_len, num_pos):
+        ss_pos = bed.pos2ss[p]
+        ss_seq = gene_seq.five_prime_seq if ss_pos[0] == "5'" else gene_seq.three_prime_seq
+        ref_nuc.append(ss_seq[ss_pos[1]][ss_pos[2]])
+    ref_nuc = np.array(ref_nuc, dtype=object)
+    somatic_base = np.array(somatic_base, dtype=object)
+    strand_ref_nuc, strand_somatic_base = ref_nuc, somatic_base
+    if bed.strand == '-':
+        # reverse complement if on negative strand
+        strand_ref_nuc = np.array([utils.rev_comp(n) for n in ref_nuc], dtype=object)
+        strand_somatic_base = np.array([utils.rev_comp(b) for b in somatic_base], dtype=object)
+    base_context = np.array(base_context, dtype=object)
+
+    # strings for the codes of the effect table
+    aa_names = np.array(list(utils.aa_letters) + ['Splice_Site', 'None'], dtype=object)
+    effect_names = np.array(utils.variant_snv + [''], dtype=object)
+    effect_table = gene_seq.get_effect_table()
+    codon_names = np.where(effect_table['Codon Pos'] >= 0,
+                           effect_table['Codon Pos'].astype(str).astype(object),
+                           'None')
+    pos_names = np.arange(num_pos).astype(str).astype(object)
+
+    max_batch = max(max_rows // max(num_mut, 1), 1)
+    for batch_size in _batch_sizes(num_permutations, max_batch):
+        # get random positions determined by sequence context
+        tmp_contxt_pos = seq_context.random_pos(context_counts.iteritems(),
+                                                batch_size)
+        tmp_mut_pos = np.hstack(pos_array for base, pos_array in tmp_contxt_pos)
 
         # get info about mutations
-        tmp_mut_info = mc.get_aa_mut_info(row,
-                                          somatic_base,
-                                          gene_seq)
-
-        # get string describing variant
-        var_class = cutils.get_variant_classification(tmp_mut_info['Reference AA'],
-                                                      tmp_mut_info['Somatic AA'],
-                                                      tmp_mut_info['Codon Pos'])
-
-        # prepare output
-        for k, mysomatic_base in enumerate(somatic_base):
-            # format DNA change
-            ref_nuc = tmp_mut_info['Reference Nuc'][k]
-            nuc_pos = row[k]
-            dna_change = 'c.{0}{1}>{2}'.format(ref_nuc, nuc_pos, mysomatic_base)
-
-            # format protein change
-            ref_aa = tmp_mut_info['Reference AA'][k]
-            somatic_aa = tmp_mut_info['Somatic AA'][k]
-            codon_pos = tmp_mut_info['Codon Pos'][k]
-            protein_change = 'p.{0}{1}{2}'.format(ref_aa, codon_pos, somatic_aa)
-
-            # reverse complement if on negative strand
-            if strand == '-':
-                ref_nuc = utils.rev_comp(ref_nuc)
-                mysomatic_base = utils.rev_comp(mysomatic_base)
-
-            # append results
-            if drop_silent and var_class[k].decode() == 'Silent': continue
-            maf_line = [gene_name, strand, chrom, genome_coord[k], genome_coord[k],
-                        ref_nuc, mysomatic_base, base_context[k], dna_change,
-                        protein_change, var_class[k].decode()]
-            maf_list.append(maf_line)
-
-    return maf_list
+        tmp_mut_info = mc.get_aa_mut_info_batch(tmp_mut_pos, somatic_base, gene_seq)
+        keep = np.ones(tmp_mut_pos.shape, dtype=bool)
+        if drop_silent:
+            keep = tmp_mut_info['Effect'] != utils.effect_code['Silent']
+        mut_pos = tmp_mut_pos[keep]
+        col_ix = np.nonzero(keep)[1]
+
+        # format DNA and protein change
+        dna_change = ('c.' + ref_nuc[mut_pos] + pos_names[mut_pos] +
+                      '>' + somatic_base[col_ix])
+        protein_change = ('p.' + aa_names[tmp_mut_info['Reference AA'][keep]] +
+                          codon_names[mut_pos] +
+                          aa_names[tmp_mut_info['Somatic AA'][keep]])
+
+        num_rows = len(mut_pos)
+        yield pd.DataFrame({'Gene': np.full(num_rows, bed.gene_name, dtype=object),
+                            'strand': np.full(num_rows, bed.strand, dtype=object),
+                            'Chromosome': np.full(num_rows, bed.chrom, dtype=object),
+                            'Start_Position': genome_coord[mut_pos],
+                            'End_Position': genome_coord[mut_pos],
+                            'Reference_Allele': strand_ref_nuc[mut_pos],
+                            'Tumor_Allele': strand_somatic_base[col_ix],
+                            'Context': base_context[col_ix],
+                            'DNA_Change': dna_change,
+                            'Protein_Change': protein_change,
+                            'Variant_Classification': effect_names[tmp_mut_info['Effect'][keep]]},
+                           columns=maf_columns)
@@ -5,7 +5,7 @@ import prob2020.python.p_value as mypval
 import numpy as np
 import pandas as pd
 
-def handle_tsg_results(permutation_result):
+def handle_tsg_results(permutation_result, sequential=False):
     """Handles result from TSG results.
 
     Takes in output from multiprocess_permutation function and converts to
@@ -15,16 +15,22 @@ def handle_tsg_results(permutation_result):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    sequential : bool, default: False
+        whether the results contain the confidence interval of the p-value
+        from the sequential mode
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
+    interval_cols = ['inactivating p-value lower', 'inactivating p-value upper'] if sequential else []
     permutation_df = pd.DataFrame(sorted(permutation_result, key=lambda x: x[2] if x[2] is not None else 1.1),
-                                  columns=['gene', 'inactivating count', 'inactivating p-value',
-                                           'Total SNV Mutations', 'SNVs Unmapped to Ref Tx'])
-    permutation_df['inactivating p-value'] = permutation_df['inactivating p-value'].astype('float')
+                                  columns=['gene', 'inactivating count', 'inactivating p-value'] +
+                                          interval_cols +
+                                          ['Total SNV Mutations', 'SNVs Unmapped to Ref Tx'])
+    for col in ['inactivating p-value'] + interval_cols:
+        permutation_df[col] = permutation_df[col].astype('float')
     tmp_df = permutation_df[permutation_df['inactivating p-value'].notnull()]
 
     # get benjamani hochberg adjusted p-values
@@ -40,12 +46,13 @@ def handle_tsg_results(permutation_result):
     permutation_df = permutation_df.set_index('gene', drop=False)
     col_order  = ['gene', 'Total SNV Mutations', 'SNVs Unmapped to Ref Tx',
                   #'Total Frameshift Mutations', 'Frameshifts Unmapped to Ref Tx',
-                  'inactivating count', 'inactivating p-value',
-                  'inactivating BH q-value']
+                  'inactivating count', 'inactivating p-value'] + \
+                 interval_cols + ['inactivating BH q-value']
     return permutation_df[col_order]
 
 
-def handle_oncogene_results(permutation_result, num_permutations):
+def handle_oncogene_results(permutation_result, num_permutations,
+                            sequential=False):
     """Takes in output from multiprocess_permutation function and converts to
     a better formatted dataframe.
 
@@ -53,15 +60,22 @@ def handle_oncogene_results(permutation_result, num_permutations):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    sequential : bool, default: False
+        whether the results contain the confidence intervals of the p-values
+        from the sequential mode
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
+    interval_cols = []
+    if sequential:
+        interval_cols = ['entropy p-value lower', 'entropy p-value upper',
+                         'vest p-value lower', 'vest p-value upper']
     mycols = ['gene', 'num recurrent', 'position entropy',
               'mean vest score', 'entropy p-value',
-              'vest p-value', 'Total Mutations', 'Unmapped to Ref Tx']
+              'vest p-value'] + interval_cols + ['Total Mutations', 'Unmapped to Ref Tx']
     permutation_df = pd.DataFrame(permutation_result, columns=mycols)
 
     # get benjamani hochberg adjusted p-values
@@ -73,7 +87,7 @@ def handle_oncogene_results(permutation_result, num_permutations):
     permutation_df['tmp vest p-value'] = permutation_df['vest p-value']
     permutation_df.loc[permutation_df['entropy p-value']==0, 'tmp entropy p-value'] = 1. / num_permutations
     permutation_df.loc[permutation_df['vest p-value']==0, 'tmp vest p-value'] = 1. / num_permutations
-    permutation_df['combined p-value'] = permutation_df[['entropy p-value', 'vest p-value']].apply(mypval.fishers_method, axis=1)
+    permutation_df['combined p-value'] = mypval.combine_p_values(permutation_df[['entropy p-value', 'vest p-value']])
     permutation_df['combined BH q-value'] = mypval.bh_fdr(permutation_df['combined p-value'])
     del permutation_df['tmp vest p-value']
     del permutation_df['tmp entropy p-value']
@@ -84,13 +98,14 @@ def handle_oncogene_results(permutation_result, num_permutations):
     col_order = ['gene', 'Total Mutations', 'Unmapped to Ref Tx',
                  'num recurrent', 'position entropy',
                  'mean vest score', 'entropy p-value',
-                 'vest p-value', 'combined p-value', 'entropy BH q-value',
+                 'vest p-value'] + interval_cols + \
+                ['combined p-value', 'entropy BH q-value',
                  'vest BH q-value', 'combined BH q-value']
     permutation_df = permutation_df.sort_values(by=['combined p-value'])
     return permutation_df[col_order]
 
 
-def handle_hotmaps_results(permutation_result):
+def handle_hotmaps_results(permutation_result, sequential=False):
     """Takes in output from multiprocess_permutation function and converts to
     a better formatted dataframe.
 
@@ -98,18 +113,22 @@ def handle_hotmaps_results(permutation_result):
     ----------
     permutation_result : list
         output from multiprocess_permutation
+    sequential : bool, default: False
+        whether the results contain the confidence interval of the p-values
+        from the sequential mode
 
     Returns
     -------
     permutation_df : pd.DataFrame
         formatted output suitable to save
     """
-    if len(permutation_result[0])  == 6:
+    interval_cols = ['p-value lower', 'p-value upper'] if sequential else []
+    if len(permutation_result[0]) - len(interval_cols) == 6:
         mycols = ['gene', 'window length', 'codon position', 'mutation count',
-                  'windowed sum', 'p-value']
+                  'windowed sum', 'p-value'] + interval_cols
     else:
         mycols = ['gene', 'window length', 'codon position', 'index', 'mutation count',
-                  'windowed sum', 'p-value']
+                  'windowed sum', 'p-value'] + interval_cols
 
     permutation_df = pd.DataFrame(permutation_result, columns=mycols)
 
@@ -0,0 +1,156 @@
+"""This module schedules the per-gene work of the permutation scripts
+across processes.
+
+Genes are grouped into bundles of roughly equal estimated cost, and the
+bundles are dispatched most expensive first to a single pool of worker
+processes. Results are returned in the order they finish.
+"""
+import prob2020.python.utils as utils
+from prob2020.python.mutation_table import MutationTable
+import numpy as np
+from multiprocessing import Pool
+import sys
+import logging
+
+logger = logging.getLogger(__name__)  # module logger
+
+
+def estimate_gene_cost(bed, num_mutations, num_iterations):
+    """Estimates the relative cost of simulating mutations for a gene.
+
+    Parameters
+    ----------
+    bed : BedLine
+        BED line object for the gene
+    num_mutations : int
+        number of mutations in the gene
+    num_iterations : int
+        number of simulations performed for the gene
+
+    Returns
+    -------
+    cost : float
+        estimated cost (mutations X CDS length X iterations)
+    """
+    return float(num_mutations) * bed.cds_len * max(num_iterations, 1)
+
+
+def gene_bundles(bed_dict, mut_df, num_iterations, num_processes,
+                 bundles_per_process=4):
+    """Groups mutated genes into bundles ordered by estimated cost.
+
+    Genes are sorted by decreasing cost and consecutive genes are added to
+    a bundle until it reaches the target cost of the total cost divided by
+    the number of bundles. Expensive genes therefore end up alone in a
+    bundle, while many cheap genes are grouped to reduce the overhead of
+    dispatching them to a process. Genes without mutations are skipped.
+
+    Parameters
+    ----------
+    bed_dict : dict
+        dictionary mapping chromosome to a list of BedLine objects
+    mut_df : pd.DataFrame
+        mutations with a "Gene" column
+    num_iterations : int
+        number of simulations performed for each gene
+    num_processes : int
+        number of worker processes
+    bundles_per_process : int, default: 4
+        number of bundles to aim for per process
+
+    Returns
+    -------
+    bundles : list of lists
+        lists of BedLine objects, ordered by decreasing estimated cost
+    """
+    # genes are categories, which are counted even without mutations
+    mut_cts = mut_df['Gene'].value_counts()
+    mut_cts = mut_cts[mut_cts > 0]
+    gene_costs = [(estimate_gene_cost(bed, mut_cts[bed.gene_name], num_iterations), bed)
+                  for chrom in bed_dict
+                  for bed in bed_dict[chrom]
+                  if bed.gene_name in mut_cts.index]
+    gene_costs.sort(key=lambda x: x[0], reverse=True)
+
+    # target cost for each bundle
+    total_cost = sum(c for c, b in gene_costs)
+    num_bundles = max(num_processes, 1) * bundles_per_process
+    target_cost = total_cost / num_bundles
+
+    # fill bundles with consecutive genes
+    bundles = []
+    bundle, bundle_cost = [], 0
+    for cost, bed in gene_costs:
+        bundle.append(bed)
+        bundle_cost += cost
+        if bundle_cost >= target_cost:
+            bundles.append(bundle)
+            bundle, bundle_cost = [], 0
+    if bundle:
+        bundles.append(bundle)
+    return bundles
+
+
+def bundle_mutations(mut_df, bundles, mut_table=None):
+    """Yields the mutation table to pass along with each bundle.
+
+    Parameters
+    ----------
+    mut_df : pd.DataFrame
+        mutations with a "Gene" column
+    bundles : list of lists
+        bundles of BedLine objects from gene_bundles
+    mut_table : MutationTable or None
+        shared mutation table used for every bundle. If None, a table
+        containing only the mutations for the genes of each bundle is
+        created instead.
+
+    Returns
+    -------
+    bundle_table : generator of MutationTable
+        mutations for the genes in each bundle
+    """
+    if mut_table is not None:
+        for bundle in bundles:
+            yield mut_table
+    else:
+        gene_ixs = mut_df.groupby('Gene').indices
+        for bundle in bundles:
+            ixs = np.concatenate([gene_ixs[bed.gene_name] for bed in bundle])
+            yield MutationTable(mut_df.iloc[np.sort(ixs)])
+
+
+def imap_bundles(func, info_list, num_processes):
+    """Applies a function to each bundle, using a single pool of processes.
+
+    Parameters
+    ----------
+    func : function
+        function applied to each element of info_list
+    info_list : iterable
+        input for each bundle, ordered by decreasing cost
+    num_processes : int
+        number of worker processes. If 0, bundles are run in this process.
+
+    Returns
+    -------
+    result : generator
+        result of func for each bundle, in the order they finish
+    """
+    if num_processes > 0:
+        pool = Pool(processes=num_processes)
+        process_results = pool.imap_unordered(func, info_list)
+        process_results.next = utils.keyboard_exit_wrapper(process_results.next)
+        try:
+            for bundle_result in process_results:
+                yield bundle_result
+        except KeyboardInterrupt:
+            pool.close()
+            pool.join()
+            logger.info('Exited by user. ctrl-c')
+            sys.exit(0)
+        pool.close()
+        pool.join()
+    else:
+        for info in info_list:
+            yield func(info)
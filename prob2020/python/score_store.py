@@ -0,0 +1,435 @@
+"""This module stores the VEST scores, MGA entropy scores and neighbor
+graphs of all genes in a single memory-mapped file.
+
+The file starts with a magic string and the length of a JSON header. The
+header lists the genes and the dtype, shape and byte offset of each array,
+and the arrays follow, aligned to 64 bytes. Scores of all genes are
+concatenated by codon:
+
+* "Codon offsets" : first codon row of each gene (num genes + 1)
+* "Reference AA" : reference residue code of the VEST scores of a codon
+* "VEST" : float64 score for each codon and somatic residue code, NaN if
+  the score is missing
+* "MGA entropy" : float64 MGA entropy score of each codon
+* "MGA length", "Has VEST", "Has MGA" : per gene information
+
+Neighbor graphs, if present, are stored as a sparse adjacency matrix over
+the same codon rows ("Graph indptr", "Graph indices", "Graph node"), with
+per gene flags in "Has graph".
+
+Since the arrays are memory-mapped, lookups are array gathers and worker
+processes share the same pages of the file.
+"""
+import prob2020.python.utils as utils
+import numpy as np
+import json
+import glob
+import os
+import sys
+import tempfile
+
+# import pickle module
+try:
+    import cPickle as pickle
+except:
+    import pickle as pickle
+
+MAGIC = b'P2020SCR'
+ALIGN = 64
+num_residues = len(utils.aa_letters)
+
+# score stores already opened in this process
+_open_stores = {}
+
+
+class VestScores(object):
+    """Dense VEST scores of a gene.
+
+    Each codon has a single reference residue, and a score for each
+    somatic residue (NaN if missing).
+    """
+
+    def __init__(self, ref_aa, scores):
+        """Constructor.
+
+        Parameters
+        ----------
+        ref_aa : np.array
+            reference residue code of each codon (utils.missing_aa_code if
+            the codon has no scores)
+        scores : np.array
+            num codons X num residues array of VEST scores
+        """
+        self.ref_aa = ref_aa
+        self.scores = scores
+
+    @classmethod
+    def from_dict(cls, vest_dict):
+        """Converts VEST scores from the nested dictionary of the pickle
+        files, i.e. codon position (1-based) -> reference AA -> somatic AA.
+        Scores keep the double precision of the pickle files. Residues
+        without a code in utils.aa_code are skipped, since mutations can
+        never be looked up with them.
+        """
+        num_codons = max(vest_dict) if vest_dict else 0
+        ref_aa = np.full(num_codons, utils.missing_aa_code, dtype=np.int8)
+        scores = np.full((num_codons, num_residues), np.nan, dtype=float)
+        for pos in vest_dict:
+            for ref in vest_dict[pos]:
+                if ref not in utils.aa_code:
+                    continue
+                if ref_aa[pos-1] != utils.missing_aa_code:
+                    raise ValueError('Codon {0} has scores for several reference '
+                                     'residues'.format(pos))
+                ref_aa[pos-1] = utils.aa_code[ref]
+                for somatic, score in vest_dict[pos][ref].items():
+                    if somatic in utils.aa_code:
+                        scores[pos-1, utils.aa_code[somatic]] = score
+        return cls(ref_aa, scores)
+
+    def fetch(self, ref_aa, somatic_aa, codon_pos, default_vest=0.0):
+        """Get VEST scores for mutations.
+
+        Follows the same definition as scores.fetch_vest_scores.
+
+        Parameters
+        ----------
+        ref_aa: list of str
+            list of reference amino acids
+        somatic_aa: list of str
+            somatic mutation aa
+        codon_pos: list of int
+            position of codon in protein sequence
+        default_vest: float, default=0.0
+            value to use if VEST score not available for a given mutation
+
+        Returns
+        -------
+        vest_score_list: list
+            score results for mutations
+        """
+        has_pos = np.array([p is not None for p in codon_pos], dtype=bool)
+        pos = np.array([p if p is not None else -1 for p in codon_pos], dtype=int)
+        ref = np.array([utils.aa_code.get(aa, utils.missing_aa_code) for aa in ref_aa], dtype=int)
+        somatic = np.array([utils.aa_code.get(aa, utils.missing_aa_code) for aa in somatic_aa], dtype=int)
+        vest_scores = self.fetch_codes(ref, somatic, pos, default_vest)
+        vest_scores[~has_pos] = 0.0
+        return vest_scores.tolist()
+
+    def fetch_codes(self, ref_aa, somatic_aa, codon_pos, default_vest=0.0):
+        """Get VEST scores for mutations given as integer codes.
+
+        Parameters
+        ----------
+        ref_aa : np.array
+            reference residue codes (see utils.aa_code)
+        somatic_aa : np.array
+            somatic residue codes (see utils.aa_code)
+        codon_pos : np.array
+            codon positions (0-based)
+        default_vest : float, default=0.0
+            value to use if VEST score not available for a given mutation
+
+        Returns
+        -------
+        vest_scores : np.array
+            score of each mutation
+        """
+        num_codons = len(self.ref_aa)
+        is_valid = ((codon_pos >= 0) & (codon_pos < num_codons) &
+                    (somatic_aa >= 0) & (somatic_aa < num_residues))
+        row = np.where(is_valid, codon_pos, 0)
+        col = np.where(is_valid, somatic_aa, 0)
+        if num_codons:
+            vest_scores = self.scores[row, col].astype(float)
+            is_valid &= self.ref_aa[row] == ref_aa
+        else:
+            vest_scores = np.zeros(np.shape(codon_pos))
+        is_valid &= ~np.isnan(vest_scores)
+        return np.where(is_valid, vest_scores, default_vest)
+
+
+def is_score_store(path):
+    """Checks whether a path is a score store file (rather than a directory
+    of pickle files)."""
+    if not path:
+        return False
+    if os.path.abspath(path) in _open_stores:
+        return True
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def open_score_store(path):
+    """Opens a score store, only once per process."""
+    path = os.path.abspath(path)
+    if path not in _open_stores:
+        _open_stores[path] = ScoreStore(path)
+    return _open_stores[path]
+
+
+class ScoreStore(object):
+    """Read access to a memory-mapped score store file."""
+
+    def __init__(self, path):
+        """Constructor.
+
+        Parameters
+        ----------
+        path : str
+            path to the score store file
+        """
+        self.path = path
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{0} is not a score store file'.format(path))
+            header_len = int(np.frombuffer(handle.read(8), dtype='<u8')[0])
+            header = json.loads(handle.read(header_len).decode('utf-8'))
+        self.genes = header['genes']
+        self._gene_ix = {g: i for i, g in enumerate(self.genes)}
+        self._arrays = {}
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            if np.prod(shape):
+                self._arrays[name] = np.memmap(path, dtype=dtype, mode='r',
+                                               offset=offset, shape=tuple(shape))
+            else:
+                self._arrays[name] = np.zeros(shape, dtype=dtype)
+
+    def __contains__(self, gene):
+        return gene in self._gene_ix
+
+    def _codon_rows(self, gene):
+        """Gets the range of codon rows of a gene."""
+        offsets = self._arrays['Codon offsets']
+        ix = self._gene_ix[gene]
+        return ix, slice(offsets[ix], offsets[ix+1])
+
+    def gene_vest(self, gene):
+        """Returns the VEST scores of a gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+
+        Returns
+        -------
+        gene_vest : VestScores or None
+            VEST scores, None if not available for the gene
+        """
+        if gene not in self:
+            return None
+        ix, rows = self._codon_rows(gene)
+        if not self._arrays['Has VEST'][ix]:
+            return None
+        return VestScores(self._arrays['Reference AA'][rows],
+                          self._arrays['VEST'][rows])
+
+    def gene_mga(self, gene):
+        """Returns the MGA entropy scores of a gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+
+        Returns
+        -------
+        mga_vec : np.array or None
+            MGA entropy score of each codon, None if not available
+        """
+        if gene not in self:
+            return None
+        ix, rows = self._codon_rows(gene)
+        if not self._arrays['Has MGA'][ix]:
+            return None
+        mga_len = self._arrays['MGA length'][ix]
+        return np.asarray(self._arrays['MGA entropy'][rows][:mga_len], dtype=float)
+
+    def gene_graph(self, gene):
+        """Returns the neighbor graph of a gene.
+
+        Parameters
+        ----------
+        gene : str
+            gene name
+
+        Returns
+        -------
+        gene_graph : dict or None
+            Graph of spatially near codons. keys = nodes, edges = key -> value.
+            None if not available.
+        """
+        if gene not in self or 'Has graph' not in self._arrays:
+            return None
+        ix, rows = self._codon_rows(gene)
+        if not self._arrays['Has graph'][ix]:
+            return None
+        indptr = self._arrays['Graph indptr']
+        indices = self._arrays['Graph indices']
+        is_node = self._arrays['Graph node'][rows]
+        gene_graph = {}
+        for codon in np.flatnonzero(is_node):
+            row = rows.start + codon
+            gene_graph[int(codon)] = set(indices[indptr[row]:indptr[row+1]].tolist())
+        return gene_graph
+
+
+def _read_pickle(path):
+    """Reads a pickle file written by either python 2 or 3."""
+    with open(path, 'rb') as handle:
+        if sys.version_info < (3,):
+            return pickle.load(handle)
+        else:
+            return pickle.load(handle, encoding='latin-1')
+
+
+def _read_gene_scores(files):
+    """Reads the VEST scores, MGA entropy scores and neighbor graph of a
+    gene from its pickle files (None if not available)."""
+    gene_vest = VestScores.from_dict(_read_pickle(files['vest'])) if 'vest' in files else None
+    mga_vec = np.asarray(_read_pickle(files['mga'])) if 'mga' in files else None
+    gene_graph = _read_pickle(files['graph']) if 'graph' in files else None
+    return gene_vest, mga_vec, gene_graph
+
+
+def write_score_store(path, score_dir=None, graph_dir=None):
+    """Converts per gene pickle files into a single score store file.
+
+    The pickle files are read twice, first to find the size of each gene's
+    block, and then to write each gene's block directly to the memory-mapped
+    output, so only one gene is kept in memory at a time.
+
+    Parameters
+    ----------
+    path : str
+        output path of the score store
+    score_dir : str or None
+        directory containing {gene}.vest.pickle and {gene}.mgaentropy.pickle
+        files
+    graph_dir : str or None
+        directory containing {gene}.pickle neighbor graph files
+    """
+    # find the genes with any scores
+    gene_files = {}
+    patterns = []
+    if score_dir:
+        patterns += [(score_dir, '.vest.pickle', 'vest'),
+                     (score_dir, '.mgaentropy.pickle', 'mga')]
+    if graph_dir:
+        patterns += [(graph_dir, '.pickle', 'graph')]
+    for mydir, suffix, kind in patterns:
+        for gene_path in glob.glob(os.path.join(mydir, '*'+suffix)):
+            gene = os.path.basename(gene_path)[:-len(suffix)]
+            if kind == 'graph' and gene.endswith(('.vest', '.mgaentropy')):
+                # skip score pickles if both are in the same directory
+                continue
+            gene_files.setdefault(gene, {})[kind] = gene_path
+    genes = sorted(gene_files)
+
+    # find the number of codons and graph edges of each gene
+    num_codons = np.zeros(len(genes), dtype=np.int64)
+    num_edges = np.zeros(len(genes), dtype=np.int64)
+    for i, gene in enumerate(genes):
+        gene_vest, mga_vec, gene_graph = _read_gene_scores(gene_files[gene])
+        lens = [0]
+        if gene_vest is not None: lens.append(len(gene_vest.ref_aa))
+        if mga_vec is not None: lens.append(len(mga_vec))
+        if gene_graph:
+            lens.append(max(max(gene_graph), max(max(nb) if nb else 0 for nb in gene_graph.values())) + 1)
+            num_edges[i] = sum(len(set(nb)) for nb in gene_graph.values())
+        num_codons[i] = max(lens)
+    offsets = np.concatenate([[0], np.cumsum(num_codons)])
+    total_codons = int(offsets[-1])
+
+    # dtype and shape of each array
+    specs = [('Codon offsets', np.int64, (len(genes)+1,)),
+             ('Reference AA', np.int8, (total_codons,)),
+             ('VEST', np.float64, (total_codons, num_residues)),
+             ('MGA entropy', np.float64, (total_codons,)),
+             ('MGA length', np.int64, (len(genes),)),
+             ('Has VEST', bool, (len(genes),)),
+             ('Has MGA', bool, (len(genes),))]
+    if graph_dir:
+        specs += [('Graph indptr', np.int64, (total_codons+1,)),
+                  ('Graph indices', np.int32, (int(num_edges.sum()),)),
+                  ('Graph node', bool, (total_codons,)),
+                  ('Has graph', bool, (len(genes),))]
+
+    # compute the location of each array in the file
+    header = {'genes': genes, 'arrays': {}}
+    names = [name for name, dtype, shape in specs]
+    data_offsets = []
+    offset = 0
+    for name, dtype, shape in specs:
+        data_offsets.append(offset)
+        nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+        offset += -(-nbytes // ALIGN) * ALIGN
+    # the offsets depend on the header length, so the space reserved for
+    # the header grows until the header with shifted offsets fits in it
+    data_start = 0
+    while True:
+        for (name, dtype, shape), data_offset in zip(specs, data_offsets):
+            header['arrays'][name] = [np.dtype(dtype).str, list(shape), data_start + data_offset]
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_end = len(MAGIC) + 8 + len(header_bytes)
+        if header_end <= data_start:
+            break
+        data_start = -(-header_end // ALIGN) * ALIGN
+    header_bytes += b' ' * (data_start - header_end)
+    assert len(MAGIC) + 8 + len(header_bytes) == data_start
+
+    # write to a temporary file first, so other processes never read a
+    # partially written file
+    out_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as handle:
+        handle.write(MAGIC)
+        handle.write(np.array([len(header_bytes)], dtype='<u8').tobytes())
+        handle.write(header_bytes)
+        handle.truncate(data_start + offset)
+    arrays = {}
+    for name, dtype, shape in specs:
+        if np.prod(shape):
+            arrays[name] = np.memmap(tmp_path, dtype=dtype, mode='r+',
+                                     offset=header['arrays'][name][2], shape=shape)
+        else:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+    arrays['Codon offsets'][:] = offsets
+
+    # write the block of each gene
+    num_written_edges = 0
+    for i, gene in enumerate(genes):
+        gene_vest, mga_vec, gene_graph = _read_gene_scores(gene_files[gene])
+        start, end = offsets[i], offsets[i+1]
+        arrays['Reference AA'][start:end] = utils.missing_aa_code
+        arrays['VEST'][start:end] = np.nan
+        arrays['MGA entropy'][start:end] = np.nan
+        if gene_vest is not None:
+            vest_len = len(gene_vest.ref_aa)
+            arrays['Reference AA'][start:start+vest_len] = gene_vest.ref_aa
+            arrays['VEST'][start:start+vest_len] = gene_vest.scores
+            arrays['Has VEST'][i] = True
+        if mga_vec is not None:
+            mga_len = len(mga_vec)
+            arrays['MGA entropy'][start:start+mga_len] = mga_vec
+            arrays['MGA length'][i] = mga_len
+            arrays['Has MGA'][i] = True
+        if graph_dir:
+            # neighbors of each codon of the gene, as rows of a sparse matrix
+            arrays['Has graph'][i] = gene_graph is not None
+            gene_graph = gene_graph or {}
+            neighbors = [sorted(set(gene_graph.get(codon, ()))) for codon in range(end-start)]
+            num_neighbors = np.array([len(nb) for nb in neighbors], dtype=np.int64)
+            gene_indices = [n for nb in neighbors for n in nb]
+            arrays['Graph indptr'][start+1:end+1] = num_written_edges + np.cumsum(num_neighbors)
+            arrays['Graph indices'][num_written_edges:num_written_edges+len(gene_indices)] = gene_indices
+            num_written_edges += len(gene_indices)
+            arrays['Graph node'][start:end] = [codon in gene_graph for codon in range(end-start)]
+    for arr in arrays.values():
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    del arrays
+    os.replace(tmp_path, path)
@@ -1,7 +1,11 @@
 #from ..cython import cutils
 import numpy as np
+import scipy.sparse as sparse
 import os
+from collections import OrderedDict
 import prob2020.python.mymath as mymath
+import prob2020.python.score_store as score_store
+import prob2020.python.utils as utils
 import sys
 
 # import pickle module
@@ -12,31 +16,147 @@ except:
         print('Falling back to regular pickle module')
     import pickle as pickle
 
+# score providers already created in this process
+_score_providers = {}
+
+
+def _read_pickle(path, encoding='latin-1'):
+    """Reads a pickle file written by either python 2 or 3."""
+    if sys.version_info < (3,):
+        # python 2.7 way
+        with open(path) as handle:
+            return pickle.load(handle)
+    else:
+        # python 3.X way
+        with open(path, 'rb') as handle:
+            if encoding:
+                return pickle.load(handle, encoding=encoding)
+            return pickle.load(handle)
+
+
+def _approx_nbytes(obj):
+    """Roughly estimates the memory used by scores of a gene."""
+    if obj is None:
+        return 0
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_approx_nbytes(v) for v in obj.values())
+    else:
+        return sys.getsizeof(obj)
+
+
+class ScoreProvider(object):
+    """Provides the VEST scores, MGA entropy scores and neighbor graphs of
+    genes from a directory of pickle files or a score store.
+
+    Scores read from pickle files are kept in memory, and the least
+    recently used genes are dropped once the estimated memory of the kept
+    scores exceeds max_bytes. Scores in a score store are memory-mapped,
+    so they are not kept.
+    """
+
+    def __init__(self, score_dir, max_bytes=2**30):
+        """Constructor.
+
+        Parameters
+        ----------
+        score_dir : str
+            directory containing pickle files, or a score store file
+        max_bytes : int, default: 2**30
+            memory budget for scores kept in memory
+        """
+        self.score_dir = score_dir
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._cache = OrderedDict()
+        if score_store.is_score_store(score_dir):
+            self._store = score_store.open_score_store(score_dir)
+        else:
+            self._store = None
+
+    def _get(self, kind, gname, suffix, encoding='latin-1'):
+        """Gets a score of a gene from the cache, or reads it from its
+        pickle file."""
+        key = (kind, gname)
+        if key in self._cache:
+            # mark as most recently used
+            val, nbytes = self._cache.pop(key)
+            self._cache[key] = (val, nbytes)
+            return val
+
+        path = os.path.join(self.score_dir, gname+suffix)
+        val = _read_pickle(path, encoding) if os.path.exists(path) else None
+        nbytes = _approx_nbytes(val)
+        self._cache[key] = (val, nbytes)
+        self.nbytes += nbytes
+
+        # drop least recently used genes if over the memory budget
+        while self.nbytes > self.max_bytes and len(self._cache) > 1:
+            old_key, (old_val, old_nbytes) = self._cache.popitem(last=False)
+            self.nbytes -= old_nbytes
+        return val
+
+    def vest(self, gname):
+        """Returns the VEST scores of a gene (dict, or VestScores for a
+        score store), or None if not available."""
+        if self._store is not None:
+            return self._store.gene_vest(gname)
+        return self._get('vest', gname, '.vest.pickle')
+
+    def mga(self, gname):
+        """Returns the MGA entropy scores of a gene, or None if not
+        available."""
+        if self._store is not None:
+            return self._store.gene_mga(gname)
+        return self._get('mga', gname, '.mgaentropy.pickle')
+
+    def graph(self, gname):
+        """Returns the neighbor graph of a gene, or None if not
+        available."""
+        if self._store is not None:
+            return self._store.gene_graph(gname)
+        return self._get('graph', gname, '.pickle', encoding=None)
+
+
+def get_score_provider(score_dir):
+    """Gets the score provider for a directory (or score store), only
+    creating it once per process.
+
+    Parameters
+    ----------
+    score_dir : str or ScoreProvider
+        directory containing pickle files, or a score store file. A
+        ScoreProvider is returned as is.
+
+    Returns
+    -------
+    provider : ScoreProvider
+        provider of scores in the directory
+    """
+    if isinstance(score_dir, ScoreProvider):
+        return score_dir
+    if score_dir not in _score_providers:
+        _score_providers[score_dir] = ScoreProvider(score_dir)
+    return _score_providers[score_dir]
+
+
 def retrieve_scores(gname, sdir,
                     codon_pos, germ_aa, somatic_aa,
                     default_mga=5., default_vest=0,
                     no_file_flag=-1):
-    """Retrieves scores from pickle files.
+    """Retrieves scores from pickle files or a score store.
 
-    Used by summary script.
+    Used by summary script. sdir may also be a ScoreProvider, which keeps
+    scores of recently used genes in memory.
 
     """
     # get variant types
     #var_class = cutils.get_variant_classification(germ_aa, somatic_aa, codon_pos)
 
     # get information about MGA entropy
-    mga_path = os.path.join(sdir, gname+".mgaentropy.pickle")
-    if os.path.exists(mga_path):
-        if sys.version_info < (3,):
-            # python 2.7 way
-            with open(mga_path) as handle:
-                mga_ent = pickle.load(handle)
-        else:
-            # python 3.X way
-            with open(mga_path, 'rb') as handle:
-                mga_ent = pickle.load(handle, encoding='latin-1')
-    else:
-        mga_ent = None
+    provider = get_score_provider(sdir)
+    mga_ent = provider.mga(gname)
     missense_pos = [p for i, p in enumerate(codon_pos)
                     if (germ_aa[i]!=somatic_aa[i]) and
                        (germ_aa[i] not in ['-', '*', 'Splice_Site']) and
@@ -55,18 +175,7 @@ def retrieve_scores(gname, sdir,
         #total_mga_ent = no_file_flag
 
     # get information about VEST scores
-    vest_path = os.path.join(sdir, gname+".vest.pickle")
-    if os.path.exists(vest_path):
-        if sys.version_info < (3,):
-            # python 2.7 way
-            with open(vest_path) as handle:
-                vest_score = pickle.load(handle)
-        else:
-            # python 3.X way
-            with open(vest_path, 'rb') as handle:
-                vest_score = pickle.load(handle, encoding='latin-1')
-    else:
-        vest_score = None
+    vest_score = provider.vest(gname)
     total_vest = compute_vest_stat(vest_score,
                                    germ_aa, somatic_aa, codon_pos,
                                    stat_func=sum, default_val=default_vest)
@@ -79,6 +188,74 @@ def retrieve_scores(gname, sdir,
     return total_mga_ent, total_vest
 
 
+def retrieve_scores_batch(gname, sdir,
+                          codon_pos, ref_aa, somatic_aa,
+                          default_mga=5., default_vest=0):
+    """Array-based version of retrieve_scores for a batch of simulations.
+
+    Mutations are given as integer codes (see utils.aa_code). Scores are
+    summed in the order of the mutations, like in retrieve_scores.
+
+    Parameters
+    ----------
+    gname : str
+        name of gene
+    sdir : str or ScoreProvider
+        directory containing score information
+    codon_pos : np.array
+        num simulations X num mutations array of codon positions (-1 for
+        mutations outside of a codon)
+    ref_aa : np.array
+        num simulations X num mutations array of reference residue codes
+    somatic_aa : np.array
+        num simulations X num mutations array of somatic residue codes
+
+    Returns
+    -------
+    total_mga_ent : np.array
+        total MGA entropy of missense mutations in each simulation
+    total_vest : np.array
+        total VEST score in each simulation
+    """
+    num_sim, num_mut = codon_pos.shape
+    provider = get_score_provider(sdir)
+
+    # get information about MGA entropy
+    mga_ent = provider.mga(gname)
+    not_missense = [utils.stop_code, utils.splice_code]
+    is_missense = ((ref_aa != somatic_aa) &
+                   ~np.isin(ref_aa, not_missense) &
+                   ~np.isin(somatic_aa, not_missense))
+    if mga_ent is None:
+        total_mga_ent = np.full(num_sim, default_mga, dtype=float)
+    else:
+        is_valid = is_missense & (codon_pos < len(mga_ent))
+        mga_scores = np.where(is_valid, mga_ent[np.where(is_valid, codon_pos, 0)], 0)
+        total_mga_ent = np.where(is_valid.any(axis=1),
+                                 _sequential_sum(mga_scores),
+                                 default_mga)
+
+    # get information about VEST scores
+    vest_score = provider.vest(gname)
+    if vest_score is None or num_mut == 0:
+        total_vest = np.full(num_sim, default_vest, dtype=float)
+    else:
+        if not isinstance(vest_score, score_store.VestScores):
+            vest_score = score_store.VestScores.from_dict(vest_score)
+        vest_scores = vest_score.fetch_codes(ref_aa, somatic_aa, codon_pos)
+        vest_scores[codon_pos < 0] = 0.0
+        total_vest = _sequential_sum(vest_scores)
+    return total_mga_ent, total_vest
+
+
+def _sequential_sum(x):
+    """Sums each row from left to right, so the result is identical to
+    the python sum of the row."""
+    if x.shape[1] == 0:
+        return np.zeros(x.shape[0], dtype=x.dtype)
+    return np.cumsum(x, axis=1)[:, -1]
+
+
 def read_vest_pickle(gname, score_dir):
     """Read in VEST scores for given gene.
 
@@ -87,24 +264,15 @@ def read_vest_pickle(gname, score_dir):
     gname : str
         name of gene
     score_dir : str
-        directory containing vest scores
+        directory containing vest scores, or a score store file
 
     Returns
     -------
-    gene_vest : dict or None
-        dict containing vest scores for gene. Returns None if not found.
+    gene_vest : dict, VestScores or None
+        dict containing vest scores for gene (VestScores if read from a
+        score store). Returns None if not found.
     """
-    vest_path = os.path.join(score_dir, gname+".vest.pickle")
-    if os.path.exists(vest_path):
-        if sys.version_info < (3,):
-            with open(vest_path) as handle:
-                gene_vest = pickle.load(handle)
-        else:
-            with open(vest_path, 'rb') as handle:
-                gene_vest = pickle.load(handle, encoding='latin-1')
-        return gene_vest
-    else:
-        return None
+    return get_score_provider(score_dir).vest(gname)
 
 
 def compute_vest_stat(vest_dict, ref_aa, somatic_aa, codon_pos,
@@ -151,6 +319,45 @@ def compute_vest_stat(vest_dict, ref_aa, somatic_aa, codon_pos,
     return score_stat
 
 
+def compute_vest_stat_batch(gene_vest, ref_aa, somatic_aa, codon_pos,
+                            default_val=0.0):
+    """Compute the mean VEST score statistic for a batch of simulations.
+
+    Array-based version of compute_vest_stat with stat_func=np.mean, where
+    mutations are given as integer codes (see utils.aa_code).
+
+    Parameters
+    ----------
+    gene_vest : dict or VestScores
+        vest scores across the gene of interest
+    ref_aa : np.array
+        num simulations X num mutations array of reference residue codes
+    somatic_aa : np.array
+        num simulations X num mutations array of somatic residue codes
+    codon_pos : np.array
+        num simulations X num mutations array of codon positions (-1 for
+        mutations outside of a codon)
+    default_val : float
+        default value to return if there are no mutations
+
+    Returns
+    -------
+    score_stat : np.array
+        vest score statistic for each simulation
+    """
+    num_sim = codon_pos.shape[0]
+    if gene_vest is None or codon_pos.shape[1] == 0:
+        return np.full(num_sim, default_val, dtype=float)
+    if not isinstance(gene_vest, score_store.VestScores):
+        gene_vest = score_store.VestScores.from_dict(gene_vest)
+
+    # look up all scores at once, mutations outside of a codon have a zero
+    # score like in fetch_vest_scores
+    myscores = gene_vest.fetch_codes(ref_aa, somatic_aa, codon_pos)
+    myscores[codon_pos < 0] = 0.0
+    return myscores.mean(axis=1)
+
+
 def compute_mga_entropy_stat(mga_vec, codon_pos,
                              stat_func=np.mean,
                              default_val=0.0):
@@ -198,7 +405,7 @@ def fetch_vest_scores(vest_dict,
 
     Parameters
     ----------
-    vest_dict : dict
+    vest_dict : dict or VestScores
         dictionary containing vest scores across the gene of interest
     ref_aa: list of str
         list of reference amino acids
@@ -214,6 +421,8 @@ def fetch_vest_scores(vest_dict,
     vest_score_list: list
         score results for mutations
     """
+    if isinstance(vest_dict, score_store.VestScores):
+        return vest_dict.fetch(ref_aa, somatic_aa, codon_pos, default_vest)
     vest_score_list = []
     for i in range(len(somatic_aa)):
         # make sure position is valid
@@ -266,20 +475,14 @@ def read_neighbor_graph_pickle(gname, graph_dir):
     gname : str
         name of gene
     graph_dir : str
-        directory containing gene graphs
+        directory containing gene graphs, or a score store file
 
     Returns
     -------
     gene_graph : dict or None
         neighbor graph as dict for gene. Returns None if not found.
     """
-    graph_path = os.path.join(graph_dir, gname+".pickle")
-    if os.path.exists(graph_path):
-        with open(graph_path) as handle:
-            gene_graph = pickle.load(handle)
-        return gene_graph
-    else:
-        return None
+    return get_score_provider(graph_dir).graph(gname)
 
 
 def compute_ng_stat(gene_graph, pos_ct, alpha=.5):
@@ -332,3 +535,94 @@ def compute_ng_stat(gene_graph, pos_ct, alpha=.5):
     coverage = np.count_nonzero(p)
 
     return graph_score, coverage
+
+
+def neighbor_graph_matrix(gene_graph):
+    """Converts the neighbor graph of a gene to a sparse adjacency matrix.
+
+    Parameters
+    ----------
+    gene_graph : dict
+        Graph of spatially near codons. keys = nodes, edges = key -> value.
+
+    Returns
+    -------
+    graph_matrix : scipy.sparse.csr_matrix
+        entry (i, j) is one if codon j is a neighbor of codon i
+    is_node : np.array
+        flag indicating which codons are nodes in the graph
+    """
+    nodes = np.array(list(gene_graph), dtype=int)
+    neighbors = [np.asarray(list(gene_graph[n]), dtype=int) for n in nodes]
+    num_neighbors = np.array([len(nb) for nb in neighbors], dtype=int)
+    neighbors = np.concatenate(neighbors + [np.zeros(0, dtype=int)])
+    num_codons = max(nodes.max(initial=-1), neighbors.max(initial=-1)) + 1
+
+    # repeated edges only count once
+    graph_matrix = sparse.csr_matrix((np.ones(len(neighbors)),
+                                      (np.repeat(nodes, num_neighbors), neighbors)),
+                                     shape=(num_codons, num_codons))
+    graph_matrix.data[:] = 1
+    is_node = np.zeros(num_codons, dtype=bool)
+    is_node[nodes] = True
+    return graph_matrix, is_node
+
+
+def compute_ng_stat_batch(graph_matrix, is_node, sim_ix, codon_pos,
+                          num_sim, alpha=.5):
+    """Compute the clustering score on the neighbor graph for a batch of
+    simulations.
+
+    Follows the same definition as compute_ng_stat, but the mutation counts
+    of every simulation are smoothed over the graph with a single sparse
+    matrix product.
+
+    Parameters
+    ----------
+    graph_matrix : scipy.sparse.csr_matrix
+        adjacency matrix from neighbor_graph_matrix
+    is_node : np.array
+        flag indicating which codons are nodes in the graph
+    sim_ix : np.array
+        simulation (row) of each missense mutation
+    codon_pos : np.array
+        codon position of each missense mutation
+    num_sim : int
+        number of simulations
+    alpha : float
+        smoothing factor
+
+    Returns
+    -------
+    graph_score : np.array
+        score measuring the clustering of missense mutations in the graph
+    coverage : np.array
+        number of nodes that received non-zero weight
+    num_codons : np.array
+        number of codons with a missense mutation
+    """
+    num_nodes = graph_matrix.shape[0]
+    is_valid = (codon_pos >= 0) & (codon_pos < num_nodes)
+    if not np.all(is_valid) or not np.all(is_node[codon_pos]):
+        raise KeyError('Mutated codon is not in the neighbor graph')
+
+    # count mutations at each codon
+    pos_ct = sparse.csr_matrix((np.ones(len(codon_pos)), (sim_ix, codon_pos)),
+                               shape=(num_sim, num_nodes))
+    pos_ct.sum_duplicates()
+    num_codons = np.diff(pos_ct.indptr)
+
+    # smooth out mutation counts
+    codon_vals = (alpha*pos_ct.dot(graph_matrix) + (1-alpha)*pos_ct).tocsr()
+    codon_vals.eliminate_zeros()
+
+    # compute regular entropy for each simulation
+    row = np.repeat(np.arange(num_sim), np.diff(codon_vals.indptr))
+    total = np.bincount(row, weights=codon_vals.data, minlength=num_sim)
+    p = codon_vals.data / total[row]
+    graph_score = np.bincount(row, weights=-p*np.log2(p), minlength=num_sim)
+    coverage = np.diff(codon_vals.indptr)
+
+    # simulations without missense mutations
+    graph_score[num_codons == 0] = 1.0
+    return graph_score, coverage, num_codons
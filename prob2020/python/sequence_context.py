@@ -1,158 +1,288 @@
 import numpy as np
+import pandas as pd
 import prob2020.python.utils as utils
 import prob2020.python.mutation_context
+import os
+import tempfile
+import zlib
+
+# backends for random number generation
+random_backends = ['randomstate', 'generator']
+
+def get_context_cache_dir(opts):
+    """Gets the directory that caches sequence context indexes.
+
+    The directory is specific to the checksum of the gene FASTA file
+    and to the type of sequence context.
+
+    Parameters
+    ----------
+    opts : dict
+        options containing "input" (gene FASTA), "context", and optionally
+        "cache_dir"
+
+    Returns
+    -------
+    cache_dir : str or None
+        cache directory, None if no cache directory was specified
+    """
+    if 'cache_dir' not in opts or not opts['cache_dir']:
+        return None
+    checksum = utils.file_checksum(opts['input'])
+    return os.path.join(opts['cache_dir'], 'context',
+                        '{0}_{1}'.format(checksum, opts['context']))
+
+
+def get_random_backend(opts):
+    """Gets the random number backend specified in the options.
+
+    Parameters
+    ----------
+    opts : dict
+        options, optionally containing "random_backend"
+
+    Returns
+    -------
+    random_backend : str
+        either "randomstate" (default) or "generator"
+    """
+    if 'random_backend' not in opts or not opts['random_backend']:
+        return 'randomstate'
+    return opts['random_backend']
 
 
 class SequenceContext(object):
     """The SequenceContext class allows for deciphering sequence context
     and for randomly permuting mutation positions while respecting sequence context.
+
+    Sequence contexts are stored as integer codes for each position
+    (self.pos_context), while positions are grouped by context in a
+    compressed sparse row layout, where the positions for the i'th context
+    in self.contexts are self.context_pos[self.context_ptr[i]:self.context_ptr[i+1]].
+
+    Context indexes are optionally cached on disk (see get_context_cache_dir),
+    so they do not need to be rebuilt when the same gene FASTA file is used
+    again.
     """
 
-    def __init__(self, gene_seq, seed=None):
-        self._init_context(gene_seq)
+    def __init__(self, gene_seq, seed=None, cache_dir=None,
+                 random_backend='randomstate'):
+        if cache_dir and gene_seq.nuc_context in [1, 2, 1.5, 3]:
+            self._init_cached_context(gene_seq, cache_dir)
+        else:
+            self._init_context(gene_seq)
         self.seed = seed  # seed for random number generator
-        context_names = prob2020.python.mutation_context.get_all_context_names(gene_seq.nuc_context)
-        self.prng_dict = {
-            c: np.random.RandomState(seed=self.seed)
-            for c in context_names
-        }
+        if random_backend not in random_backends:
+            raise ValueError('Unknown random number backend "{0}" (expected one '
+                             'of {1})'.format(random_backend, ', '.join(random_backends)))
+        self.random_backend = random_backend
+        self.gene_name = gene_seq.bed.gene_name
+        # random number generators are created on first use of a context
+        self.prng_dict = {}
+
+    def _get_prng(self, context):
+        """Gets the random number generator for a sequence context.
+
+        With the "randomstate" backend every context uses a RandomState
+        seeded with self.seed. With the "generator" backend each context
+        of each gene uses an independent stream derived from self.seed,
+        the gene name and the context, so draws do not depend on which
+        process simulates a gene.
+
+        Parameters
+        ----------
+        context : str
+            sequence context
+
+        Returns
+        -------
+        prng : np.random.RandomState or np.random.Generator
+            random number generator for the context
+        """
+        if context not in self.prng_dict:
+            if self.random_backend == 'randomstate':
+                self.prng_dict[context] = np.random.RandomState(seed=self.seed)
+            else:
+                spawn_key = (zlib.crc32(self.gene_name.encode('utf8')),
+                             zlib.crc32(context.encode('utf8')))
+                seed_seq = np.random.SeedSequence(self.seed, spawn_key=spawn_key)
+                self.prng_dict[context] = np.random.Generator(np.random.PCG64(seed_seq))
+        return self.prng_dict[context]
 
     def _init_context(self, gene_seq):
         """Initializes attributes defining mutation contexts and their position.
 
-        The self.context2pos and self.pos2context dictionaries map from
-        sequence context to sequence position and sequence position to
-        sequence context, respectively. These attributes allow for randomly
-        sampling of mutation positions while respecting sequence context in the
-        randomization-based test.
+        The self.pos_context array records the sequence context code of each
+        sequence position, while self.context_ptr and self.context_pos group
+        sequence positions by sequence context. These attributes allow for
+        randomly sampling of mutation positions while respecting sequence
+        context in the randomization-based test.
 
         Parameters
         ----------
         gene_seq : GeneSequence
             GeneSequence object from the gene_sequence module
         """
-        self.context2pos, self.pos2context = {}, {}
         gene_len = len(gene_seq.exon_seq)  # get length of CDS
         five_ss_len = 2*len(gene_seq.five_prime_seq)  # total length of 5' splice sites
         three_ss_len = 2*len(gene_seq.three_prime_seq)  # total length of 3' splice sites
+        num_pos = gene_len + five_ss_len + three_ss_len
+
+        # contexts and positions in the order that positions are added to
+        # each context
+        context_list, pos_list = [], []
+        # position whose context differs from the context it was added to
+        last_pos_context = None
 
         if gene_seq.nuc_context in [1, 2]:
             # case where context matters
             index_context = int(gene_seq.nuc_context) - 1  # subtract 1 since python is zero-based index
-            for i in range(index_context, gene_len):
-                nucs = gene_seq.exon_seq[i-index_context:i+1]
-                self.context2pos.setdefault(nucs, [])
-                self.context2pos[nucs].append(i)
-                self.pos2context[i] = nucs
+            context_list += [gene_seq.exon_seq[i-index_context:i+1]
+                             for i in range(index_context, gene_len)]
+            pos_list += range(index_context, gene_len)
 
             # sequence context for five prime splice site
             for i, five_ss in enumerate(gene_seq.five_prime_seq):
-                first_nucs = five_ss[1-index_context:1+1]
-                second_nucs = five_ss[2-index_context:2+1]
-                first_pos = 2*i + gene_len
-                second_pos = 2*i + gene_len + 1
-                self.context2pos.setdefault(first_nucs, [])
-                self.context2pos[first_nucs].append(first_pos)
-                self.context2pos.setdefault(second_nucs, [])
-                self.context2pos[second_nucs].append(second_pos)
-                self.pos2context[first_pos] = first_nucs
-                self.pos2context[second_pos] = second_nucs
+                context_list += [five_ss[1-index_context:1+1], five_ss[2-index_context:2+1]]
+                pos_list += [2*i + gene_len, 2*i + gene_len + 1]
             # sequence context for three prime splice site
             for i, three_ss in enumerate(gene_seq.three_prime_seq):
-                first_nucs = three_ss[1-index_context:1+1]
-                second_nucs = three_ss[2-index_context:2+1]
-                first_pos = 2*i + gene_len + five_ss_len
-                second_pos = 2*i + gene_len + five_ss_len + 1
-                self.context2pos.setdefault(first_nucs, [])
-                self.context2pos[first_nucs].append(first_pos)
-                self.context2pos.setdefault(second_nucs, [])
-                self.context2pos[second_nucs].append(second_pos)
-                self.pos2context[first_pos] = first_nucs
-                self.pos2context[second_pos] = second_nucs
+                context_list += [three_ss[1-index_context:1+1], three_ss[2-index_context:2+1]]
+                pos_list += [2*i + gene_len + five_ss_len, 2*i + gene_len + five_ss_len + 1]
 
             # hack solution for context for first nuc
             if gene_seq.exon_seq and gene_seq.nuc_context > 1:
-                self.pos2context[0] = gene_seq.exon_seq[0] * 2
-                self.context2pos.setdefault(gene_seq.exon_seq[0]*2, [])
-                self.context2pos[gene_seq.exon_seq[0]*2].append(0)
+                context_list.append(gene_seq.exon_seq[0] * 2)
+                pos_list.append(0)
         elif gene_seq.nuc_context in [1.5, 3]:
             # use the nucleotide context from chasm if nuc
             # context is 1.5 otherwise always use a three
             # nucleotide context
-            ncontext = gene_seq.nuc_context
-            for i in range(1, len(gene_seq.exon_seq)-1):
-                nucs = gene_seq.exon_seq[i-1:i+2]
-                if ncontext == 1.5:
-                    context = prob2020.python.mutation_context.get_chasm_context(nucs)
-                else:
-                    context = nucs
-                self.context2pos.setdefault(context, [])
-                self.context2pos[context].append(i)
-                self.pos2context[i] = context
+            if gene_seq.nuc_context == 1.5:
+                chasm_contexts = {}
+                def to_context(nucs):
+                    if nucs not in chasm_contexts:
+                        chasm_contexts[nucs] = prob2020.python.mutation_context.get_chasm_context(nucs)
+                    return chasm_contexts[nucs]
+            else:
+                to_context = lambda nucs: nucs
+            context_list += [to_context(gene_seq.exon_seq[i-1:i+2])
+                             for i in range(1, gene_len-1)]
+            pos_list += range(1, gene_len-1)
 
             # sequence context for five prime splice site
             for i, five_ss in enumerate(gene_seq.five_prime_seq):
-                first_nucs = five_ss[:3]
-                second_nucs = five_ss[1:4]
-                first_pos = 2*i + gene_len
-                second_pos = 2*i + gene_len + 1
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nucs)
-                    second_context = prob2020.python.mutation_context.get_chasm_context(second_nucs)
-                else:
-                    first_context = first_nucs
-                    second_context = second_nucs
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(first_pos)
-                self.context2pos.setdefault(second_context, [])
-                self.context2pos[second_context].append(second_pos)
-                self.pos2context[first_pos] = first_context
-                self.pos2context[second_pos] = second_context
+                context_list += [to_context(five_ss[:3]), to_context(five_ss[1:4])]
+                pos_list += [2*i + gene_len, 2*i + gene_len + 1]
             # sequence context for three prime splice site
             for i, three_ss in enumerate(gene_seq.three_prime_seq):
-                first_nucs = three_ss[:3]
-                second_nucs = three_ss[1:4]
-                first_pos = 2*i + gene_len + five_ss_len
-                second_pos = 2*i + gene_len + five_ss_len + 1
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nucs)
-                    second_context = prob2020.python.mutation_context.get_chasm_context(second_nucs)
-                else:
-                    first_context = first_nucs
-                    second_context = second_nucs
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(first_pos)
-                self.context2pos.setdefault(second_context, [])
-                self.context2pos[second_context].append(second_pos)
-                self.pos2context[first_pos] = first_context
-                self.pos2context[second_pos] = second_context
+                context_list += [to_context(three_ss[:3]), to_context(three_ss[1:4])]
+                pos_list += [2*i + gene_len + five_ss_len, 2*i + gene_len + five_ss_len + 1]
 
             # hack solution for context for first nuc
             if gene_seq.exon_seq:
-                first_nuc = gene_seq.exon_seq[0] + gene_seq.exon_seq[:2]
-                if ncontext == 1.5:
-                    first_context = prob2020.python.mutation_context.get_chasm_context(first_nuc)
-                else:
-                    first_context = first_nuc
-                self.pos2context[0] = first_context
-                self.context2pos.setdefault(first_context, [])
-                self.context2pos[first_context].append(0)
-                last_nuc = gene_seq.exon_seq[-2:] + gene_seq.exon_seq[-1]
-                if ncontext == 1.5:
-                    last_context = prob2020.python.mutation_context.get_chasm_context(last_nuc)
-                else:
-                    last_context = last_nuc
-                last_pos = len(gene_seq.exon_seq) - 1
-                self.pos2context[last_pos] = first_context
-                self.context2pos.setdefault(last_context, [])
-                self.context2pos[last_context].append(last_pos)
+                first_context = to_context(gene_seq.exon_seq[0] + gene_seq.exon_seq[:2])
+                context_list.append(first_context)
+                pos_list.append(0)
+                last_context = to_context(gene_seq.exon_seq[-2:] + gene_seq.exon_seq[-1])
+                context_list.append(last_context)
+                pos_list.append(gene_len - 1)
+                # the last position is recorded as having the context of
+                # the first position
+                last_pos_context = (gene_len - 1, first_context)
         else:
             # case where there is no context,
             # mutations occur with uniform probability at each
             # position
-            for i in range(gene_len + five_ss_len + three_ss_len):
-                self.pos2context[i] = 'None'
-            self.context2pos['None'] = range(gene_len + five_ss_len + three_ss_len)
+            context_list = ['None'] * num_pos
+            pos_list = range(num_pos)
+
+        # group positions by context, keeping the order positions were added
+        context_codes, contexts = pd.factorize(np.array(context_list, dtype=object))
+        self.contexts = list(contexts)
+        order = np.argsort(context_codes, kind='mergesort')
+        self.context_pos = np.asarray(pos_list, dtype=np.int32)[order]
+        context_cts = np.bincount(context_codes, minlength=len(self.contexts))
+        self.context_ptr = np.concatenate([[0], np.cumsum(context_cts)]).astype(np.int64)
+        self.pos_context = np.full(num_pos, -1, dtype=np.int16)
+        self.pos_context[np.asarray(pos_list, dtype=np.int64)] = context_codes
+        if last_pos_context is not None:
+            self.pos_context[last_pos_context[0]] = self.contexts.index(last_pos_context[1])
+        self._context_ix = {c: i for i, c in enumerate(self.contexts)}
+
+    def _init_cached_context(self, gene_seq, cache_dir):
+        """Loads the context indexes for a gene from the cache directory,
+        or creates and caches them if not previously cached.
+
+        Parameters
+        ----------
+        gene_seq : GeneSequence
+            GeneSequence object from the gene_sequence module
+        cache_dir : str
+            directory containing cached context indexes
+        """
+        cache_path = os.path.join(cache_dir, gene_seq.bed.gene_name + '.npz')
+        num_pos = gene_seq.bed.cds_len + gene_seq.bed.five_ss_len + gene_seq.bed.three_ss_len
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                contexts = cached['contexts'].tolist()
+                index = cached['index']
+            # the index array holds the offsets of positions for each context,
+            # the positions for each context and then the context of each position
+            num_ctxt = len(contexts)
+            context_ptr = index[:num_ctxt+1]
+            if len(index) == num_ctxt + 1 + context_ptr[-1] + num_pos:
+                self.contexts = contexts
+                self.context_ptr = context_ptr.astype(np.int64)
+                self.context_pos = index[num_ctxt+1:num_ctxt+1+context_ptr[-1]].astype(np.int32)
+                self.pos_context = index[num_ctxt+1+context_ptr[-1]:].astype(np.int16)
+                self._context_ix = {c: i for i, c in enumerate(self.contexts)}
+                return
+
+        # create the indexes and save them in the cache
+        self._init_context(gene_seq)
+        index = np.concatenate([self.context_ptr, self.context_pos, self.pos_context]).astype(np.int64)
+
+        # write to a temporary file first, so other processes never read a
+        # partially written file
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as handle:
+            np.savez(handle, contexts=np.array(self.contexts, dtype=str), index=index)
+        os.replace(tmp_path, cache_path)
+
+    @property
+    def context2pos(self):
+        """Dictionary mapping sequence context to an array of sequence positions."""
+        return {c: self.context_pos[self.context_ptr[i]:self.context_ptr[i+1]]
+                for i, c in enumerate(self.contexts)}
+
+    @property
+    def pos2context(self):
+        """Dictionary mapping sequence position to sequence context."""
+        return {i: self.contexts[code]
+                for i, code in enumerate(self.pos_context.tolist())
+                if code >= 0}
+
+    def get_contexts(self, positions):
+        """Returns the sequence context of each sequence position.
+
+        Parameters
+        ----------
+        positions : array-like
+            sequence positions
+
+        Returns
+        -------
+        contexts : np.array
+            sequence context for each position
+        """
+        codes = self.pos_context[np.asarray(positions, dtype=np.int64)]
+        if np.any(codes < 0):
+            missing = np.asarray(positions)[codes < 0]
+            raise KeyError('No sequence context for position(s) {0}'.format(list(missing)))
+        return np.array(self.contexts, dtype=object)[codes]
 
     def is_valid_context(self, ctxt):
         """Checks if provided context is valid (previously seen).
@@ -162,7 +292,23 @@ class SequenceContext(object):
         ctxt : str
             mutation context
         """
-        return ctxt in self.context2pos
+        return ctxt in self._context_ix
+
+    def context_positions(self, context):
+        """Gets all positions in the gene with the sequence context.
+
+        Parameters
+        ----------
+        context : str
+            Sequence context.
+
+        Returns
+        -------
+        positions : np.array
+            positions (0-based) having the sequence context
+        """
+        ix = self._context_ix[context]
+        return self.context_pos[self.context_ptr[ix]:self.context_ptr[ix+1]]
 
     def random_context_pos(self, num, num_permutations, context):
         """Samples with replacement available positions matching the
@@ -200,8 +346,13 @@ class SequenceContext(object):
             raise ValueError(error_msg)
 
         # randomly select from available positions that fit the specified context
-        available_pos = self.context2pos[context]
-        random_pos = self.prng_dict[context].choice(available_pos, (num_permutations, num))
+        available_pos = self.context_positions(context)
+        prng = self._get_prng(context)
+        if self.random_backend == 'randomstate':
+            random_pos = prng.choice(available_pos, (num_permutations, num))
+        else:
+            random_ix = prng.integers(0, len(available_pos), size=(num_permutations, num))
+            random_pos = available_pos[random_ix]
         return random_pos
 
     def random_pos(self, context_iterable, num_permutations):
@@ -3,6 +3,7 @@ from prob2020.python.bed_line import BedLine
 import numpy as np
 import pandas as pd
 import csv
+import hashlib
 from collections import OrderedDict
 from functools import wraps
 import warnings
@@ -15,6 +16,9 @@ import sys
 
 logger = logging.getLogger(__name__)  # module logger
 
+# checksums of files already computed in this process
+_file_checksums = {}
+
 # small epsilon value to prevent issues with machine decimal precision
 epsilon = 0.0001
 
@@ -72,6 +76,27 @@ variant_indel = variant_frameshift + variant_in_frame_indel
 # all variants
 all_variants = variant_snv + variant_indel
 
+##############################
+# Integer codes used by the array-based
+# simulations. The position of a letter
+# in the string is its integer code.
+##############################
+# nucleotides, anything else is treated as 'N'
+nuc_letters = 'ACGTN'
+nuc_code = {nuc: i for i, nuc in enumerate(nuc_letters)}
+
+# amino acid residues, including stop codons and splice sites
+aa_letters = 'ACDEFGHIKLMNPQRSTVWY*'
+aa_code = {aa: i for i, aa in enumerate(aa_letters)}
+aa_code['Splice_Site'] = len(aa_letters)
+stop_code = aa_code['*']
+splice_code = aa_code['Splice_Site']
+missing_aa_code = -1  # residue can not be determined, e.g. "N" in codon
+
+# mutation effect classes are the position in variant_snv
+effect_code = {v: i for i, v in enumerate(variant_snv)}
+missing_effect_code = -1  # effect can not be determined
+
 def start_logging(log_file='', log_level='INFO', verbose=False):
     """Start logging information into the log directory.
 
@@ -146,6 +171,17 @@ def keyboard_exit_wrapper(func):
     return wrap
 
 
+def file_checksum(path):
+    """Computes the MD5 checksum of a file once per process."""
+    if path not in _file_checksums:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b''):
+                md5.update(chunk)
+        _file_checksums[path] = md5.hexdigest()
+    return _file_checksums[path]
+
+
 def filter_list(mylist, bad_ixs):
     """Removes indices from a list.
 
@@ -191,24 +227,6 @@ def rev_comp(seq):
     return rev_comp_seq
 
 
-def is_valid_nuc(nuc):
-    """Check if valid single letter base.
-
-    Parameters
-    ----------
-    nuc : str
-        String to check if valid single nucleotide base
-
-    Returns
-    -------
-    is_valid : bool
-        flag indicating valid nucleotide base
-    """
-    valid_nucs = ['A', 'C', 'T', 'G', 'N']
-    is_valid = nuc in valid_nucs
-    return is_valid
-
-
 def bed_generator(bed_path):
     """Iterates through a BED file yielding parsed BED lines.
 
@@ -291,11 +309,10 @@ def _fix_mutation_df(mutation_df, only_unique=False):
     logger.info(log_msg)
 
     # check if mutations are valid SNVs
-    valid_nuc_flag = (mutation_df['Reference_Allele'].apply(is_valid_nuc) & \
-                      mutation_df['Tumor_Allele'].apply(is_valid_nuc))
+    valid_nucs = ['A', 'C', 'T', 'G', 'N']
+    valid_nuc_flag = (mutation_df['Reference_Allele'].isin(valid_nucs) & \
+                      mutation_df['Tumor_Allele'].isin(valid_nucs))
     mutation_df = mutation_df[valid_nuc_flag]  # filter bad lines
-    mutation_df = mutation_df[mutation_df['Tumor_Allele'].apply(lambda x: len(x)==1)]
-    mutation_df = mutation_df[mutation_df['Reference_Allele'].apply(lambda x: len(x)==1)]
     valid_len = len(mutation_df)
 
     # log the number of dropped mutations
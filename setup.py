@@ -62,7 +62,9 @@ else:
                   'probabilistic2020 = prob2020.console.probabilistic2020:cli_main',
                   'mut_annotate = prob2020.console.annotate:cli_main',
                   'extract_gene_seq = prob2020.console.extract_gene_seq:cli_main',
-                  'simulate_non_silent_ratio = prob2020.console.simulate_non_silent_ratio:cli_main'
+                  'simulate_non_silent_ratio = prob2020.console.simulate_non_silent_ratio:cli_main',
+                  'convert_scores = prob2020.console.convert_scores:cli_main',
+                  'prepare_mutations = prob2020.console.prepare_mutations:cli_main'
               ]
           },
           long_description=open('README.rst').read(),
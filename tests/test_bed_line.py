@@ -0,0 +1,35 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+
+import prob2020.python.utils as utils
+import numpy as np
+
+
+def test_query_positions():
+    for bed_file in ['data/CTNNB1.bed', 'data/tp53.bed']:
+        bed_path = os.path.join(file_dir, bed_file)
+        for bed in utils.bed_generator(bed_path):
+            # query every position around the gene, including splice sites
+            coords = np.arange(bed.exons[0][0]-5, bed.exons[-1][1]+5)
+            for strand in ['+', '-']:
+                pos = bed.query_positions(strand, coords)
+                for c, p in zip(coords, pos):
+                    expected = bed.query_position(strand, bed.chrom, int(c))
+                    if expected is None:
+                        assert np.isnan(p), 'Position {0} should not be mapped'.format(c)
+                    else:
+                        assert p == expected, 'Position {0} maps to {1} instead of {2}'.format(c, p, expected)
+
+
+def test_seq_to_genome():
+    for bed_file in ['data/CTNNB1.bed', 'data/tp53.bed']:
+        bed_path = os.path.join(file_dir, bed_file)
+        for bed in utils.bed_generator(bed_path):
+            # every coding position should map back to itself
+            seq_pos = np.arange(bed.cds_len)
+            genome_pos = bed.seq_to_genome(seq_pos)
+            for p, c in zip(seq_pos, genome_pos):
+                assert bed.query_position(bed.strand, bed.chrom, int(c)) == p
@@ -38,6 +38,28 @@ def test_tp53_main():
     assert result.ix[0, 'inactivating p-value'] < 0.001, 'TP53 should have a very low p-value ({0}>.001)'.format(result[0][2])
 
 
+def test_tp53_exact():
+    opts = {'input': os.path.join(file_dir, 'data/tp53.fa'),
+            'bed': os.path.join(file_dir, 'data/tp53.bed'),
+            'mutations': os.path.join(file_dir, 'data/tp53_mutations.txt'),
+            'output': None,
+            'context': 1,
+            'use_unmapped': False,
+            'deleterious': 5,
+            'processes': 0,
+            'num_iterations': 10000,
+            'stop_criteria': 100,
+            'deleterious_pseudo_count': 0,
+            'unique': False,
+            'seed': None,
+            'exact': True,
+            'kind': 'tsg'}
+    # exact p-values are not limited by the number of simulations
+    result = pt.main(opts)
+    pval = result['inactivating p-value'].iloc[0]
+    assert 0 < pval < 1e-4, 'TP53 should have a very low p-value ({0}>1e-4)'.format(pval)
+
+
 def test_100genes_main():
     opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
             'bed': os.path.join(file_dir, 'data/100genes.bed'),
@@ -73,5 +95,70 @@ def test_100genes_main():
     assert num_del_sig < 7, 'Few of the 100 test genes should not be significant ({0})'.format(num_del_sig)
 
 
+def test_100genes_processes():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': None,
+            'context': 1,
+            'use_unmapped': False,
+            'deleterious': 5,
+            'processes': 0,
+            'num_iterations': 1000,
+            'stop_criteria': 100,
+            'deleterious_pseudo_count': 0,
+            'unique': False,
+            'seed': 101,
+            'kind': 'tsg'}
+    # results should not depend on how genes are scheduled across processes
+    single_result = pt.main(opts).sort_index()
+    opts['processes'] = 2
+    multi_result = pt.main(opts).sort_index()
+    assert single_result.equals(multi_result), 'Results differ when using multiple processes'
+
+    # pass mutations through shared memory
+    opts['shared_memory'] = True
+    shared_result = pt.main(opts).sort_index()
+    assert single_result.equals(shared_result), 'Results differ when using shared memory'
+
+    # independent random streams for each gene and context
+    opts['random_backend'] = 'generator'
+    opts['processes'] = 0
+    single_result = pt.main(opts).sort_index()
+    opts['processes'] = 2
+    multi_result = pt.main(opts).sort_index()
+    assert single_result.equals(multi_result), 'Results differ when using multiple processes'
+
+
+def test_100genes_sequential():
+    opts = {'input': os.path.join(file_dir, 'data/100genes.fa'),
+            'bed': os.path.join(file_dir, 'data/100genes.bed'),
+            'mutations': os.path.join(file_dir, 'data/100genes_mutations.txt'),
+            'output': None,
+            'context': 1,
+            'use_unmapped': False,
+            'deleterious': 1,
+            'processes': 0,
+            'num_iterations': 10000,
+            'stop_criteria': 10000,
+            'deleterious_pseudo_count': 0,
+            'unique': False,
+            'seed': 101,
+            'sequential_threshold': .05,
+            'kind': 'tsg'}
+    result = pt.main(opts)
+    result = result[result['inactivating p-value'].notnull()]
+    lower = result['inactivating p-value lower']
+    upper = result['inactivating p-value upper']
+    pval = result['inactivating p-value']
+    assert len(result), 'Some genes should have been tested'
+    assert np.all((lower <= pval) & (pval <= upper)), 'p-value should be within its interval'
+
+    # simulations stop once the interval excludes the threshold, unless
+    # the maximum number of iterations was reached
+    is_decided = (lower > .05) | (upper < .05)
+    assert np.all(is_decided | (upper - lower < .02)), 'Simulations stopped too early'
+
+
 if __name__ == "__main__":
     test_100genes_main()
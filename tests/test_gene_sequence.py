@@ -41,3 +41,77 @@ def test_pos_to_codon():
         results.append(codon_info)
     true_results = [('ACA', 0, 1, 'C'), ('GAT', 4, 0, 'G'), ('CCG', 5, 2, 'G')]
     assert results == true_results, 'Codon information is incorrect'
+
+
+def test_effect_table():
+    import prob2020.python.mutation_context as mc
+    import numpy as np
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+
+    # compare lookup table against the string based amino acid info
+    num_pos = bed.cds_len + bed.five_ss_len + bed.three_ss_len
+    pos = np.repeat(np.arange(num_pos), len(utils.nuc_letters))
+    somatic_base = list(utils.nuc_letters) * num_pos
+    aa_info = mc.get_aa_mut_info(pos, somatic_base, gs)
+    aa_info_batch = mc.get_aa_mut_info_batch(pos[np.newaxis, :], somatic_base, gs)
+    code2aa = {v: k for k, v in utils.aa_code.items()}
+    code2aa[utils.missing_aa_code] = None
+    for key in ['Reference AA', 'Somatic AA']:
+        batch_aa = [code2aa[c] for c in aa_info_batch[key][0]]
+        assert batch_aa == aa_info[key], '{0} does not match'.format(key)
+    batch_codon = [(c if c >= 0 else None) for c in aa_info_batch['Codon Pos'][0]]
+    assert batch_codon == aa_info['Codon Pos'], 'Codon position does not match'
+
+    # compare the variant classification
+    var_class = cutils.get_variant_classification(aa_info['Reference AA'],
+                                                  aa_info['Somatic AA'],
+                                                  aa_info['Codon Pos'])
+    code2effect = {v: k for k, v in utils.effect_code.items()}
+    code2effect[utils.missing_effect_code] = ''
+    batch_class = [code2effect[c] for c in aa_info_batch['Effect'][0]]
+    assert batch_class == [v.decode() for v in var_class], 'Effect does not match'
+
+    # updating the sequence should also update the table
+    gs.add_germline_variants(['T'], [2])
+    assert code2aa[gs.get_effect_table()['Reference AA'][0]] == 'T'
+
+
+def test_batch_pos_info():
+    import prob2020.python.batch_stats as batch_stats
+    import numpy as np
+
+    # random amino acid changes, concentrated on a few codons so that some
+    # positions are recurrent
+    prng = np.random.RandomState(101)
+    num_sim, num_mut = 60, 12
+    residues = list('ACDMW*') + ['Splice_Site']
+    ref_aa = prng.choice(residues, size=(num_sim, num_mut))
+    somatic_aa = prng.choice(residues, size=(num_sim, num_mut))
+    codon_pos = prng.randint(0, 6, size=(num_sim, num_mut))
+    is_splice = (ref_aa == 'Splice_Site') | (somatic_aa == 'Splice_Site')
+    ref_aa[is_splice] = somatic_aa[is_splice] = 'Splice_Site'
+    codon_pos[is_splice] = -1
+
+    # simulations without missense mutations
+    somatic_aa[:5] = ref_aa[:5]
+    somatic_aa[5:8] = '*'
+
+    effect = np.empty((num_sim, num_mut), dtype=int)
+    for i in range(num_sim):
+        var_class = cutils.get_variant_classification(ref_aa[i], somatic_aa[i], codon_pos[i])
+        effect[i] = [utils.effect_code[v.decode()] for v in var_class]
+
+    params = [{'min_frac': .02, 'min_recur': 3},
+              {'min_frac': .3, 'min_recur': 2},
+              {'is_obs': 0},
+              {'pseudo_count': 2, 'is_obs': 0}]
+    for kwargs in params:
+        num_recur, frac_pos_ent, delta_pos_ent = batch_stats.calc_pos_info(codon_pos, effect, **kwargs)
+        for i in range(num_sim):
+            pos = [(p if p >= 0 else None) for p in codon_pos[i].tolist()]
+            true_info = cutils.calc_pos_info(pos, ref_aa[i].tolist(),
+                                             somatic_aa[i].tolist(), **kwargs)
+            assert num_recur[i] == true_info[0], 'Recurrent count does not match'
+            assert np.isclose(frac_pos_ent[i], true_info[1]), 'Entropy fraction does not match'
+            assert np.isclose(delta_pos_ent[i], true_info[2]), 'Delta entropy does not match'
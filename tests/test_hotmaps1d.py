@@ -5,6 +5,9 @@ file_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(file_dir, '..'))
 
 import prob2020.console.randomization_test as rt
+import prob2020.python.batch_stats as batch_stats
+from prob2020.python.empirical_null import EmpiricalNull
+import prob2020.python.utils as utils
 import numpy as np
 
 def test_ctnnb1_hotmaps_main():
@@ -57,5 +60,47 @@ def test_100genes_main():
     assert num_sig < 9, 'Few of the 100 test genes should not be significant ({0})'.format(num_sig)
 
 
+def test_batch_windowed_sum():
+    prng = np.random.RandomState(101)
+    num_sim, num_mut = 50, 20
+    codon_pos = prng.randint(0, 30, size=(num_sim, num_mut))
+    codon_pos[:, -1] = -1  # splice site
+    aa = np.array(list(utils.aa_letters))
+    ref_aa = prng.randint(0, len(aa), size=(num_sim, num_mut))
+    somatic_aa = prng.randint(0, len(aa), size=(num_sim, num_mut))
+    somatic_aa[:, 0] = ref_aa[:, 0]  # silent
+    ref_aa[:, -1] = somatic_aa[:, -1] = utils.splice_code
+    window = [3, 6]
+    pos_sim, pos_ct, pos_sum = batch_stats.calc_windowed_sum(codon_pos, ref_aa,
+                                                             somatic_aa, window)
+    for i in range(num_sim):
+        ref = [aa[r] if r != utils.splice_code else 'Splice_Site' for r in ref_aa[i]]
+        som = [aa[r] if r != utils.splice_code else 'Splice_Site' for r in somatic_aa[i]]
+        pos = [p if p >= 0 else None for p in codon_pos[i]]
+        true_ct, true_sum = utils.calc_windowed_sum(pos, ref, som, window)
+        is_sim = pos_sim == i
+        assert list(pos_ct[is_sim]) == [true_ct[k] for k in sorted(true_ct)]
+        for w in window:
+            assert list(pos_sum[w][is_sim]) == [true_sum[w][k] for k in sorted(true_sum[w])]
+
+
+def test_empirical_null_merge():
+    prng = np.random.RandomState(101)
+    vals1 = prng.randint(1, 10, size=100)
+    vals2 = prng.randint(1, 15, size=50)
+    null1 = EmpiricalNull([3], 10)
+    null1.add(3, vals1)
+    null2 = EmpiricalNull([3], 15)
+    null2.add(3, vals2)
+    null1.merge(null2)
+
+    # p-values should match the merged values
+    all_vals = np.concatenate([vals1, vals2])
+    obs = np.arange(0, 20)
+    true_pvals = [np.mean(all_vals >= o) for o in obs]
+    assert null1.num_sim(3) == len(all_vals)
+    assert np.allclose(null1.p_values(3, obs), true_pvals)
+
+
 if __name__ == '__main__':
     test_100genes_main()
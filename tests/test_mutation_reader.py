@@ -0,0 +1,90 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+
+import prob2020.python.mutation_reader as mr
+import prob2020.python.mutation_context as mc
+import prob2020.python.utils as utils
+from prob2020.python.gene_sequence import GeneSequence
+import pandas as pd
+import pysam
+
+
+def test_read_mutations():
+    # file with MAF column names
+    mut_path = os.path.join(file_dir, 'data/100genes_mutations.txt')
+    mut_df = mr.read_mutations(mut_path, chunksize=1000)
+    true_df = pd.read_csv(mut_path, sep='\t').rename(columns=mr.rename_dict)
+    assert list(mut_df.columns) == [c for c in true_df.columns if c in mr.mutation_cols]
+    assert len(mut_df) == len(true_df)
+    assert mut_df['Start_Position'].dtype.kind == 'i'
+    for col in mr.category_cols:
+        if col in mut_df.columns:
+            assert isinstance(mut_df[col].dtype, pd.CategoricalDtype), col
+    for col in mut_df.columns:
+        assert (mut_df[col] == true_df[col]).all(), col
+
+    # only valid single nucleotide variants are kept
+    snv_df = utils._fix_mutation_df(mut_df)
+    is_snv = (true_df['Variant_Classification'].isin(utils.variant_snv) &
+              true_df['Reference_Allele'].isin(list('ACGTN')) &
+              true_df['Tumor_Allele'].isin(list('ACGTN')))
+    assert len(snv_df) == is_snv.sum()
+    assert (snv_df['Start_Position'] == true_df.loc[is_snv, 'Start_Position'] - 1).all()
+
+
+def test_prepared_mutations():
+    mut_path = os.path.join(file_dir, 'data/100genes_mutations.txt')
+    mut_df = mr.read_mutations(mut_path)
+
+    # mutations are identical after a round trip through a prepared file
+    prepared_path = os.path.join(file_dir, 'output/100genes_mutations.npz')
+    mr.write_prepared_mutations(mut_df, prepared_path, mut_path)
+    assert mr.is_prepared_mutations(prepared_path)
+    assert not mr.is_prepared_mutations(mut_path)
+    pd.testing.assert_frame_equal(mr.read_mutations(prepared_path), mut_df)
+
+    # prepared files are cached by the checksum of the mutation file
+    cache_dir = os.path.join(file_dir, 'output/cache')
+    cache_path = os.path.join(cache_dir, 'mutations', utils.file_checksum(mut_path) + '.npz')
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    pd.testing.assert_frame_equal(mr.read_mutations(mut_path, cache_dir=cache_dir), mut_df)
+    assert os.path.exists(cache_path)
+    pd.testing.assert_frame_equal(mr.read_mutations(mut_path, cache_dir=cache_dir), mut_df)
+
+
+def test_annotated_snvs():
+    data_dir = os.path.join(file_dir, 'data')
+    opts = {'mutations': os.path.join(data_dir, '100genes_mutations.txt'),
+            'bed': os.path.join(data_dir, '100genes.bed'),
+            'input': os.path.join(data_dir, '100genes.fa'),
+            'context': 1.5, 'use_unmapped': False,
+            'cache_dir': os.path.join(file_dir, 'output/cache')}
+    cache_path = mr.annotated_cache_path(opts)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    # annotated SNVs are loaded from the cache once written
+    snv_df = mc.select_snvs(None, opts)
+    assert os.path.exists(cache_path)
+    pd.testing.assert_frame_equal(mc.select_snvs(None, opts), snv_df)
+
+    # annotated SNVs give the same contexts as annotating each gene
+    raw_df = mc.select_snvs(None, opts, use_cache=False)
+    assert 'Context' not in raw_df.columns
+    gene_fa = pysam.Fastafile(opts['input'])
+    gs = GeneSequence(gene_fa, nuc_context=opts['context'])
+    bed_dict = utils.read_bed(opts['bed'])
+    for bed in [b for chrom in bed_dict for b in bed_dict[chrom]]:
+        raw_gene_df = raw_df[raw_df['Gene'] == bed.gene_name]
+        snv_gene_df = snv_df[snv_df['Gene'] == bed.gene_name]
+        raw_result = mc.compute_mutation_context(bed, gs, raw_gene_df, opts)
+        snv_result = mc.compute_mutation_context(bed, gs, snv_gene_df, opts)
+        assert raw_result[0].to_dict() == snv_result[0].to_dict(), bed.gene_name
+        cols = ['Context', 'Tumor_Allele', 'Coding Position']
+        assert (raw_result[2][cols].astype(str).values ==
+                snv_result[2][cols].astype(str).values).all(), bed.gene_name
+    gene_fa.close()
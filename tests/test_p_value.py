@@ -0,0 +1,68 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+
+import prob2020.python.p_value as mypval
+import prob2020.python.mymath as mymath
+import itertools
+import numpy as np
+import scipy.stats as stats
+
+
+def test_p_adjust():
+    pvals = np.array([.01, np.nan, .04, .03, np.nan, .5])
+
+    # results from p.adjust in R, which removes NA values
+    bh_qvals = mypval.bh_fdr(pvals)
+    assert np.allclose(bh_qvals[~np.isnan(pvals)], [.04, .05333333, .05333333, .5])
+    assert np.isnan(bh_qvals[[1, 4]]).all()
+    by_qvals = mypval.p_adjust(pvals, method='BY')
+    assert np.allclose(by_qvals[~np.isnan(pvals)], [.08333333, .1111111, .1111111, 1.])
+
+    # columns are adjusted separately
+    qvals = mypval.p_adjust(np.c_[pvals, pvals[::-1]])
+    assert np.allclose(qvals[:, 0], bh_qvals, equal_nan=True)
+    assert np.allclose(qvals[:, 1], bh_qvals[::-1], equal_nan=True)
+
+
+def test_combine_p_values():
+    prng = np.random.RandomState(101)
+    pvals = prng.rand(20, 3)
+    weights = [1, 2, 3]
+    fisher_pvals = mypval.combine_p_values(pvals, method='fisher')
+    stouffer_pvals = mypval.combine_p_values(pvals, method='stouffer', weights=weights)
+    for i in range(len(pvals)):
+        # compare with the scipy implementation
+        assert np.isclose(fisher_pvals[i], stats.combine_pvalues(pvals[i], method='fisher')[1])
+        assert np.isclose(stouffer_pvals[i], stats.combine_pvalues(pvals[i], method='stouffer',
+                                                                   weights=weights)[1])
+        assert np.isclose(mypval.fishers_method(pvals[i]), fisher_pvals[i])
+
+    # weighted cauchy combination, T = .25*tan(.49*pi) + .75*tan(.3*pi)
+    cauchy_pval = mypval.combine_p_values([[.01, .2]], method='cauchy', weights=[1, 3])[0]
+    assert np.isclose(cauchy_pval, 0.0352722061844)
+
+    # equal p-values combine to the same value with stouffer and cauchy
+    same_pvals = np.repeat([[.001], [.2], [.9]], 3, axis=1)
+    for method in ['stouffer', 'cauchy']:
+        combined_pvals = mypval.combine_p_values(same_pvals, method=method)
+        assert np.all(np.diff(combined_pvals) > 0)
+    assert np.allclose(mypval.combine_p_values(same_pvals, method='cauchy'), same_pvals[:, 0])
+    assert mypval.combine_p_values([[1e-300, .9]], method='cauchy')[0] > 0
+
+
+def test_poisson_binomial_pmf():
+    probs = [.1, .5, .8]
+    counts = [2, 1, 3]
+
+    # enumerate the outcome of every trial
+    trial_probs = np.repeat(probs, counts)
+    expected = np.zeros(len(trial_probs)+1)
+    for outcome in itertools.product([0, 1], repeat=len(trial_probs)):
+        outcome = np.array(outcome)
+        expected[outcome.sum()] += np.prod(np.where(outcome, trial_probs, 1-trial_probs))
+
+    assert np.allclose(mymath.poisson_binomial_pmf(probs, counts), expected)
+    assert np.allclose(mymath.poisson_binomial_pmf(trial_probs), expected)
@@ -0,0 +1,167 @@
+# fix problems with pythons terrible import system
+import os
+import sys
+file_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(file_dir, '../'))
+
+import prob2020.python.scores as scores
+import prob2020.python.score_store as score_store
+import prob2020.python.utils as utils
+import numpy as np
+import pickle
+import shutil
+
+
+def test_compute_ng_stat_batch():
+    # random neighbor graph of nearby codons
+    prng = np.random.RandomState(101)
+    num_codons = 60
+    gene_graph = {i: set(prng.randint(max(i-5, 0), min(i+6, num_codons), size=4))
+                  for i in range(num_codons)}
+    graph_matrix, is_node = scores.neighbor_graph_matrix(gene_graph)
+
+    # random missense mutations for each simulation
+    num_sim = 30
+    sim_ix = np.sort(prng.randint(0, num_sim-1, size=200))  # last simulation has no mutations
+    codon_pos = prng.randint(0, num_codons, size=200)
+    graph_score, coverage, num_codons_mut = scores.compute_ng_stat_batch(graph_matrix, is_node,
+                                                                         sim_ix, codon_pos,
+                                                                         num_sim)
+    for i in range(num_sim):
+        pos, cts = np.unique(codon_pos[sim_ix==i], return_counts=True)
+        pos_ct = dict(zip(pos, cts))
+        true_score, true_coverage = scores.compute_ng_stat(gene_graph, pos_ct)
+        assert np.isclose(graph_score[i], true_score)
+        assert coverage[i] == true_coverage
+        assert num_codons_mut[i] == len(pos_ct)
+
+
+def test_score_store():
+    score_dir = os.path.join(file_dir, 'data/scores/')
+    store_path = os.path.join(file_dir, 'output/scores.store')
+    score_store.write_score_store(store_path, score_dir=score_dir)
+    assert score_store.is_score_store(store_path)
+    assert not score_store.is_score_store(score_dir)
+
+    for gene in ['CTNNB1', 'A1CF', 'A2M']:
+        true_mga = score_store._read_pickle(os.path.join(score_dir, gene+'.mgaentropy.pickle'))
+        store_mga = score_store.open_score_store(store_path).gene_mga(gene)
+        assert np.array_equal(store_mga, true_mga)
+
+        # look up every VEST score plus some missing ones
+        gene_vest = scores.read_vest_pickle(gene, score_dir)
+        store_vest = scores.read_vest_pickle(gene, store_path)
+        ref_aa, somatic_aa, codon_pos = [], [], []
+        for pos in gene_vest:
+            for ref in gene_vest[pos]:
+                for somatic in list(gene_vest[pos][ref]) + ['Splice_Site', '*']:
+                    ref_aa.append(ref)
+                    somatic_aa.append(somatic)
+                    codon_pos.append(pos-1)
+        ref_aa += ['A', 'A', 'Splice_Site']
+        somatic_aa += ['C', 'C', 'Splice_Site']
+        codon_pos += [len(gene_vest)+100, None, 0]
+        true_scores = scores.fetch_vest_scores(gene_vest, ref_aa, somatic_aa, codon_pos, -1.0)
+        store_scores = scores.fetch_vest_scores(store_vest, ref_aa, somatic_aa, codon_pos, -1.0)
+        assert np.array_equal(store_scores, true_scores)
+
+    # genes without scores
+    assert scores.read_vest_pickle('NOT_A_GENE', store_path) is None
+
+
+def test_score_store_sizes():
+    score_dir = os.path.join(file_dir, 'data/scores/')
+    genes = sorted(set(f.split('.')[0] for f in os.listdir(score_dir)))
+    store_path = os.path.join(file_dir, 'output/score_store_sizes.store')
+
+    # the length of the header changes with the number of genes
+    for num_genes in [1, 4, 17, 50, 79, 91, len(genes)]:
+        store_dir = os.path.join(file_dir, 'output/score_store_sizes')
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        os.makedirs(store_dir)
+        for gene in genes[:num_genes]:
+            for kind in ['vest', 'mgaentropy']:
+                shutil.copy(os.path.join(score_dir, '{0}.{1}.pickle'.format(gene, kind)), store_dir)
+        score_store.write_score_store(store_path, score_dir=store_dir)
+        store = score_store.ScoreStore(store_path)
+        assert store.genes == genes[:num_genes]
+        gene = genes[num_genes-1]
+        true_mga = score_store._read_pickle(os.path.join(score_dir, gene+'.mgaentropy.pickle'))
+        assert np.array_equal(store.gene_mga(gene), true_mga)
+
+    # neighbor graph of a gene named after a clone, in the score directory
+    with open(os.path.join(store_dir, 'AC004381.6.pickle'), 'wb') as handle:
+        pickle.dump({0: set([1]), 1: set([0, 2])}, handle)
+    score_store.write_score_store(store_path, score_dir=store_dir, graph_dir=store_dir)
+    store = score_store.ScoreStore(store_path)
+    assert store.genes == sorted(genes + ['AC004381.6'])
+    assert store.gene_graph('AC004381.6') == {0: set([1]), 1: set([0, 2])}
+    assert store.gene_graph(genes[0]) is None
+
+
+def test_vest_scores_unknown_residues():
+    # residues without a code, e.g. "U" (selenocysteine), are skipped. They
+    # are never the result of translating a codon.
+    vest_dict = {1: {'A': {'C': .5, 'U': .7}}, 2: {'U': {'A': .9}}, 3: {'C': {'D': .1}}}
+    gene_vest = score_store.VestScores.from_dict(vest_dict)
+    assert gene_vest.ref_aa.tolist() == [utils.aa_code['A'], utils.missing_aa_code, utils.aa_code['C']]
+    ref_aa, somatic_aa, codon_pos = ['A', 'A', 'C'], ['C', 'D', 'D'], [0, 0, 2]
+    vest_scores = gene_vest.fetch(ref_aa, somatic_aa, codon_pos, default_vest=-1.0)
+    assert vest_scores == [.5, -1.0, .1]
+    assert vest_scores == scores.fetch_vest_scores(vest_dict, ref_aa, somatic_aa, codon_pos, -1.0)
+
+
+def test_compute_vest_stat_batch():
+    score_dir = os.path.join(file_dir, 'data/scores/')
+    gene_vest = scores.read_vest_pickle('CTNNB1', score_dir)
+
+    # random mutations, including residues without scores and splice sites
+    prng = np.random.RandomState(101)
+    num_sim, num_mut = 50, 20
+    codon_pos = prng.randint(-1, len(gene_vest)+5, size=(num_sim, num_mut))
+    ref_aa = prng.randint(-1, len(utils.aa_letters), size=(num_sim, num_mut))
+    somatic_aa = prng.randint(-1, len(utils.aa_letters)+1, size=(num_sim, num_mut))
+    for i in range(num_sim):
+        # use the true reference residue for most mutations
+        for j in range(num_mut):
+            pos = codon_pos[i, j] + 1
+            if pos in gene_vest and j % 4:
+                ref_aa[i, j] = utils.aa_code[list(gene_vest[pos])[0]]
+    vest_stat = scores.compute_vest_stat_batch(gene_vest, ref_aa, somatic_aa, codon_pos)
+
+    code2aa = dict((v, k) for k, v in utils.aa_code.items())
+    for i in range(num_sim):
+        true_stat = scores.compute_vest_stat(gene_vest,
+                                             [code2aa.get(a) for a in ref_aa[i]],
+                                             [code2aa.get(a) for a in somatic_aa[i]],
+                                             [(p if p >= 0 else None) for p in codon_pos[i]])
+        assert np.isclose(vest_stat[i], true_stat)
+
+
+def test_score_provider():
+    score_dir = os.path.join(file_dir, 'data/scores/')
+    genes = ['CTNNB1', 'A1CF', 'A2M']
+
+    # scores are identical to those in the pickle files
+    provider = scores.ScoreProvider(score_dir)
+    for gene in genes:
+        vest_path = os.path.join(score_dir, gene+'.vest.pickle')
+        assert provider.vest(gene) == scores._read_pickle(vest_path)
+        mga_path = os.path.join(score_dir, gene+'.mgaentropy.pickle')
+        assert np.array_equal(provider.mga(gene), scores._read_pickle(mga_path))
+        # scores are only read once
+        assert provider.vest(gene) is provider.vest(gene)
+    assert provider.vest('NOT_A_GENE') is None
+
+    # least recently used genes are dropped once over the memory budget
+    provider = scores.ScoreProvider(score_dir, max_bytes=1)
+    first_vest = provider.vest(genes[0])
+    provider.vest(genes[1])
+    assert len(provider._cache) == 1
+    assert provider.vest(genes[0]) is not first_vest
+    assert provider.vest(genes[0]) == first_vest
+
+    # providers are shared, and passed through as is
+    assert scores.get_score_provider(score_dir) is scores.get_score_provider(score_dir)
+    assert scores.get_score_provider(provider) is provider
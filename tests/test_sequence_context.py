@@ -10,6 +10,9 @@ from prob2020.python.gene_sequence import GeneSequence
 from prob2020.python.sequence_context import SequenceContext
 import prob2020.python.utils as utils
 import pysam
+import numpy as np
+import tempfile
+import shutil
 
 # set up global variables
 fake_fasta = os.path.join(file_dir, 'data/fake_sequence.fa')
@@ -77,6 +80,47 @@ def test_no_context_constructor():
     _check_true_context_pos(sc, true_ctxt2pos)
 
 
+def test_cached_context():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for nuc_context in [1, 2, 1.5, 3]:
+            gs = GeneSequence(gene_fa, nuc_context=nuc_context)
+            gs.set_gene(bed)
+            sc = SequenceContext(gs)
+            # first call creates the cache, the second reads it
+            for i in range(2):
+                cached_sc = SequenceContext(gs, cache_dir=cache_dir)
+                assert sc.contexts == cached_sc.contexts, 'Cached contexts differ'
+                assert np.array_equal(sc.context_ptr, cached_sc.context_ptr), 'Cached context offsets differ'
+                assert np.array_equal(sc.context_pos, cached_sc.context_pos), 'Cached context positions differ'
+                assert np.array_equal(sc.pos_context, cached_sc.pos_context), 'Cached position contexts differ'
+            shutil.rmtree(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def test_get_contexts():
+    for nuc_context in [0, 1, 2, 1.5, 3]:
+        gs = GeneSequence(gene_fa, nuc_context=nuc_context)
+        gs.set_gene(bed)
+        sc = SequenceContext(gs)
+        pos2context = sc.pos2context
+        positions = sorted(pos2context)
+        contexts = sc.get_contexts(positions)
+        assert list(contexts) == [pos2context[p] for p in positions], 'Wrong contexts for positions'
+
+
+def test_generator_backend():
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    sc1 = SequenceContext(gs, seed=101, random_backend='generator')
+    sc2 = SequenceContext(gs, seed=101, random_backend='generator')
+    pos1 = sc1.random_context_pos(5, 10, 'A')
+    pos2 = sc2.random_context_pos(5, 10, 'A')
+    assert (pos1 == pos2).all(), 'Same seed should give the same positions'
+    assert set(pos1.flatten()) <= set(sc1.context2pos['A']), 'Positions should match the context'
+
+
 def _check_true_counts(seq_context, true_counts):
     for letter in true_counts:
         true_ct = true_counts[letter]
@@ -89,4 +133,4 @@ def _check_true_context_pos(seq_context, true_context_pos):
         assert_msg = 'Context positions don\'t match ({0}: {1} != {2})'.format(letter,
                                                                                true_context_pos[letter],
                                                                                seq_context.context2pos[letter])
-        assert true_context_pos[letter] == seq_context.context2pos[letter], assert_msg
+        assert list(true_context_pos[letter]) == list(seq_context.context2pos[letter]), assert_msg
@@ -5,6 +5,18 @@ file_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(file_dir, '../'))
 
 import prob2020.console.annotate as sm
+import prob2020.console.simulate_non_silent_ratio as snr
+import prob2020.python.indel as indel
+import prob2020.python.utils as utils
+import prob2020.python.batch_stats as batch_stats
+import prob2020.python.mutation_context as mc
+import prob2020.python.mymath as mymath
+import prob2020.python.maf_writer as maf_writer
+import prob2020.cython.cutils as cutils
+from prob2020.python.gene_sequence import GeneSequence
+import numpy as np
+import pandas as pd
+import pysam
 
 def test_sim_summary():
     opts = {'input': os.path.join(file_dir, 'data/sim_summary.fa'),
@@ -36,5 +48,179 @@ def test_sim_summary():
     sm.main(opts)
 
 
+def test_batch_summary_info():
+    gene_fa = pysam.Fastafile(os.path.join(file_dir, 'data/CTNNB1.fa'))
+    with open(os.path.join(file_dir, 'data/CTNNB1.bed')) as handle:
+        bed = utils.BedLine(handle.readline().strip())
+    gs = GeneSequence(gene_fa, nuc_context=1)
+    gs.set_gene(bed)
+    score_dir = os.path.join(file_dir, 'data/scores/')
+
+    # random mutations, concentrated on a few codons so that some are recurrent
+    prng = np.random.RandomState(101)
+    num_sim, num_mut = 40, 30
+    splice_pos = sorted(bed.pos2ss)
+    candidate_pos = np.concatenate([prng.randint(0, bed.cds_len, size=12),
+                                    [0, 1, 2, bed.cds_len-1], splice_pos[:4]])
+    mut_pos = prng.choice(candidate_pos, size=(num_sim, num_mut))
+    somatic_base = list(prng.choice(list('ACGT'), size=num_mut))
+    aa_info = mc.get_aa_mut_info_batch(mut_pos, somatic_base, gs)
+    summary_info = batch_stats.calc_summary_info(aa_info, bed.gene_name, score_dir,
+                                                 min_frac=.02, min_recur=3)
+
+    for i in range(num_sim):
+        mut_info = mc.get_aa_mut_info(mut_pos[i], somatic_base, gs)
+        true_info = cutils.calc_summary_info(mut_info['Reference AA'],
+                                             mut_info['Somatic AA'],
+                                             mut_info['Codon Pos'],
+                                             bed.gene_name, score_dir,
+                                             min_frac=.02, min_recur=3)
+        pos_ct = list(true_info.pop(-1).values())
+        assert list(summary_info[i, :8]) == true_info[:8]
+        assert np.allclose(summary_info[i, 8:-1], true_info[8:], rtol=1e-12)
+        assert np.isclose(summary_info[i, -1], mymath.xlog2x(pos_ct).sum())
+
+        # mutation entropy from the summary matches the mutation counts
+        counts = pos_ct + [1]*true_info[1] + [sum(true_info[2:6]) + 2, 3]
+        norm_ent = sm.summary_mutation_entropy(summary_info[i:i+1], np.array([2]),
+                                               np.array([3]))
+        assert np.isclose(norm_ent[0], mymath.normalized_mutation_entropy(counts))
+    gene_fa.close()
+
+
+def test_sim_maf_formats():
+    opts = {'input': os.path.join(file_dir, 'data/sim_summary.fa'),
+            'mutations': os.path.join(file_dir, 'data/sim_summary_mutations.txt'),
+            'bed': os.path.join(file_dir, 'data/sim_summary.bed'),
+            'processes': 0,
+            'num_iterations': 3,
+            'context': 1.5,
+            'summary': False,
+            'maf': True,
+            'unique': True,
+            'use_unmapped': False,
+            'genome': '',
+            'score_dir': None,
+            'fraction': .02,
+            'recurrent': 3,
+            'drop_silent': False,
+            'restrict_genes': False,
+            'seed': 101}
+
+    # other files in the output directory are kept
+    npz_dir = os.path.join(file_dir, 'output', 'sim_summary_maf_formats')
+    if not os.path.exists(npz_dir):
+        os.makedirs(npz_dir)
+    other_path = os.path.join(npz_dir, 'other.npz')
+    np.savez(other_path, x=np.arange(3))
+
+    # the simulated SNVs are the same in every output format
+    snv_list = []
+    for output, maf_format in [('sim_summary_maf_formats.txt', None),
+                               ('sim_summary_maf_formats.txt.gz', None),
+                               ('sim_summary_maf_formats', 'npz')]:
+        opts['output'] = os.path.join(file_dir, 'output', output)
+        opts['maf_format'] = maf_format
+        sm.main(opts)
+        maf_df = maf_writer.read_maf(opts['output'], maf_format)
+        snv_df = maf_df[maf_df['Context']!='-'].reset_index(drop=True)
+        assert len(snv_df)
+        snv_list.append(snv_df)
+    for snv_df in snv_list[1:]:
+        assert snv_df.equals(snv_list[0])
+    assert os.path.exists(other_path)
+
+
+def test_simulate_indel_counts():
+    bed_dict = utils.read_bed(os.path.join(file_dir, 'data/100genes.bed'))
+    indel_df = pd.DataFrame({'indel len': [1, 2, 3, 4, 6, 7, 9, 10]})
+    num_sim = 500
+    fs_cts, inframe_cts, gene_names = indel.simulate_indel_counts(indel_df, bed_dict,
+                                                                  num_sim, seed=101,
+                                                                  max_draws=100)
+    assert fs_cts.shape == (num_sim, len(gene_names))
+
+    # every simulation has all indels
+    assert (fs_cts.sum(axis=1) == 5).all()
+    assert (inframe_cts.sum(axis=1) == 3).all()
+
+    # longer genes get more indels
+    gene_len = np.array([b.cds_len for chrom in bed_dict for b in bed_dict[chrom]])
+    total_cts = np.asarray((fs_cts + inframe_cts).sum(axis=0))[0]
+    assert np.corrcoef(gene_len, total_cts)[0, 1] > .8
+
+    # counts do not depend on the number of indels assigned at a time
+    fs_all, inframe_all, _ = indel.simulate_indel_counts(indel_df, bed_dict,
+                                                         num_sim, seed=101)
+    assert (fs_all != fs_cts).nnz == 0
+    assert (inframe_all != inframe_cts).nnz == 0
+
+
+def test_analytic_non_silent_ratio():
+    # probabilities of each variant classification for 200 mutations, with
+    # a few mutations whose effect can not be determined
+    prng = np.random.RandomState(101)
+    num_effects = len(utils.variant_snv)
+    effect_frac = prng.dirichlet(np.ones(num_effects+1), size=200)[:, :num_effects]
+    effect_frac[20:] /= effect_frac[20:].sum(axis=1, keepdims=True)
+    null_df = snr.analytic_null(effect_frac, conf_level=.95).set_index('statistic')
+
+    # simulate the effect of each mutation
+    num_sim = 20000
+    cum_frac = np.cumsum(effect_frac, axis=1)
+    effect = (prng.rand(num_sim, len(effect_frac), 1) > cum_frac).sum(axis=2)
+    sim_cts = batch_stats.calc_non_silent_info(effect)
+    sim_ratio = sim_cts[:, 0] / sim_cts[:, 1].astype(float)
+
+    for i, col in enumerate(snr.cols[:7]):
+        assert abs(null_df.loc[col, 'mean'] - sim_cts[:, i].mean()) < .1
+        assert abs(null_df.loc[col, 'std'] - sim_cts[:, i].std()) < .1
+        sim_lower, sim_upper = np.percentile(sim_cts[:, i], [2.5, 97.5])
+        assert abs(null_df.loc[col, 'lower'] - sim_lower) <= 1
+        assert abs(null_df.loc[col, 'upper'] - sim_upper) <= 1
+    ratio = null_df.loc['non-silent/silent ratio']
+    assert abs(ratio['lower'] - np.percentile(sim_ratio, 2.5)) < .05 * ratio['mean']
+    assert abs(ratio['upper'] - np.percentile(sim_ratio, 97.5)) < .05 * ratio['mean']
+
+
+def test_analytic_non_silent_ratio_main():
+    opts = {'input': os.path.join(file_dir, 'data/sim_summary.fa'),
+            'mutations': os.path.join(file_dir, 'data/sim_summary_mutations.txt'),
+            'bed': os.path.join(file_dir, 'data/sim_summary.bed'),
+            'processes': 0,
+            'num_permutations': 5000,
+            'context': 1.5,
+            'use_unmapped': False,
+            'genome': '',
+            'score_dir': None,
+            'by_sample': False,
+            'seed': 101,
+            'cache_dir': None,
+            'observed_output': os.path.join(file_dir, 'output/non_silent_ratio_observed.txt'),
+            'output': os.path.join(file_dir, 'output/non_silent_ratio_sim.txt')}
+    sim_df = snr.main(opts)
+
+    # the analytic null agrees with the simulations
+    opts['analytic'] = True
+    opts['output'] = os.path.join(file_dir, 'output/non_silent_ratio_analytic.txt')
+    null_df = snr.main(opts).set_index('statistic')
+    for col in snr.cols[:7]:
+        assert abs(null_df.loc[col, 'mean'] - sim_df[col].mean()) < .1
+        assert abs(null_df.loc[col, 'std'] - sim_df[col].std()) < .1
+    obs_df = pd.read_csv(opts['observed_output'], sep='\t')
+
+    # per sample null distributions and observed counts add up to the totals
+    opts['by_sample'] = True
+    opts['observed_output'] = os.path.join(file_dir, 'output/non_silent_ratio_observed_by_sample.txt')
+    opts['output'] = os.path.join(file_dir, 'output/non_silent_ratio_analytic_by_sample.txt')
+    sample_null_df = snr.main(opts)
+    sample_obs_df = pd.read_csv(opts['observed_output'], sep='\t', index_col=0)
+    assert list(sample_obs_df.columns) == snr.cols[:7]
+    assert np.allclose(sample_obs_df.sum(), obs_df.iloc[0])
+    assert len(sample_null_df) == len(sample_obs_df) * 8
+    sample_means = sample_null_df.groupby('statistic')['mean'].sum()
+    assert np.allclose(sample_means[snr.cols[:7]], null_df.loc[snr.cols[:7], 'mean'])
+
+
 if __name__ == '__main__':
     test_sim_summary()